@@ -0,0 +1,103 @@
+"""partition_auth_token
+
+Range partitions auth_token by revoked_at, one partition per month, so that expired tokens are
+dropped a whole partition at a time. This revision lives outside the default version location and
+is applied through the auth_token_partitioning section of alembic.ini:
+
+    alembic -n auth_token_partitioning upgrade auth_token_partitioning@head
+
+Once applied, keep running migrations with -n auth_token_partitioning, upgrading 'heads'.
+Rows are copied into the new table inside the migration, schedule it with the application stopped.
+
+There is no default partition, it would keep the token purger from detaching expired partitions
+concurrently. Keep the purger enabled (TOKEN_PURGE_INTERVAL), it creates the partitions ahead.
+
+Revision ID: 7e2d5b8a9c41
+Revises: 3c9a4f1e2b7d
+Create Date: 2026-10-19 10:31:07.204117
+
+"""
+from datetime import date, datetime, timezone
+from typing import Sequence, Union
+
+from alembic import context, op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7e2d5b8a9c41'
+down_revision: Union[str, None] = '3c9a4f1e2b7d'
+branch_labels: Union[str, Sequence[str], None] = ('auth_token_partitioning',)
+depends_on: Union[str, Sequence[str], None] = None
+
+# Partitions ahead of the current month, the token purger keeps extending them
+PREMADE_MONTHS = 3
+
+COLUMNS = 'id, token, anonymous_user_id, classic_user_id, issued_at, revoked_at'
+
+
+def _next_month(day: date) -> date:
+    return date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+
+def _create_table(partitioned: bool) -> None:
+    primary_key = 'id, revoked_at' if partitioned else 'id'
+    op.execute(f"""
+        CREATE TABLE auth_token (
+            id BIGINT NOT NULL DEFAULT nextval('auth_token_id_seq'),
+            token VARCHAR(64) NOT NULL,
+            anonymous_user_id BIGINT REFERENCES anonymous_identify (id),
+            classic_user_id BIGINT REFERENCES classic_identify (id),
+            issued_at TIMESTAMP WITH TIME ZONE DEFAULT now() NOT NULL,
+            revoked_at TIMESTAMP WITH TIME ZONE DEFAULT now() NOT NULL,
+            CONSTRAINT auth_token_pkey PRIMARY KEY ({primary_key}),
+            CONSTRAINT check_anonymous_or_classic_user CHECK (
+                (anonymous_user_id IS NOT NULL AND classic_user_id IS NULL) OR
+                (anonymous_user_id IS NULL AND classic_user_id IS NOT NULL))
+        ) {'PARTITION BY RANGE (revoked_at)' if partitioned else ''}
+    """)
+    # A unique index of a partitioned table has to include the partition key
+    token_columns = 'token, revoked_at' if partitioned else 'token'
+    op.execute(f"CREATE UNIQUE INDEX ix_auth_token_token ON auth_token ({token_columns})")
+    op.execute("CREATE INDEX ix_auth_token_revoked_at ON auth_token (revoked_at)")
+
+
+def _swap_table(partitioned: bool) -> None:
+    op.execute("ALTER TABLE auth_token RENAME TO auth_token_old")
+    op.execute("ALTER TABLE auth_token_old RENAME CONSTRAINT auth_token_pkey TO auth_token_old_pkey")
+    op.execute("ALTER INDEX ix_auth_token_token RENAME TO ix_auth_token_token_old")
+    op.execute("ALTER INDEX ix_auth_token_revoked_at RENAME TO ix_auth_token_revoked_at_old")
+    op.execute("ALTER SEQUENCE auth_token_id_seq OWNED BY NONE")
+
+    _create_table(partitioned)
+    if partitioned:
+        now = datetime.now(timezone.utc)
+        oldest = now
+        if not context.is_offline_mode():
+            oldest = op.get_bind().execute(sa.text("SELECT min(revoked_at) FROM auth_token_old")).scalar() or now
+        oldest = oldest.astimezone(timezone.utc)
+        month = date(oldest.year, oldest.month, 1)
+        last = date(now.year, now.month, 1)
+        for _ in range(PREMADE_MONTHS):
+            last = _next_month(last)
+        while month <= last:
+            op.execute(
+                f"CREATE TABLE auth_token_p{month:%Y%m} PARTITION OF auth_token "
+                f"FOR VALUES FROM ('{month.isoformat()} 00:00+00') TO ('{_next_month(month).isoformat()} 00:00+00')"
+            )
+            month = _next_month(month)
+        if context.is_offline_mode():
+            # Offline scripts start at the current month, older rows land here
+            op.execute("CREATE TABLE auth_token_default PARTITION OF auth_token DEFAULT")
+
+    op.execute(f"INSERT INTO auth_token ({COLUMNS}) SELECT {COLUMNS} FROM auth_token_old")
+    op.execute("DROP TABLE auth_token_old")
+    op.execute("ALTER SEQUENCE auth_token_id_seq OWNED BY auth_token.id")
+
+
+def upgrade() -> None:
+    _swap_table(partitioned=True)
+
+
+def downgrade() -> None:
+    _swap_table(partitioned=False)
@@ -0,0 +1,83 @@
+"""cache_invalidation_triggers
+
+Revision ID: 5b1e8d3a7c20
+Revises: 3c9a4f1e2b7d
+Create Date: 2026-10-19 14:03:27.114052
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5b1e8d3a7c20'
+down_revision: Union[str, None] = '3c9a4f1e2b7d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+CHANNEL = 'hiccup_cache_invalidation'
+
+# Table and the column of its rows that names the cache entries to drop
+TABLES = {
+    'virtual_server': 'id',
+    'virtual_server_alias': 'id',
+    'channel': 'id',
+    'permission_group': 'id',
+    'classic_identify': 'id',
+    'user_permission_group': 'classic_user_id',
+}
+
+# One notification per statement. The changed keys are collected from the transition tables, statements
+# touching too many rows for the 8000 bytes of a payload (and TRUNCATE) send no keys, the whole table is
+# invalidated then.
+NOTIFY_FUNCTION = f"""
+CREATE OR REPLACE FUNCTION hiccup_notify_cache_invalidation() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    keys bigint[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        EXECUTE format('SELECT array_agg(DISTINCT %I) FROM new_rows', TG_ARGV[0]) INTO keys;
+    ELSIF TG_OP = 'UPDATE' THEN
+        EXECUTE format('SELECT array_agg(DISTINCT k) FROM (SELECT %1$I AS k FROM old_rows UNION SELECT %1$I FROM new_rows) changed', TG_ARGV[0]) INTO keys;
+    ELSIF TG_OP = 'DELETE' THEN
+        EXECUTE format('SELECT array_agg(DISTINCT %I) FROM old_rows', TG_ARGV[0]) INTO keys;
+    END IF;
+
+    IF TG_OP <> 'TRUNCATE' AND keys IS NULL THEN
+        RETURN NULL;
+    END IF;
+    IF cardinality(keys) > 500 THEN
+        keys := NULL;
+    END IF;
+
+    PERFORM pg_notify('{CHANNEL}', json_build_object('t', TG_TABLE_NAME, 'k', keys, 'x', txid_current())::text);
+    RETURN NULL;
+END
+$$
+"""
+
+
+def upgrade() -> None:
+    op.execute(NOTIFY_FUNCTION)
+    for table, column in TABLES.items():
+        op.execute(f"CREATE TRIGGER {table}_invalidate_insert AFTER INSERT ON {table} "
+                   f"REFERENCING NEW TABLE AS new_rows "
+                   f"FOR EACH STATEMENT EXECUTE FUNCTION hiccup_notify_cache_invalidation('{column}')")
+        op.execute(f"CREATE TRIGGER {table}_invalidate_update AFTER UPDATE ON {table} "
+                   f"REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows "
+                   f"FOR EACH STATEMENT EXECUTE FUNCTION hiccup_notify_cache_invalidation('{column}')")
+        op.execute(f"CREATE TRIGGER {table}_invalidate_delete AFTER DELETE ON {table} "
+                   f"REFERENCING OLD TABLE AS old_rows "
+                   f"FOR EACH STATEMENT EXECUTE FUNCTION hiccup_notify_cache_invalidation('{column}')")
+        op.execute(f"CREATE TRIGGER {table}_invalidate_truncate AFTER TRUNCATE ON {table} "
+                   f"FOR EACH STATEMENT EXECUTE FUNCTION hiccup_notify_cache_invalidation('{column}')")
+
+
+def downgrade() -> None:
+    for table in TABLES:
+        for event in ('insert', 'update', 'delete', 'truncate'):
+            op.execute(f"DROP TRIGGER IF EXISTS {table}_invalidate_{event} ON {table}")
+    op.execute("DROP FUNCTION IF EXISTS hiccup_notify_cache_invalidation()")
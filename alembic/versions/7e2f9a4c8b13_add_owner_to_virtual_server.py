@@ -0,0 +1,28 @@
+"""add-owner-to-virtual-server
+
+Revision ID: 7e2f9a4c8b13
+Revises: 9d4c2e7b1f36
+Create Date: 2026-10-19 18:42:09.503817
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7e2f9a4c8b13'
+down_revision: Union[str, None] = '9d4c2e7b1f36'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('virtual_server', sa.Column('owner_id', sa.BigInteger(), nullable=True))
+    op.create_foreign_key('virtual_server_owner_id_fkey', 'virtual_server', 'classic_identify', ['owner_id'], ['id'])
+
+
+def downgrade() -> None:
+    op.drop_constraint('virtual_server_owner_id_fkey', 'virtual_server', type_='foreignkey')
+    op.drop_column('virtual_server', 'owner_id')
@@ -0,0 +1,38 @@
+"""membership_invalidation_trigger
+
+Revision ID: 9d4c2e7b1f36
+Revises: 5b1e8d3a7c20
+Create Date: 2026-10-19 16:41:08.572931
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9d4c2e7b1f36'
+down_revision: Union[str, None] = '5b1e8d3a7c20'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Membership indexes are keyed by user, notify the users whose memberships changed
+    op.execute("CREATE TRIGGER user_joined_server_invalidate_insert AFTER INSERT ON user_joined_server "
+               "REFERENCING NEW TABLE AS new_rows "
+               "FOR EACH STATEMENT EXECUTE FUNCTION hiccup_notify_cache_invalidation('classic_user_id')")
+    op.execute("CREATE TRIGGER user_joined_server_invalidate_update AFTER UPDATE ON user_joined_server "
+               "REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows "
+               "FOR EACH STATEMENT EXECUTE FUNCTION hiccup_notify_cache_invalidation('classic_user_id')")
+    op.execute("CREATE TRIGGER user_joined_server_invalidate_delete AFTER DELETE ON user_joined_server "
+               "REFERENCING OLD TABLE AS old_rows "
+               "FOR EACH STATEMENT EXECUTE FUNCTION hiccup_notify_cache_invalidation('classic_user_id')")
+    op.execute("CREATE TRIGGER user_joined_server_invalidate_truncate AFTER TRUNCATE ON user_joined_server "
+               "FOR EACH STATEMENT EXECUTE FUNCTION hiccup_notify_cache_invalidation('classic_user_id')")
+
+
+def downgrade() -> None:
+    for event in ('insert', 'update', 'delete', 'truncate'):
+        op.execute(f"DROP TRIGGER IF EXISTS user_joined_server_invalidate_{event} ON user_joined_server")
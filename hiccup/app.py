@@ -4,30 +4,43 @@ from contextlib import asynccontextmanager
 import strawberry
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from strawberry.fastapi import GraphQLRouter
 from strawberry.schema.config import StrawberryConfig
 from strawberry.subscriptions import GRAPHQL_TRANSPORT_WS_PROTOCOL, GRAPHQL_WS_PROTOCOL
 from strawberry.extensions import ParserCache, QueryDepthLimiter
 
 from hiccup import SETTINGS
-from hiccup.graphql import Query, Mutation, get_context
+from hiccup.cache import EVENT_BROKER, REVOCATION_FILTER, SHARED_CACHE
+from hiccup.cache.invalidation import DB_CHANGE_LISTENER
+from hiccup.cache.persisted_query import PERSISTED_QUERIES
+from hiccup.db.maintenance import TOKEN_PURGER
+from hiccup.graphql import Query, Mutation, Subscription, get_context
+from hiccup.graphql.extensions import CachedValidation, CachedIntrospection, QueryCostLimiter, UnitOfWorkExtension, \
+    RateLimitReport
+from hiccup.graphql.router import HiccupGraphQLRouter
 from hiccup.services import SERVICE_REGISTRY
 
 # GraphQL
 schema = strawberry.Schema(
     query=Query,
     mutation=Mutation,
+    subscription=Subscription,
     config=StrawberryConfig(
         disable_field_suggestions=not SETTINGS.debug_enabled,
     ),
     extensions=[
         ParserCache(maxsize=SETTINGS.graphql_parser_cache_size),
         QueryDepthLimiter(max_depth=SETTINGS.graphql_max_query_depth),
+        CachedValidation,
+        CachedIntrospection,
+        QueryCostLimiter,
+        RateLimitReport,
+        UnitOfWorkExtension,
     ],
 )
+CachedIntrospection.warm(schema)
 logging.getLogger("strawberry.execution").setLevel(logging.INFO if SETTINGS.debug_enabled else logging.CRITICAL)
 
-graphql_app = GraphQLRouter(
+graphql_app = HiccupGraphQLRouter(
     schema,
     debug=SETTINGS.debug_enabled,
     context_getter=get_context,
@@ -42,8 +55,19 @@ graphql_app = GraphQLRouter(
 async def lifespan(a: FastAPI):
     # Setup
     await SERVICE_REGISTRY.setup()
+    await PERSISTED_QUERIES.setup()
+    await EVENT_BROKER.setup()
+    await REVOCATION_FILTER.setup()
+    await SHARED_CACHE.setup()
+    await DB_CHANGE_LISTENER.setup()
+    await TOKEN_PURGER.setup()
     yield
     # Clean up
+    await TOKEN_PURGER.dispose()
+    await DB_CHANGE_LISTENER.dispose()
+    await SHARED_CACHE.dispose()
+    await REVOCATION_FILTER.dispose()
+    await EVENT_BROKER.dispose()
     await SERVICE_REGISTRY.dispose()
 
 app = FastAPI(lifespan=lifespan)
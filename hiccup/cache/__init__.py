@@ -1,5 +1,19 @@
 from hiccup.cache.redis import *
 from hiccup.cache.utils import *
+from hiccup.cache.response import get_cached_response, store_cached_response, invalidate_response_tags
+from hiccup.cache.entity import ENTITY_CACHES, VIRTUAL_SERVER_CACHE, CHANNEL_CACHE, VIRTUAL_SERVER_ALIAS_CACHE, \
+    ALIAS_RESOLUTION_CACHE
+from hiccup.cache.pubsub import EVENT_BROKER
+from hiccup.cache.presence import PRESENCE
+from hiccup.cache.revocation import REVOCATION_FILTER
+from hiccup.cache.ratelimit import RATE_LIMITER
+from hiccup.cache.shared import SHARED_CACHE
+from hiccup.cache.membership import MEMBERSHIP_INDEX
 
 
-__all__ = ['AsyncRedisSessionLocal', 'cache_nonce', 'get_user_permission_cached', 'get_user_permission_no_cache']
+__all__ = ['AsyncRedisSessionLocal', 'cache_nonce', 'get_user_permission_cached', 'get_user_permission_no_cache',
+           'mark_recent_write', 'has_recent_write',
+           'get_cached_response', 'store_cached_response', 'invalidate_response_tags',
+           'ENTITY_CACHES', 'VIRTUAL_SERVER_CACHE', 'CHANNEL_CACHE', 'VIRTUAL_SERVER_ALIAS_CACHE', 'ALIAS_RESOLUTION_CACHE',
+           'EVENT_BROKER', 'PRESENCE', 'REVOCATION_FILTER', 'RATE_LIMITER', 'SHARED_CACHE',
+           'MEMBERSHIP_INDEX']
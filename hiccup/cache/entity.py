@@ -0,0 +1,359 @@
+import enum
+from datetime import timedelta
+from typing import Any, Generic, Optional, Type, TypeVar
+
+from pydantic import BaseModel, ConfigDict
+from sqlalchemy.orm import DeclarativeBase
+
+from hiccup import SETTINGS
+from hiccup.cache.redis import AsyncRedisSessionLocal, REDIS_FAILURES
+from hiccup.cache.shared import SHARED_CACHE
+from hiccup.cache.utils import delete_keys_matching
+from hiccup.db import AsyncSessionLocal
+from hiccup.db.server import Channel, VirtualServer, VirtualServerAlias, ServerConfiguration
+from hiccup.db.statements import row_by_id, rows_by_ids, id_by_column
+
+
+class _Prefix(str, enum.Enum):
+    Entity = "ENTITY::"
+    Version = "ENTITY-VERSION::"
+    Index = "ENTITY-INDEX::"
+    AliasResolution = "ALIAS-RESOLUTION::"
+
+
+class EntityEntry(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    version: int = 0
+
+
+class VirtualServerEntry(EntityEntry):
+    name: str
+    configuration: Optional[dict] = None
+    owner_id: Optional[int] = None
+    config: ServerConfiguration
+
+
+class ChannelEntry(EntityEntry):
+    server_id: int
+    name: str
+    joinable: bool
+    configuration: Optional[dict] = None
+
+
+class VirtualServerAliasEntry(EntityEntry):
+    name: str
+    virtual_server_id: int
+    valid: bool
+
+
+class AliasResolution(BaseModel):
+    alias_id: int
+    alias_version: int
+    valid: bool
+    server_id: int
+    server_version: int
+    server_name: str
+    server_configuration: Optional[dict] = None
+    allow_join_by_alias: bool
+
+
+EntryT = TypeVar('EntryT', bound=EntityEntry)
+
+# KEYS: index key  ARGV: entity key prefix, version key prefix
+_GET_BY_INDEX_SCRIPT = """
+local ident = redis.call('GET', KEYS[1])
+if not ident then
+    return {false, false, false}
+end
+return {ident, redis.call('GET', ARGV[1] .. ident), redis.call('GET', ARGV[2] .. ident)}
+"""
+
+# KEYS: resolution key  ARGV: alias version key prefix, server version key prefix
+_GET_ALIAS_RESOLUTION_SCRIPT = """
+local resolution = redis.call('HMGET', KEYS[1], 'alias_id', 'server_id', 'payload')
+if not resolution[3] then
+    return {false, false, false}
+end
+return {resolution[3], redis.call('GET', ARGV[1] .. resolution[1]), redis.call('GET', ARGV[2] .. resolution[2])}
+"""
+
+
+class EntityCache(Generic[EntryT]):
+    """
+    Read-through cache of rows keyed by primary key, optionally reachable through one unique column.
+
+    Every entry records the row version it was loaded at. Writers bump the version before readers may
+    refill, so an entry loaded from a row that changed meanwhile is never served.
+    """
+    def __init__(self, model: Type[DeclarativeBase], entry_type: Type[EntryT], index_column: Optional[str] = None):
+        self.model = model
+        self.entry_type = entry_type
+        self.index_column = index_column
+        self.name = model.__table__.name
+
+    @property
+    def ttl(self) -> timedelta:
+        return timedelta(seconds=SETTINGS.entity_cache_ttl)
+
+    @property
+    def version_ttl(self) -> timedelta:
+        # Versions must outlive every entry written against them
+        return self.ttl * 2
+
+    def _entity_key(self, ident: Any = '') -> str:
+        return f'{_Prefix.Entity.value}{self.name}::{ident}'
+
+    def _version_key(self, ident: Any = '') -> str:
+        return f'{_Prefix.Version.value}{self.name}::{ident}'
+
+    def _index_key(self, value: Any) -> str:
+        return f'{_Prefix.Index.value}{self.name}::{self.index_column}::{value}'
+
+    async def _fetch(self, ident: Any, version: int = 0) -> Optional[EntryT]:
+        async with AsyncSessionLocal() as db_session:
+            row = await db_session.scalar(row_by_id(self.model), {'ident': ident})
+        if row is None:
+            return None
+        return self.entry_type.model_validate(row).model_copy(update={'version': version})
+
+    async def _load(self, session, ident: Any, version: int) -> Optional[EntryT]:
+        entry = await self._fetch(ident, version)
+        if entry is None:
+            return None
+        await session.set(self._entity_key(ident), entry.model_dump_json(), ex=self.ttl)
+        return entry
+
+    def _parse(self, payload: Optional[bytes], version: Optional[bytes]) -> (Optional[EntryT], int):
+        version = int(version or 0)
+        if payload is None:
+            return None, version
+        entry = self.entry_type.model_validate_json(payload)
+        if entry.version != version:
+            return None, version
+        return entry, version
+
+    def _shared_get(self, ident: Any) -> Optional[EntryT]:
+        payload = SHARED_CACHE.get(self._entity_key(ident))
+        return None if payload is None else self.entry_type.model_validate_json(payload)
+
+    def _shared_put(self, entry: Optional[EntryT], generation: int) -> None:
+        if entry is not None and SHARED_CACHE.enabled:
+            SHARED_CACHE.put(self._entity_key(entry.id), entry.model_dump_json().encode('utf-8'), generation)
+
+    async def get(self, ident: int) -> Optional[EntryT]:
+        entry = self._shared_get(ident)
+        if entry is not None:
+            return entry
+        generation = SHARED_CACHE.generation
+        try:
+            entry = await self._get(ident)
+        except REDIS_FAILURES:
+            # Read through to the database while redis is unavailable
+            return await self._fetch(ident)
+        self._shared_put(entry, generation)
+        return entry
+
+    async def _get(self, ident: int) -> Optional[EntryT]:
+        async with AsyncRedisSessionLocal() as session:
+            payload, version = await session.mget(self._entity_key(ident), self._version_key(ident))
+            entry, version = self._parse(payload, version)
+            if entry is not None:
+                return entry
+            return await self._load(session, ident, version)
+
+    async def get_many(self, idents: list[int]) -> dict[int, EntryT]:
+        """
+        Entries of several rows in one redis round trip and at most one query. Rows that don't exist are left out.
+        """
+        entries: dict[int, EntryT] = {}
+        for ident in idents:
+            entry = self._shared_get(ident)
+            if entry is not None:
+                entries[ident] = entry
+        idents = [ident for ident in dict.fromkeys(idents) if ident not in entries]
+        if not idents:
+            return entries
+
+        generation = SHARED_CACHE.generation
+        versions: dict[int, int] = {ident: 0 for ident in idents}
+        redis_available = True
+        try:
+            async with AsyncRedisSessionLocal() as session:
+                values = await session.mget([key for ident in idents for key in (self._entity_key(ident), self._version_key(ident))])
+            for i, ident in enumerate(idents):
+                entry, versions[ident] = self._parse(values[2 * i], values[2 * i + 1])
+                if entry is not None:
+                    entries[ident] = entry
+                    self._shared_put(entry, generation)
+        except REDIS_FAILURES:
+            redis_available = False
+
+        missing = [ident for ident in idents if ident not in entries]
+        if not missing:
+            return entries
+        async with AsyncSessionLocal() as db_session:
+            rows = (await db_session.scalars(rows_by_ids(self.model), {'idents': missing})).all()
+        loaded = [self.entry_type.model_validate(row).model_copy(update={'version': versions[row.id]}) for row in rows]
+        for entry in loaded:
+            entries[entry.id] = entry
+        if redis_available and loaded:
+            for entry in loaded:
+                self._shared_put(entry, generation)
+            try:
+                async with AsyncRedisSessionLocal() as session:
+                    async with session.pipeline(transaction=False) as pipe:
+                        for entry in loaded:
+                            pipe.set(self._entity_key(entry.id), entry.model_dump_json(), ex=self.ttl)
+                        await pipe.execute()
+            except REDIS_FAILURES:
+                pass
+        return entries
+
+    async def get_by(self, value: Any) -> Optional[EntryT]:
+        """
+        Lookup by the index column. The index only maps to a primary key, a stale mapping
+        (renamed or deleted row) is detected by comparing against the loaded entry.
+        """
+        assert self.index_column is not None
+        index_key = self._index_key(value)
+        ident = SHARED_CACHE.get(index_key)
+        if ident is not None:
+            entry = self._shared_get(int(ident))
+            if entry is not None and getattr(entry, self.index_column) == value:
+                return entry
+
+        generation = SHARED_CACHE.generation
+        try:
+            entry = await self._get_by(value)
+        except REDIS_FAILURES:
+            async with AsyncSessionLocal() as db_session:
+                ident = await db_session.scalar(id_by_column(self.model, self.index_column), {'value': value})
+            return None if ident is None else await self._fetch(ident)
+        if entry is not None and SHARED_CACHE.enabled:
+            SHARED_CACHE.put(index_key, str(entry.id).encode('utf-8'), generation)
+            self._shared_put(entry, generation)
+        return entry
+
+    async def _get_by(self, value: Any) -> Optional[EntryT]:
+        index_key = self._index_key(value)
+        async with AsyncRedisSessionLocal() as session:
+            ident, payload, version = await session.register_script(_GET_BY_INDEX_SCRIPT)(
+                keys=[index_key],
+                args=[self._entity_key(), self._version_key()],
+            )
+            if ident is not None:
+                entry, version = self._parse(payload, version)
+                if entry is None:
+                    entry = await self._load(session, int(ident), version)
+                if entry is not None and getattr(entry, self.index_column) == value:
+                    return entry
+                await session.delete(index_key)
+
+            async with AsyncSessionLocal() as db_session:
+                ident = await db_session.scalar(id_by_column(self.model, self.index_column), {'value': value})
+            if ident is None:
+                return None
+            await session.set(index_key, ident, ex=self.ttl)
+            payload, version = await session.mget(self._entity_key(ident), self._version_key(ident))
+            entry, version = self._parse(payload, version)
+            if entry is not None:
+                return entry
+            return await self._load(session, ident, version)
+
+    async def invalidate(self, *idents: int) -> None:
+        if not idents:
+            return
+        async with AsyncRedisSessionLocal() as session:
+            async with session.pipeline(transaction=False) as pipe:
+                for ident in idents:
+                    pipe.incr(self._version_key(ident))
+                    pipe.expire(self._version_key(ident), self.version_ttl)
+                    pipe.delete(self._entity_key(ident))
+                await pipe.execute()
+        await SHARED_CACHE.invalidate(*(self._entity_key(ident) for ident in idents))
+
+    async def flush(self) -> None:
+        """
+        Drop every entry and index mapping. Versions are kept, they only ever grow.
+        """
+        await delete_keys_matching(f'{self._entity_key()}*')
+        if self.index_column is not None:
+            await delete_keys_matching(f'{_Prefix.Index.value}{self.name}::*')
+        await SHARED_CACHE.flush()
+
+
+VIRTUAL_SERVER_CACHE = EntityCache(VirtualServer, VirtualServerEntry)
+CHANNEL_CACHE = EntityCache(Channel, ChannelEntry)
+VIRTUAL_SERVER_ALIAS_CACHE = EntityCache(VirtualServerAlias, VirtualServerAliasEntry, index_column='name')
+
+
+class AliasResolutionCache:
+    """
+    What joining by alias needs to know, in one round trip. A resolution is put together from the alias
+    and server entries and records both their versions, it is stale as soon as either entity is invalidated.
+    """
+    def __init__(self, alias_cache: EntityCache[VirtualServerAliasEntry], server_cache: EntityCache[VirtualServerEntry]):
+        self.alias_cache = alias_cache
+        self.server_cache = server_cache
+
+    def _key(self, alias: str) -> str:
+        return f'{_Prefix.AliasResolution.value}{alias}'
+
+    async def _compose(self, alias: str) -> Optional[AliasResolution]:
+        alias_entry = await self.alias_cache.get_by(alias)
+        if alias_entry is None:
+            return None
+        server_entry = await self.server_cache.get(alias_entry.virtual_server_id)
+        if server_entry is None:
+            return None
+        return AliasResolution(
+            alias_id=alias_entry.id,
+            alias_version=alias_entry.version,
+            valid=alias_entry.valid,
+            server_id=server_entry.id,
+            server_version=server_entry.version,
+            server_name=server_entry.name,
+            server_configuration=server_entry.configuration,
+            allow_join_by_alias=server_entry.config.allow_join_by_alias,
+        )
+
+    async def get(self, alias: str) -> Optional[AliasResolution]:
+        key = self._key(alias)
+        try:
+            async with AsyncRedisSessionLocal() as session:
+                payload, alias_version, server_version = await session.register_script(_GET_ALIAS_RESOLUTION_SCRIPT)(
+                    keys=[key],
+                    args=[self.alias_cache._version_key(), self.server_cache._version_key()],
+                )
+            if payload is not None:
+                resolution = AliasResolution.model_validate_json(payload)
+                if resolution.alias_version == int(alias_version or 0) and resolution.server_version == int(server_version or 0):
+                    return resolution
+        except REDIS_FAILURES:
+            return await self._compose(alias)
+
+        resolution = await self._compose(alias)
+        if resolution is None:
+            return None
+        try:
+            async with AsyncRedisSessionLocal() as session:
+                async with session.pipeline(transaction=True) as pipe:
+                    pipe.hset(key, mapping={
+                        'alias_id': resolution.alias_id,
+                        'server_id': resolution.server_id,
+                        'payload': resolution.model_dump_json(),
+                    })
+                    pipe.expire(key, self.alias_cache.ttl)
+                    await pipe.execute()
+        except REDIS_FAILURES:
+            pass
+        return resolution
+
+
+ALIAS_RESOLUTION_CACHE = AliasResolutionCache(VIRTUAL_SERVER_ALIAS_CACHE, VIRTUAL_SERVER_CACHE)
+
+ENTITY_CACHES: dict[str, EntityCache] = {
+    cache.name: cache for cache in (VIRTUAL_SERVER_CACHE, CHANNEL_CACHE, VIRTUAL_SERVER_ALIAS_CACHE)
+}
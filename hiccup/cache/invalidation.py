@@ -0,0 +1,185 @@
+import asyncio
+import enum
+import hashlib
+import json
+import logging
+from contextlib import suppress
+from typing import Any, Optional
+
+import asyncpg
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+
+from hiccup import SETTINGS
+from hiccup.cache.entity import ENTITY_CACHES
+from hiccup.cache.membership import MEMBERSHIP_INDEX
+from hiccup.cache.redis import AsyncRedisSessionLocal
+from hiccup.cache.response import invalidate_response_tags
+from hiccup.cache.utils import invalidate_permission_cache, flush_permission_cache
+from hiccup.db import AsyncSessionLocal
+from hiccup.metrics import METRICS
+
+
+logger = logging.getLogger(__name__)
+
+# Channel notified by the triggers of the cache_invalidation_triggers migration
+_CHANNEL = "hiccup_cache_invalidation"
+
+GROUP_MEMBERS = text("SELECT classic_user_id FROM user_permission_group WHERE permission_group_id = ANY(:ids)")
+
+
+class _Prefix(str, enum.Enum):
+    Applied = "DB-CHANGE::"
+    Flushed = "DB-CHANGE-FLUSH"
+
+
+class ChangeListener:
+    """
+    Turns row change notifications of the database into cache invalidations, so that changes made
+    outside the GraphQL mutations (migrations, admin SQL, other services) reach the caches too.
+
+    Every worker listens, the first worker to claim a notification in redis applies it. While the
+    connection is down notifications are lost, every (re)connect and every overflow of the queue
+    therefore flushes the caches fed by the watched tables.
+    """
+    task: Optional[asyncio.Task]
+
+    def __init__(self):
+        self.task = None
+        self._queue: Optional[asyncio.Queue[str]] = None
+        self._overflowed = False
+        self.notifications = 0
+        self.applied = 0
+        self.flushes = 0
+        self.reconnects = 0
+        self.connected = False
+        METRICS.register('db_change_listener', self.stats)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            'connected': self.connected,
+            'notifications': self.notifications,
+            'applied': self.applied,
+            'flushes': self.flushes,
+            'reconnects': self.reconnects,
+        }
+
+    async def setup(self):
+        if SETTINGS.db_change_listener_enabled:
+            self.task = asyncio.create_task(self._listen())
+
+    async def dispose(self):
+        if self.task is not None:
+            self.task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self.task
+        self.task = None
+
+    @staticmethod
+    def _dsn() -> str:
+        # asyncpg takes a plain postgresql url
+        return make_url(SETTINGS.database_url).set(drivername='postgresql').render_as_string(hide_password=False)
+
+    def _on_notification(self, connection, pid: int, channel: str, payload: str) -> None:
+        self.notifications += 1
+        if self._queue.full():
+            self._overflowed = True
+            return
+        self._queue.put_nowait(payload)
+
+    async def _listen(self):
+        delay = 1.0
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(self._dsn(), timeout=SETTINGS.db_change_listener_keepalive)
+                self._queue = asyncio.Queue(maxsize=SETTINGS.db_change_listener_queue_size)
+                self._overflowed = False
+                await connection.add_listener(_CHANNEL, self._on_notification)
+                self.connected = True
+                delay = 1.0
+                # Changes made while nobody listened are unknown
+                await self.flush()
+                await self._consume(connection)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Database change listener disconnected: {e}")
+            finally:
+                self.connected = False
+                if connection is not None:
+                    with suppress(Exception):
+                        await connection.close(timeout=1.0)
+            self.reconnects += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+
+    async def _consume(self, connection: asyncpg.Connection):
+        while True:
+            try:
+                payload = await asyncio.wait_for(self._queue.get(), timeout=SETTINGS.db_change_listener_keepalive)
+            except asyncio.TimeoutError:
+                # A dead connection delivers nothing, find out before notifications pile up elsewhere
+                await connection.fetchval('SELECT 1', timeout=SETTINGS.db_change_listener_keepalive)
+                continue
+
+            if self._overflowed:
+                self._overflowed = False
+                await self.flush()
+                continue
+            try:
+                await self.apply(payload)
+            except Exception as e:
+                logger.warning(f"Applying database change {payload} failed, flushing caches: {e}")
+                await self.flush()
+
+    async def _claim(self, key: str, ttl: int) -> bool:
+        async with AsyncRedisSessionLocal() as session:
+            return bool(await session.set(key, 1, nx=True, ex=ttl))
+
+    async def apply(self, payload: str) -> None:
+        digest = hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+        if not await self._claim(f'{_Prefix.Applied.value}{digest}', 60):
+            return
+        change = json.loads(payload)
+        table, keys = change['t'], change['k']
+        self.applied += 1
+
+        if table in ENTITY_CACHES:
+            if keys is None:
+                await ENTITY_CACHES[table].flush()
+            else:
+                await ENTITY_CACHES[table].invalidate(*keys)
+                await invalidate_response_tags(*(f'{table}:{key}' for key in keys))
+        elif table in ('classic_identify', 'user_permission_group'):
+            if keys is None:
+                await flush_permission_cache()
+            else:
+                await invalidate_permission_cache(*keys)
+        elif table == 'user_joined_server':
+            if keys is None:
+                await MEMBERSHIP_INDEX.flush()
+            else:
+                await MEMBERSHIP_INDEX.invalidate(*keys)
+                await invalidate_response_tags(*(f'user_joined_server:{key}' for key in keys))
+        elif table == 'permission_group':
+            if keys is None:
+                await flush_permission_cache()
+            else:
+                async with AsyncSessionLocal() as session:
+                    members = (await session.execute(GROUP_MEMBERS, {'ids': keys})).scalars().all()
+                await invalidate_permission_cache(*members)
+
+    async def flush(self) -> None:
+        # Workers connecting together, as on a deploy, flush once
+        if not await self._claim(_Prefix.Flushed.value, SETTINGS.db_change_listener_flush_window):
+            return
+        self.flushes += 1
+        logger.info("Flushing caches fed by the database, change notifications may have been lost")
+        for cache in ENTITY_CACHES.values():
+            await cache.flush()
+        await flush_permission_cache()
+        await MEMBERSHIP_INDEX.flush()
+
+
+DB_CHANGE_LISTENER = ChangeListener()
@@ -0,0 +1,153 @@
+import enum
+from datetime import timedelta
+from typing import Optional
+
+from hiccup import SETTINGS
+from hiccup.cache.redis import AsyncRedisSessionLocal, REDIS_FAILURES
+from hiccup.cache.utils import delete_keys_matching
+from hiccup.db import AsyncSessionLocal
+from hiccup.db.statements import JOINED_SERVER_IDS
+
+
+class _Prefix(str, enum.Enum):
+    Servers = "USER-SERVERS::"
+    Version = "USER-SERVERS-VERSION::"
+
+
+# Member 0 marks a loaded index, so that an empty index and a missing one can be told apart.
+# Server ids start at 1 and reads range over scores above 0.
+_LOADED = 0
+
+# KEYS: index, version  ARGV: version read before loading, ttl, server ids
+_STORE_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('ZADD', KEYS[1], 0, 0)
+for i = 3, #ARGV do
+    redis.call('ZADD', KEYS[1], ARGV[i], ARGV[i])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+# KEYS: index, version  ARGV: version ttl, server ids
+_ADD_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    -- A load running now may have read the database before this join
+    redis.call('INCR', KEYS[2])
+    redis.call('EXPIRE', KEYS[2], ARGV[1])
+    return 0
+end
+for i = 2, #ARGV do
+    redis.call('ZADD', KEYS[1], ARGV[i], ARGV[i])
+end
+return 1
+"""
+
+
+class MembershipIndex:
+    """
+    Ids of the servers a user joined, as a sorted set scored by server id so that pages are ranges after a cursor.
+
+    Joins add to an index only once it is loaded, a partial index would pass for the complete one. Changes that
+    can't be applied to the index bump a version, so that an index loaded from the database before the change
+    committed is not stored after it.
+    """
+    @property
+    def ttl(self) -> timedelta:
+        return timedelta(seconds=SETTINGS.membership_cache_ttl)
+
+    def _key(self, uid: int) -> str:
+        return f'{_Prefix.Servers.value}{uid}'
+
+    def _version_key(self, uid: int) -> str:
+        return f'{_Prefix.Version.value}{uid}'
+
+    @staticmethod
+    async def _fetch(uid: int) -> list[int]:
+        async with AsyncSessionLocal() as db_session:
+            return sorted((await db_session.scalars(JOINED_SERVER_IDS, {'uid': uid})).all())
+
+    async def _load(self, uid: int) -> list[int]:
+        async with AsyncRedisSessionLocal() as session:
+            version = await session.get(self._version_key(uid))
+        server_ids = await self._fetch(uid)
+        async with AsyncRedisSessionLocal() as session:
+            await session.register_script(_STORE_SCRIPT)(
+                keys=[self._key(uid), self._version_key(uid)],
+                args=[int(version or 0), int(self.ttl.total_seconds()), *server_ids],
+            )
+        return server_ids
+
+    async def server_ids(self, uid: int, after: Optional[int] = None, limit: Optional[int] = None) -> list[int]:
+        """
+        Joined server ids in ascending order, starting after the server id `after`.
+        """
+        after = after or _LOADED
+        try:
+            async with AsyncRedisSessionLocal() as session:
+                async with session.pipeline(transaction=False) as pipe:
+                    pipe.zscore(self._key(uid), _LOADED)
+                    pipe.zrangebyscore(self._key(uid), f'({after}', '+inf',
+                                       start=0 if limit is not None else None, num=limit)
+                    loaded, members = await pipe.execute()
+            if loaded is not None:
+                return [int(member) for member in members]
+            server_ids = await self._load(uid)
+        except REDIS_FAILURES:
+            server_ids = await self._fetch(uid)
+
+        server_ids = [server_id for server_id in server_ids if server_id > after]
+        return server_ids if limit is None else server_ids[:limit]
+
+    async def is_member(self, uid: int, server_id: int) -> bool:
+        try:
+            async with AsyncRedisSessionLocal() as session:
+                async with session.pipeline(transaction=False) as pipe:
+                    pipe.zscore(self._key(uid), _LOADED)
+                    pipe.zscore(self._key(uid), server_id)
+                    loaded, member = await pipe.execute()
+            if loaded is not None:
+                return member is not None
+            server_ids = await self._load(uid)
+        except REDIS_FAILURES:
+            server_ids = await self._fetch(uid)
+        return server_id in server_ids
+
+    async def add(self, uid: int, *server_ids: int) -> None:
+        if not server_ids:
+            return
+        async with AsyncRedisSessionLocal() as session:
+            await session.register_script(_ADD_SCRIPT)(
+                keys=[self._key(uid), self._version_key(uid)],
+                args=[int(self.ttl.total_seconds()) * 2, *server_ids],
+            )
+
+    async def remove(self, uid: int, *server_ids: int) -> None:
+        if not server_ids:
+            return
+        async with AsyncRedisSessionLocal() as session:
+            async with session.pipeline(transaction=True) as pipe:
+                pipe.incr(self._version_key(uid))
+                pipe.expire(self._version_key(uid), self.ttl * 2)
+                pipe.zrem(self._key(uid), *server_ids)
+                await pipe.execute()
+
+    async def invalidate(self, *uids: int) -> None:
+        if not uids:
+            return
+        async with AsyncRedisSessionLocal() as session:
+            async with session.pipeline(transaction=True) as pipe:
+                for uid in uids:
+                    pipe.incr(self._version_key(uid))
+                    pipe.expire(self._version_key(uid), self.ttl * 2)
+                    pipe.delete(self._key(uid))
+                await pipe.execute()
+
+    async def flush(self) -> None:
+        await delete_keys_matching(f'{_Prefix.Servers.value}*')
+
+
+MEMBERSHIP_INDEX = MembershipIndex()
@@ -0,0 +1,117 @@
+import enum
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Optional
+
+from hiccup import SETTINGS
+from hiccup.cache.redis import AsyncRedisSessionLocal, REDIS_FAILURES
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Prefix(str, enum.Enum):
+    PersistedQuery = "PERSISTED-QUERY::"
+
+
+def query_hash(query: str) -> str:
+    return hashlib.sha256(query.encode('utf-8')).hexdigest()
+
+
+class PersistedQueryRegistry:
+    """
+    Hash addressed GraphQL documents.
+
+    Documents from the manifest are pinned in every worker, documents registered by clients (APQ)
+    are shared through redis and kept in a bounded per-worker LRU. Handing out the very same string
+    object for a hash keeps the parser cache hit cheap.
+    """
+    def __init__(self):
+        self._manifest: dict[str, str] = {}
+        self._local: OrderedDict[str, str] = OrderedDict()
+
+    @property
+    def ttl(self) -> timedelta:
+        return timedelta(seconds=SETTINGS.graphql_persisted_query_ttl)
+
+    @property
+    def allowlist_only(self) -> bool:
+        return SETTINGS.graphql_persisted_queries_allowlist_only
+
+    def _remember(self, sha256_hash: str, query: str) -> str:
+        self._local[sha256_hash] = query
+        self._local.move_to_end(sha256_hash)
+        while len(self._local) > SETTINGS.graphql_persisted_query_cache_size:
+            self._local.popitem(last=False)
+        return query
+
+    async def setup(self) -> None:
+        if SETTINGS.graphql_persisted_query_manifest:
+            count = await self.load_manifest(SETTINGS.graphql_persisted_query_manifest)
+            logger.info(f"Loaded {count} persisted queries from manifest")
+
+    async def load_manifest(self, path: str) -> int:
+        """
+        Accepts either a plain {hash: document} mapping or an apollo style {"operations": [{"body": ...}]} manifest.
+        Documents are always indexed by their own sha256.
+        """
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+
+        if isinstance(manifest, dict) and 'operations' in manifest:
+            documents = [operation['body'] for operation in manifest['operations']]
+        else:
+            documents = list(manifest.values())
+
+        for document in documents:
+            self._manifest[query_hash(document)] = document
+
+        try:
+            async with AsyncRedisSessionLocal() as session:
+                async with session.pipeline(transaction=False) as pipe:
+                    for sha256_hash, document in self._manifest.items():
+                        pipe.set(f'{_Prefix.PersistedQuery.value}{sha256_hash}', document, ex=self.ttl)
+                    await pipe.execute()
+        except REDIS_FAILURES as e:
+            # Pinned in this worker all the same
+            logger.warning(f"Could not share the persisted query manifest: {e}")
+
+        return len(documents)
+
+    async def get(self, sha256_hash: str) -> Optional[str]:
+        if sha256_hash in self._manifest:
+            return self._manifest[sha256_hash]
+        if self.allowlist_only:
+            return None
+
+        if sha256_hash in self._local:
+            self._local.move_to_end(sha256_hash)
+            return self._local[sha256_hash]
+
+        try:
+            async with AsyncRedisSessionLocal() as session:
+                query = await session.get(f'{_Prefix.PersistedQuery.value}{sha256_hash}')
+        except REDIS_FAILURES:
+            # A miss, the client sends the whole document again
+            return None
+        if query is None:
+            return None
+        return self._remember(sha256_hash, query.decode('utf-8'))
+
+    async def register(self, sha256_hash: str, query: str) -> str:
+        if sha256_hash in self._manifest or sha256_hash in self._local:
+            return await self.get(sha256_hash)
+
+        try:
+            async with AsyncRedisSessionLocal() as session:
+                await session.set(f'{_Prefix.PersistedQuery.value}{sha256_hash}', query, ex=self.ttl)
+        except REDIS_FAILURES:
+            # Other workers miss it and have it sent again
+            pass
+        return self._remember(sha256_hash, query)
+
+
+PERSISTED_QUERIES = PersistedQueryRegistry()
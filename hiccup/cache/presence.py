@@ -0,0 +1,86 @@
+import enum
+import time
+from datetime import timedelta
+from typing import Iterable, NamedTuple
+
+from hiccup import SETTINGS
+from hiccup.cache.redis import AsyncRedisSessionLocal
+
+
+class _Prefix(str, enum.Enum):
+    Presence = "PRESENCE::"
+
+
+class PresenceMember(NamedTuple):
+    user_type: str
+    user_id: int
+    last_seen: float
+
+    @property
+    def member(self) -> str:
+        return f'{self.user_type}:{self.user_id}'
+
+    @classmethod
+    def parse(cls, member: bytes, last_seen: float) -> 'PresenceMember':
+        user_type, user_id = member.decode('utf-8').split(':', 1)
+        return cls(user_type=user_type, user_id=int(user_id), last_seen=last_seen)
+
+
+class PresenceTracker:
+    """
+    Channel occupancy kept in one sorted set per channel, scored by the last heartbeat.
+
+    Heartbeats of a whole room are a single ZADD, stale members are swept with ZREMRANGEBYSCORE
+    when the channel is read, and the key expires by itself once nobody heartbeats anymore.
+    """
+    @property
+    def ttl(self) -> timedelta:
+        return timedelta(seconds=SETTINGS.presence_ttl)
+
+    @staticmethod
+    def _key(channel_id: int) -> str:
+        return f'{_Prefix.Presence.value}{channel_id}'
+
+    async def heartbeat(self, channel_id: int, members: Iterable[tuple[str, int]]) -> int:
+        """
+        Join or refresh members of a channel, returns how many of them were not present before.
+        """
+        now = time.time()
+        mapping = {f'{user_type}:{user_id}': now for user_type, user_id in members}
+        if not mapping:
+            return 0
+        async with AsyncRedisSessionLocal() as session:
+            async with session.pipeline(transaction=False) as pipe:
+                pipe.zadd(self._key(channel_id), mapping)
+                pipe.expire(self._key(channel_id), self.ttl)
+                added, _ = await pipe.execute()
+        return added
+
+    async def leave(self, channel_id: int, members: Iterable[tuple[str, int]]) -> int:
+        names = [f'{user_type}:{user_id}' for user_type, user_id in members]
+        if not names:
+            return 0
+        async with AsyncRedisSessionLocal() as session:
+            return await session.zrem(self._key(channel_id), *names)
+
+    async def occupancy(self, channel_ids: Iterable[int]) -> dict[int, list[PresenceMember]]:
+        """
+        Present members of every channel, read in one round trip.
+        """
+        channel_ids = list(channel_ids)
+        if not channel_ids:
+            return {}
+        deadline = time.time() - SETTINGS.presence_ttl
+        async with AsyncRedisSessionLocal() as session:
+            async with session.pipeline(transaction=False) as pipe:
+                for channel_id in channel_ids:
+                    pipe.zremrangebyscore(self._key(channel_id), '-inf', deadline)
+                    pipe.zrange(self._key(channel_id), 0, -1, withscores=True)
+                results = await pipe.execute()
+        return {
+            channel_id: [PresenceMember.parse(member, score) for member, score in members]
+            for channel_id, members in zip(channel_ids, results[1::2])
+        }
+
+
+PRESENCE = PresenceTracker()
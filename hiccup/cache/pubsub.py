@@ -0,0 +1,145 @@
+import asyncio
+import json
+import logging
+from contextlib import asynccontextmanager, suppress
+from typing import Any, AsyncIterator, Optional
+
+import redis.asyncio as redis
+from redis.asyncio.client import PubSub
+
+from hiccup import SETTINGS
+from hiccup.cache.redis import AsyncRedisSessionLocal
+from hiccup.metrics import METRICS
+
+
+logger = logging.getLogger(__name__)
+
+_CHANNEL_PREFIX = "EVENTS::"
+
+
+class EventSubscriber:
+    """
+    Bounded queue of one local subscriber. A slow consumer loses its oldest events instead of
+    blocking the fan-out of the whole worker.
+    """
+    def __init__(self, topic: str, maxsize: int):
+        self.topic = topic
+        self.queue: asyncio.Queue[dict[str, Any]] = asyncio.Queue(maxsize=maxsize)
+        self.dropped = 0
+
+    def put(self, event: dict[str, Any]) -> None:
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(event)
+
+    def __aiter__(self) -> 'EventSubscriber':
+        return self
+
+    async def __anext__(self) -> dict[str, Any]:
+        return await self.queue.get()
+
+
+class EventBroker:
+    """
+    Fans redis pub/sub messages out to local subscribers. Each worker holds a single pub/sub
+    connection and subscribes to a topic only while at least one local subscriber listens to it.
+    """
+    pubsub: Optional[PubSub]
+    reader_task: Optional[asyncio.Task]
+
+    def __init__(self):
+        self.pubsub = None
+        self.reader_task = None
+        self._subscribers: dict[str, set[EventSubscriber]] = {}
+        self._lock = asyncio.Lock()
+        self._has_topics = asyncio.Event()
+        self._dropped = 0
+        METRICS.register('events', self.stats)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            'topics': len(self._subscribers),
+            'subscribers': sum(len(s) for s in self._subscribers.values()),
+            'dropped': self._dropped + sum(sub.dropped for s in self._subscribers.values() for sub in s),
+        }
+
+    async def setup(self):
+        client = redis.Redis(connection_pool=AsyncRedisSessionLocal.cache.pool)
+        self.pubsub = client.pubsub(ignore_subscribe_messages=True)
+        self.reader_task = asyncio.create_task(self._read())
+
+    async def dispose(self):
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self.reader_task
+        if self.pubsub is not None:
+            await self.pubsub.aclose()
+        self.pubsub = None
+        self.reader_task = None
+
+    async def _read(self):
+        while True:
+            await self._has_topics.wait()
+            try:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except (redis.ConnectionError, redis.TimeoutError, OSError) as e:
+                # redis-py resubscribes every channel once the connection is back
+                logger.warning(f"Event broker lost redis connection: {e}")
+                await asyncio.sleep(1.0)
+                continue
+            except Exception as e:
+                # The reader serves every subscription of the worker, it must not end
+                logger.warning(f"Event broker failed to read: {e!r}")
+                await asyncio.sleep(1.0)
+                continue
+            if message is None or message['type'] != 'message':
+                continue
+
+            try:
+                topic = message['channel'].decode('utf-8').removeprefix(_CHANNEL_PREFIX)
+                event = json.loads(message['data'])
+                for subscriber in tuple(self._subscribers.get(topic, ())):
+                    subscriber.put(event)
+            except Exception as e:
+                logger.warning(f"Event broker dropped a malformed event on {message['channel']!r}: {e!r}")
+
+    @asynccontextmanager
+    async def subscribe(self, topic: str) -> AsyncIterator[EventSubscriber]:
+        if self.pubsub is None:
+            raise RuntimeError("Event broker is not set up")
+
+        subscriber = EventSubscriber(topic, SETTINGS.event_subscriber_queue_size)
+        async with self._lock:
+            if topic not in self._subscribers:
+                await self.pubsub.subscribe(f'{_CHANNEL_PREFIX}{topic}')
+                self._subscribers[topic] = set()
+            self._subscribers[topic].add(subscriber)
+            self._has_topics.set()
+
+        try:
+            yield subscriber
+        finally:
+            async with self._lock:
+                self._dropped += subscriber.dropped
+                self._subscribers[topic].discard(subscriber)
+                if not self._subscribers[topic]:
+                    del self._subscribers[topic]
+                    if not self._subscribers:
+                        # Nothing to read, the reader waits for the next subscription
+                        self._has_topics.clear()
+                    await self.pubsub.unsubscribe(f'{_CHANNEL_PREFIX}{topic}')
+
+    async def publish(self, topics: list[str], event: dict[str, Any]) -> None:
+        if not topics:
+            return
+        payload = json.dumps(event)
+        async with AsyncRedisSessionLocal() as session:
+            async with session.pipeline(transaction=False) as pipe:
+                for topic in dict.fromkeys(topics):
+                    pipe.publish(f'{_CHANNEL_PREFIX}{topic}', payload)
+                await pipe.execute()
+
+
+EVENT_BROKER = EventBroker()
@@ -0,0 +1,158 @@
+import enum
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, NamedTuple, Sequence
+
+from hiccup import SETTINGS
+from hiccup.cache.redis import AsyncRedisSessionLocal, REDIS_FAILURES
+from hiccup.metrics import METRICS
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Prefix(str, enum.Enum):
+    RateLimit = "RATE-LIMIT::"
+
+
+# Token buckets of one request, taken all or nothing. KEYS are the buckets, ARGV holds the cost followed by
+# capacity and refill per second of every bucket. Returns allowed, the lowest remaining tokens and the seconds
+# every bucket needs to refill enough.
+_TOKEN_BUCKET_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local cost = tonumber(ARGV[1])
+local allowed = 1
+local waits = {}
+local levels = {}
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 2])
+    local rate = tonumber(ARGV[i * 2 + 1])
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    waits[i] = '0'
+    if tokens < cost then
+        allowed = 0
+        waits[i] = tostring((cost - tokens) / rate)
+    end
+    levels[i] = tokens
+end
+local remaining = -1
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 2])
+    local rate = tonumber(ARGV[i * 2 + 1])
+    local tokens = levels[i]
+    if allowed == 1 then
+        tokens = tokens - cost
+    end
+    redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', tostring(now))
+    redis.call('PEXPIRE', key, math.ceil(capacity / rate * 1000))
+    if remaining < 0 or tokens < remaining then
+        remaining = tokens
+    end
+end
+return {allowed, math.floor(remaining), waits}
+"""
+
+
+class Bucket(NamedTuple):
+    key: str
+    capacity: int
+    period: float
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / self.period
+
+
+class RateLimitResult(NamedTuple):
+    allowed: bool
+    limit: int
+    remaining: int
+    retry_after: float
+
+
+class RateLimiter:
+    """
+    Token buckets kept in redis and updated atomically by a script. Buckets that redis turned away are
+    remembered in process until they refill, so a client hammering past its limit costs no round trip.
+    """
+    def __init__(self):
+        self._script = None
+        self._blocked: OrderedDict[str, float] = OrderedDict()
+        self.allowed = 0
+        self.denied = 0
+        self.denied_locally = 0
+        self.errors = 0
+        METRICS.register('rate_limit', self.stats)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            'allowed': self.allowed,
+            'denied': self.denied,
+            'denied_locally': self.denied_locally,
+            'errors': self.errors,
+            'blocked_buckets': len(self._blocked),
+        }
+
+    @staticmethod
+    def key(scope: str, dimension: str, value: str) -> str:
+        return f'{_Prefix.RateLimit.value}{scope}:{dimension}:{value}'
+
+    def _blocked_for(self, buckets: Sequence[Bucket]) -> float:
+        now = time.monotonic()
+        wait = 0.0
+        for bucket in buckets:
+            until = self._blocked.get(bucket.key)
+            if until is None:
+                continue
+            if until <= now:
+                del self._blocked[bucket.key]
+                continue
+            wait = max(wait, until - now)
+        return wait
+
+    def _block(self, bucket: Bucket, retry_after: float) -> None:
+        self._blocked[bucket.key] = time.monotonic() + retry_after
+        self._blocked.move_to_end(bucket.key)
+        while len(self._blocked) > SETTINGS.rate_limit_local_entries:
+            self._blocked.popitem(last=False)
+
+    async def hit(self, buckets: Sequence[Bucket], cost: int = 1) -> RateLimitResult:
+        limit = min(bucket.capacity for bucket in buckets)
+        wait = self._blocked_for(buckets)
+        if wait > 0:
+            self.denied_locally += 1
+            return RateLimitResult(allowed=False, limit=limit, remaining=0, retry_after=wait)
+
+        try:
+            async with AsyncRedisSessionLocal() as session:
+                if self._script is None:
+                    self._script = session.register_script(_TOKEN_BUCKET_SCRIPT)
+                args = [cost]
+                for bucket in buckets:
+                    args.extend((bucket.capacity, bucket.rate))
+                allowed, remaining, waits = await self._script(keys=[b.key for b in buckets], args=args, client=session)
+        except REDIS_FAILURES as e:
+            # Rather let requests through than lock everybody out while redis is away
+            self.errors += 1
+            logger.warning(f"Rate limiter unavailable: {e}")
+            return RateLimitResult(allowed=True, limit=limit, remaining=limit, retry_after=0.0)
+
+        if not allowed:
+            self.denied += 1
+            waits = [float(wait) for wait in waits]
+            for bucket, wait in zip(buckets, waits):
+                # Only exhausted buckets, the others may still serve other requests
+                if wait > 0:
+                    self._block(bucket, wait)
+            return RateLimitResult(allowed=False, limit=limit, remaining=max(int(remaining), 0), retry_after=max(waits))
+
+        self.allowed += 1
+        return RateLimitResult(allowed=True, limit=limit, remaining=max(int(remaining), 0), retry_after=0.0)
+
+
+RATE_LIMITER = RateLimiter()
@@ -1,13 +1,69 @@
+import time
+from typing import Optional
+
 import redis.asyncio as redis
 
 from hiccup import SETTINGS
+from hiccup.resilience import CircuitBreaker, CircuitOpenError, REDIS_BREAKER
+
+
+# Errors of redis being unreachable or slow, as opposed to errors of a command
+REDIS_FAILURES = (redis.ConnectionError, redis.TimeoutError, OSError)
+
+
+class MeasuredConnection(redis.Connection):
+    """
+    Reports the round trip of commands, and failures to reach redis, to the circuit breaker of the pool.
+    """
+    breaker: CircuitBreaker = REDIS_BREAKER
+    _sent_at: Optional[float] = None
+
+    async def connect(self) -> None:
+        try:
+            await super().connect()
+        except REDIS_FAILURES:
+            self.breaker.record_failure()
+            raise
+
+    async def send_packed_command(self, command, check_health: bool = True) -> None:
+        if not self.is_connected:
+            # Connect failures are recorded by connect()
+            await self.connect()
+        self._sent_at = time.perf_counter()
+        try:
+            await super().send_packed_command(command, check_health)
+        except REDIS_FAILURES:
+            self.breaker.record_failure()
+            raise
+
+    async def read_response(self, *args, **kwargs):
+        try:
+            response = await super().read_response(*args, **kwargs)
+        except REDIS_FAILURES:
+            self.breaker.record_failure()
+            raise
+        # Pipelines read several replies per send, the first one carries the round trip
+        if self._sent_at is not None:
+            self.breaker.record_success(time.perf_counter() - self._sent_at)
+            self._sent_at = None
+        return response
+
+
+def measured_connection_pool(url: str, breaker: CircuitBreaker) -> redis.ConnectionPool:
+    connection_class = type(f'{breaker.name.title()}Connection', (MeasuredConnection, ), {'breaker': breaker})
+    return redis.ConnectionPool.from_url(
+        url,
+        connection_class=connection_class,
+        socket_timeout=SETTINGS.redis_socket_timeout,
+        socket_connect_timeout=SETTINGS.redis_connect_timeout,
+    )
 
 
 class RedisCache:
     pool: redis.ConnectionPool
 
     def __init__(self):
-        self.pool = redis.ConnectionPool().from_url(SETTINGS.redis_url)
+        self.pool = measured_connection_pool(SETTINGS.redis_url, REDIS_BREAKER)
 
 
 class AsyncRedisSessionMaker:
@@ -24,6 +80,11 @@ class AsyncRedisSession:
         self.client = None
 
     async def __aenter__(self):
+        try:
+            REDIS_BREAKER.allow()
+        except CircuitOpenError as e:
+            # A redis error, so that callers falling back on redis failures fall back here too
+            raise redis.ConnectionError(str(e)) from e
         self.client = redis.Redis(connection_pool=self.cache.pool)
         return self.client
 
@@ -0,0 +1,104 @@
+import enum
+import json
+from datetime import timedelta
+from typing import Any, Iterable, Optional
+
+from hiccup import SETTINGS
+from hiccup.cache.redis import AsyncRedisSessionLocal
+
+
+class _Prefix(str, enum.Enum):
+    Entry = "RESPONSE::"
+    Tag = "RESPONSE-TAG::"
+    Tombstone = "RESPONSE-TOMBSTONE::"
+
+
+# Tombstones must outlive the slowest resolver, otherwise a result computed before
+# an invalidation could still be stored after it.
+_TOMBSTONE_TTL = timedelta(seconds=60)
+
+# KEYS: entry key, tag sets..., tombstones...  ARGV: payload, ttl, started_at, tag count
+_STORE_SCRIPT = """
+local tag_count = tonumber(ARGV[4])
+for i = 2 + tag_count, 1 + 2 * tag_count do
+    local invalidated_at = redis.call('GET', KEYS[i])
+    if invalidated_at and tonumber(invalidated_at) >= tonumber(ARGV[3]) then
+        return 0
+    end
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+for i = 2, 1 + tag_count do
+    redis.call('SADD', KEYS[i], KEYS[1])
+    if redis.call('TTL', KEYS[i]) < tonumber(ARGV[2]) then
+        redis.call('EXPIRE', KEYS[i], ARGV[2])
+    end
+end
+return 1
+"""
+
+# KEYS: tag sets..., tombstones...  ARGV: tombstone ttl
+_INVALIDATE_SCRIPT = """
+local now = redis.call('TIME')
+local stamp = now[1] .. string.format('%06d', now[2])
+local tag_count = #KEYS / 2
+for i = 1, tag_count do
+    local members = redis.call('SMEMBERS', KEYS[i])
+    for j = 1, #members, 1000 do
+        redis.call('DEL', unpack(members, j, math.min(j + 999, #members)))
+    end
+    redis.call('DEL', KEYS[i])
+    redis.call('SET', KEYS[tag_count + i], stamp, 'EX', ARGV[1])
+end
+return tag_count
+"""
+
+
+def _redis_timestamp(value: tuple[int, int]) -> int:
+    seconds, microseconds = value
+    return int(seconds) * 1_000_000 + int(microseconds)
+
+
+async def get_cached_response(key: str) -> (bool, Any, int):
+    """
+    Lookup a cached response, stored as JSON. Returns (hit, value, started_at), where started_at is the redis
+    clock reading that must be handed back to store_cached_response on a miss.
+    """
+    async with AsyncRedisSessionLocal() as session:
+        async with session.pipeline(transaction=False) as pipe:
+            pipe.time()
+            pipe.get(f'{_Prefix.Entry.value}{key}')
+            now, payload = await pipe.execute()
+
+    if payload is not None:
+        try:
+            return True, json.loads(payload), _redis_timestamp(now)
+        except ValueError:
+            # Written in another format by an earlier release, recompute
+            pass
+    return False, None, _redis_timestamp(now)
+
+
+async def store_cached_response(key: str, value: Any, tags: Iterable[str], started_at: int, ttl: Optional[int] = None) -> bool:
+    """
+    Store a JSON serializable response unless one of its tags was invalidated after started_at.
+    """
+    tags = list(dict.fromkeys(tags))
+    keys = [f'{_Prefix.Entry.value}{key}']
+    keys += [f'{_Prefix.Tag.value}{tag}' for tag in tags]
+    keys += [f'{_Prefix.Tombstone.value}{tag}' for tag in tags]
+    async with AsyncRedisSessionLocal() as session:
+        stored = await session.register_script(_STORE_SCRIPT)(
+            keys=keys,
+            args=[json.dumps(value), ttl or SETTINGS.response_cache_ttl, started_at, len(tags)],
+        )
+    return bool(stored)
+
+
+async def invalidate_response_tags(*tags: str) -> None:
+    tags = list(dict.fromkeys(tags))
+    if not tags:
+        return
+    keys = [f'{_Prefix.Tag.value}{tag}' for tag in tags]
+    keys += [f'{_Prefix.Tombstone.value}{tag}' for tag in tags]
+    async with AsyncRedisSessionLocal() as session:
+        await session.register_script(_INVALIDATE_SCRIPT)(keys=keys, args=[int(_TOMBSTONE_TTL.total_seconds())])
@@ -0,0 +1,163 @@
+import asyncio
+import enum
+import hashlib
+import logging
+import time
+from contextlib import suppress
+from typing import Any, Optional
+
+from hiccup import SETTINGS
+from hiccup.cache.pubsub import EVENT_BROKER
+from hiccup.cache.redis import AsyncRedisSessionLocal, REDIS_FAILURES
+from hiccup.metrics import METRICS
+
+
+logger = logging.getLogger(__name__)
+
+_TOPIC = "auth_token_revocations"
+
+
+class _Prefix(str, enum.Enum):
+    RevokedTokens = "REVOKED-TOKENS::"
+
+
+class RevocationFilter:
+    """
+    Bloom filter over revoked auth token ids, consulted before trusting a signed session token.
+
+    A signed token lives at most signed_session_token_ttl seconds, so a revocation only has to be
+    remembered that long. Revocations go to the filter of the current ttl sized generation, and the
+    current and previous generations are checked. Each generation is a redis bitmap, every worker holds
+    a copy of the bits, loads it at startup and then follows additions through the event broker. Until
+    the bits are loaded, and whenever following them broke off, every token has to be checked.
+    """
+    task: Optional[asyncio.Task]
+
+    def __init__(self):
+        self.task = None
+        self._generations: dict[int, bytearray] = {}
+        # Loaded and followed since without a gap
+        self.loaded = False
+        self.checks = 0
+        self.positives = 0
+        METRICS.register('revocation_filter', self.stats)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            'loaded': self.loaded,
+            'generations': len(self._generations),
+            'bytes': sum(len(bits) for bits in self._generations.values()),
+            'checks': self.checks,
+            'positives': self.positives,
+        }
+
+    @property
+    def _size(self) -> int:
+        return SETTINGS.token_revocation_filter_bits
+
+    @staticmethod
+    def _generation(now: Optional[float] = None) -> int:
+        return int((now or time.time()) // SETTINGS.signed_session_token_ttl)
+
+    @staticmethod
+    def _key(generation: int) -> str:
+        return f'{_Prefix.RevokedTokens.value}{generation}'
+
+    def _offsets(self, token_id: int) -> list[int]:
+        digest = hashlib.blake2b(token_id.to_bytes(8, 'big'), digest_size=4 * SETTINGS.token_revocation_filter_hashes).digest()
+        return [int.from_bytes(digest[i:i + 4], 'big') % self._size for i in range(0, len(digest), 4)]
+
+    def _bits(self, generation: int) -> bytearray:
+        if generation not in self._generations:
+            self._generations[generation] = bytearray(self._size // 8 + 1)
+            for stale in [g for g in self._generations if g < generation - 1]:
+                del self._generations[stale]
+        return self._generations[generation]
+
+    def _set(self, generation: int, token_id: int) -> None:
+        bits = self._bits(generation)
+        for offset in self._offsets(token_id):
+            # Same bit order as redis SETBIT, so that bitmaps loaded from redis can be used as is
+            bits[offset >> 3] |= 0x80 >> (offset & 7)
+
+    def might_be_revoked(self, token_id: int) -> bool:
+        """
+        False means the token is certainly not revoked, True has to be confirmed against the database.
+        """
+        self.checks += 1
+        if not self.loaded:
+            return True
+        current = self._generation()
+        offsets = self._offsets(token_id)
+        for generation in (current, current - 1):
+            bits = self._generations.get(generation)
+            if bits is not None and all(bits[offset >> 3] & (0x80 >> (offset & 7)) for offset in offsets):
+                self.positives += 1
+                return True
+        return False
+
+    async def revoke(self, token_id: int) -> None:
+        generation = self._generation()
+        self._set(generation, token_id)
+        try:
+            async with AsyncRedisSessionLocal() as session:
+                async with session.pipeline(transaction=False) as pipe:
+                    for offset in self._offsets(token_id):
+                        pipe.setbit(self._key(generation), offset, 1)
+                    pipe.expire(self._key(generation), 2 * SETTINGS.signed_session_token_ttl)
+                    await pipe.execute()
+        except REDIS_FAILURES as e:
+            # Workers following the broker still learn about it, a worker loading later does not
+            logger.warning(f"Could not store revocation of auth token {token_id}: {e}")
+        await EVENT_BROKER.publish([_TOPIC], {'token_id': token_id, 'generation': generation})
+
+    async def load(self) -> None:
+        current = self._generation()
+        async with AsyncRedisSessionLocal() as session:
+            stored = await session.mget([self._key(current - 1), self._key(current)])
+        for generation, value in zip((current - 1, current), stored):
+            bits = self._bits(generation)
+            if value:
+                # Merge, so that bits received while loading are kept
+                for i, byte in enumerate(value[:len(bits)]):
+                    bits[i] |= byte
+
+    async def setup(self):
+        if SETTINGS.signed_session_tokens_enabled:
+            self.task = asyncio.create_task(self._sync())
+
+    async def dispose(self):
+        if self.task is not None:
+            self.task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self.task
+        self.task = None
+
+    async def _sync(self):
+        while True:
+            try:
+                # Subscribe before loading, no revocation falls between the two
+                async with EVENT_BROKER.subscribe(_TOPIC) as subscriber:
+                    await self.load()
+                    self.loaded = True
+                    while True:
+                        try:
+                            event = await asyncio.wait_for(subscriber.__anext__(), timeout=SETTINGS.signed_session_token_ttl / 4)
+                        except asyncio.TimeoutError:
+                            # Catch up on anything missed while the broker was reconnecting
+                            await self.load()
+                            continue
+                        self._set(event['generation'], event['token_id'])
+                        if subscriber.dropped:
+                            # Revocations were lost, load them again
+                            subscriber.dropped = 0
+                            await self.load()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Revocation filter sync failed: {e}")
+                self.loaded = False
+                await asyncio.sleep(1.0)
+
+
+REVOCATION_FILTER = RevocationFilter()
@@ -0,0 +1,308 @@
+import asyncio
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import time
+from contextlib import contextmanager, suppress
+from typing import Any, Iterator, Optional
+
+from hiccup import SETTINGS
+from hiccup.cache.pubsub import EVENT_BROKER
+from hiccup.metrics import METRICS
+
+
+logger = logging.getLogger(__name__)
+
+_TOPIC = "shared_cache_invalidations"
+
+_MAGIC = b'HICCUPC2'
+# magic, buckets, ways, slot size, generation, epoch
+_HEADER = struct.Struct('<8sIII4xQQ')
+_HEADER_SIZE = 64
+_COUNTER = struct.Struct('<Q')
+_GENERATION_OFFSET = 24
+_EPOCH_OFFSET = 32
+# seq, key hash, expires at, length, epoch
+_ENTRY = struct.Struct('<IQdIQ')
+_ENTRY_FIELDS = 5
+_SEQ = struct.Struct('<I')
+
+
+def _hash(key: str) -> int:
+    # 0 marks an empty slot
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little') or 1
+
+
+class SharedMemoryCache:
+    """
+    Read-mostly cache in a memory mapped file, one copy per host shared by every worker.
+
+    The file holds a set associative table, a key hashes to a bucket of `ways` fixed size slots. Readers
+    take no lock: every slot carries a sequence number that writers make odd while they change the slot,
+    a read that saw it odd or changed is a miss. Writers serialize on a lock of the file. Entries are
+    stamped with the epoch of the file, clearing the cache moves the epoch on instead of writing every slot.
+
+    The file name carries the layout, so that workers started with other settings, as during a deploy,
+    map a file of their own instead of resizing one mapped by others.
+
+    Invalidations are published on the event broker. The worker holding the updater lock of the file
+    applies those of other workers, the invalidating worker applies its own right away. Entries expire
+    after shared_cache_ttl, which bounds staleness should an invalidation be lost.
+    """
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self._path: Optional[str] = None
+        self._origin = os.urandom(8).hex()
+        self._fd: Optional[int] = None
+        self._updater_fd: Optional[int] = None
+        self._mm: Optional[mmap.mmap] = None
+        self._buckets = 0
+        self._ways = 0
+        self._slot_size = 0
+        self._bucket: Optional[struct.Struct] = None
+        self._data_offset = 0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.invalidations = 0
+        METRICS.register('shared_cache', self.stats)
+
+    def stats(self) -> dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            'enabled': self._mm is not None,
+            'updater': self._updater_fd is not None,
+            'bytes': len(self._mm) if self._mm is not None else 0,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'stores': self.stores,
+            'invalidations': self.invalidations,
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return self._mm is not None
+
+    @staticmethod
+    def layout_path(path: str, buckets: int, ways: int, slot_size: int) -> str:
+        return f'{path}.{_MAGIC.decode("ascii").lower()}-{buckets}x{ways}x{slot_size}.cache'
+
+    def open(self, path: str, buckets: int, ways: int, slot_size: int) -> None:
+        index_size = buckets * ways * _ENTRY.size
+        size = _HEADER_SIZE + index_size + buckets * ways * slot_size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size == 0:
+                    # Created just now, nobody maps it yet
+                    os.ftruncate(fd, size)
+                    os.pwrite(fd, _HEADER.pack(_MAGIC, buckets, ways, slot_size, 0, 0), 0)
+                header = os.pread(fd, _HEADER.size, 0)
+                if len(header) < _HEADER.size or _HEADER.unpack(header)[:4] != (_MAGIC, buckets, ways, slot_size) \
+                        or os.fstat(fd).st_size != size:
+                    # Other workers may have it mapped, resizing it under them would fault their reads
+                    raise ValueError(f"Shared cache file {path} does not match its layout")
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        except BaseException:
+            os.close(fd)
+            raise
+
+        self._fd = fd
+        self._mm = mmap.mmap(fd, size)
+        self._buckets, self._ways, self._slot_size = buckets, ways, slot_size
+        self._bucket = struct.Struct('<' + 'IQdIQ' * ways)
+        self._data_offset = _HEADER_SIZE + index_size
+
+    def close(self) -> None:
+        if self._mm is not None:
+            self._mm.close()
+        for fd in (self._fd, self._updater_fd):
+            if fd is not None:
+                os.close(fd)
+        self._mm = self._fd = self._updater_fd = None
+
+    @contextmanager
+    def _write_lock(self) -> Iterator[None]:
+        # Held for a few slot writes only, not worth leaving the event loop for
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _entry_offset(self, bucket: int, way: int) -> int:
+        return _HEADER_SIZE + (bucket * self._ways + way) * _ENTRY.size
+
+    def _slot_offset(self, bucket: int, way: int) -> int:
+        return self._data_offset + (bucket * self._ways + way) * self._slot_size
+
+    @property
+    def generation(self) -> int:
+        """
+        Bumped by every invalidation. Taken before loading a value and handed to put(), so that a value
+        loaded before an invalidation is not stored after it.
+        """
+        if self._mm is None:
+            return 0
+        return _COUNTER.unpack_from(self._mm, _GENERATION_OFFSET)[0]
+
+    @property
+    def _epoch(self) -> int:
+        return _COUNTER.unpack_from(self._mm, _EPOCH_OFFSET)[0]
+
+    def get(self, key: str) -> Optional[bytes]:
+        if self._mm is None:
+            return None
+        key_hash = _hash(key)
+        bucket = key_hash % self._buckets
+        entries = self._bucket.unpack_from(self._mm, self._entry_offset(bucket, 0))
+        now = time.time()
+        epoch = self._epoch
+        for way in range(self._ways):
+            seq, entry_hash, expires_at, length, entry_epoch = entries[way * _ENTRY_FIELDS:(way + 1) * _ENTRY_FIELDS]
+            if entry_hash != key_hash or seq & 1 or expires_at <= now or entry_epoch != epoch:
+                continue
+            offset = self._slot_offset(bucket, way)
+            value = self._mm[offset:offset + length]
+            # Seqlock, the slot must not have changed while it was copied
+            if _SEQ.unpack_from(self._mm, self._entry_offset(bucket, way))[0] == seq:
+                self.hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def _write_entry(self, bucket: int, way: int, key_hash: int, expires_at: float, value: bytes, epoch: int) -> None:
+        offset = self._entry_offset(bucket, way)
+        seq = _SEQ.unpack_from(self._mm, offset)[0]
+        _SEQ.pack_into(self._mm, offset, (seq + 1) & 0xFFFFFFFF)
+        if value:
+            self._mm[self._slot_offset(bucket, way):self._slot_offset(bucket, way) + len(value)] = value
+        _ENTRY.pack_into(self._mm, offset, (seq + 1) & 0xFFFFFFFF, key_hash, expires_at, len(value), epoch)
+        # Even again only once the whole slot is written
+        _SEQ.pack_into(self._mm, offset, (seq + 2) & 0xFFFFFFFF)
+
+    def put(self, key: str, value: bytes, generation: int) -> bool:
+        """
+        Store unless an invalidation happened since `generation` was read or the value does not fit a slot.
+        """
+        if self._mm is None or len(value) > self._slot_size:
+            return False
+        key_hash = _hash(key)
+        bucket = key_hash % self._buckets
+        now = time.time()
+        with self._write_lock():
+            if self.generation != generation:
+                return False
+            entries = self._bucket.unpack_from(self._mm, self._entry_offset(bucket, 0))
+            epoch = self._epoch
+
+            def live(way: int) -> bool:
+                return entries[way * _ENTRY_FIELDS + 1] != 0 and entries[way * _ENTRY_FIELDS + 2] > now \
+                    and entries[way * _ENTRY_FIELDS + 4] == epoch
+
+            # Same key, else a free, expired or cleared slot, else the slot expiring first
+            victim = min(range(self._ways), key=lambda way: (
+                entries[way * _ENTRY_FIELDS + 1] != key_hash,
+                live(way),
+                entries[way * _ENTRY_FIELDS + 2],
+            ))
+            self._write_entry(bucket, victim, key_hash, now + SETTINGS.shared_cache_ttl, value, epoch)
+        self.stores += 1
+        return True
+
+    def _delete(self, keys: list[str]) -> None:
+        with self._write_lock():
+            for key in keys:
+                key_hash = _hash(key)
+                bucket = key_hash % self._buckets
+                entries = self._bucket.unpack_from(self._mm, self._entry_offset(bucket, 0))
+                for way in range(self._ways):
+                    if entries[way * _ENTRY_FIELDS + 1] == key_hash:
+                        self._write_entry(bucket, way, 0, 0.0, b'', 0)
+            _COUNTER.pack_into(self._mm, _GENERATION_OFFSET, self.generation + 1)
+        self.invalidations += len(keys)
+
+    def _clear(self) -> None:
+        with self._write_lock():
+            # Entries of earlier epochs read as misses and are reused as free slots
+            _COUNTER.pack_into(self._mm, _EPOCH_OFFSET, self._epoch + 1)
+            _COUNTER.pack_into(self._mm, _GENERATION_OFFSET, self.generation + 1)
+
+    async def invalidate(self, *keys: str) -> None:
+        if self._mm is None or not keys:
+            return
+        self._delete(list(keys))
+        await EVENT_BROKER.publish([_TOPIC], {'keys': list(keys), 'origin': self._origin})
+
+    async def flush(self) -> None:
+        if self._mm is None:
+            return
+        self._clear()
+        await EVENT_BROKER.publish([_TOPIC], {'keys': [], 'flush': True, 'origin': self._origin})
+
+    async def setup(self):
+        if not SETTINGS.shared_cache_enabled:
+            return
+        self._path = self.layout_path(SETTINGS.shared_cache_path, SETTINGS.shared_cache_buckets,
+                                      SETTINGS.shared_cache_ways, SETTINGS.shared_cache_slot_size)
+        try:
+            self.open(self._path, SETTINGS.shared_cache_buckets, SETTINGS.shared_cache_ways, SETTINGS.shared_cache_slot_size)
+        except ValueError as e:
+            logger.warning(f"Shared cache disabled: {e}")
+            return
+        self.task = asyncio.create_task(self._update())
+
+    async def dispose(self):
+        if self.task is not None:
+            self.task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self.task
+        self.task = None
+        self.close()
+
+    def _try_become_updater(self) -> bool:
+        # One updater per file, workers of another layout have their own
+        fd = os.open(f'{self._path}.updater', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        # Released by the kernel if this worker dies, another one takes over
+        self._updater_fd = fd
+        return True
+
+    async def _update(self):
+        while not self._try_become_updater():
+            await asyncio.sleep(SETTINGS.shared_cache_updater_poll)
+        logger.info(f"Worker {os.getpid()} applies shared cache invalidations")
+
+        while True:
+            try:
+                async with EVENT_BROKER.subscribe(_TOPIC) as subscriber:
+                    # Whatever was invalidated while nobody listened is unknown, start over
+                    self._clear()
+                    async for event in subscriber:
+                        if subscriber.dropped:
+                            subscriber.dropped = 0
+                            self._clear()
+                        if event['origin'] == self._origin:
+                            continue
+                        if event.get('flush'):
+                            self._clear()
+                        else:
+                            self._delete(event['keys'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Shared cache updater failed: {e}")
+                await asyncio.sleep(1.0)
+
+
+SHARED_CACHE = SharedMemoryCache()
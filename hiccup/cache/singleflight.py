@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import math
+import random
+import time
+from typing import Any, Awaitable, Callable, Hashable, TypeVar
+
+from hiccup import SETTINGS
+from hiccup.metrics import METRICS
+
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent loads of the same key within a worker. The first caller runs the load, callers
+    arriving while it is in flight await the same result. Coalescing across workers is left to the cache
+    the load fills, or to its lock.
+
+    The average load duration is kept for probabilistic early refresh (XFetch): a hit close to expiry
+    refreshes in the background with a probability rising as the entry gets older, so a hot key is
+    renewed by one request before everybody misses it at once.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self._flights: dict[Hashable, asyncio.Task] = {}
+        self._refreshes: set[asyncio.Task] = set()
+        self.load_seconds = 0.0
+        self.loads = 0
+        self.shared = 0
+        self.early_refreshes = 0
+        METRICS.register(f'single_flight.{name}', self.stats)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            'loads': self.loads,
+            'shared': self.shared,
+            'in_flight': len(self._flights),
+            'early_refreshes': self.early_refreshes,
+            'load_ms': round(self.load_seconds * 1000, 3),
+        }
+
+    async def do(self, key: Hashable, load: Callable[[], Awaitable[T]]) -> T:
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = asyncio.create_task(self._load(key, load))
+            # Retrieved here, no warning if every waiter is gone by the time the load fails
+            flight.add_done_callback(lambda task: task.cancelled() or task.exception())
+            self._flights[key] = flight
+        else:
+            self.shared += 1
+        # Shielded, a cancelled waiter must not cancel the load for the others
+        return await asyncio.shield(flight)
+
+    async def _load(self, key: Hashable, load: Callable[[], Awaitable[T]]) -> T:
+        started = time.perf_counter()
+        try:
+            return await load()
+        finally:
+            del self._flights[key]
+            self._record(time.perf_counter() - started)
+
+    def _record(self, seconds: float) -> None:
+        self.loads += 1
+        self.load_seconds = seconds if self.loads == 1 else self.load_seconds * 0.9 + seconds * 0.1
+
+    def should_refresh(self, ttl: float) -> bool:
+        """
+        XFetch: true with a probability growing as the remaining ttl (seconds) nears the load duration.
+        """
+        if ttl < 0:
+            # No expiry
+            return False
+        return -self.load_seconds * SETTINGS.cache_early_refresh_beta * math.log(1.0 - random.random()) >= ttl
+
+    def refresh(self, key: Hashable, load: Callable[[], Awaitable[Any]]) -> None:
+        """
+        Reload in the background, unless a load of the key is in flight already.
+        """
+        if key in self._flights:
+            return
+        self.early_refreshes += 1
+        task = asyncio.create_task(self._refresh(key, load))
+        self._refreshes.add(task)
+        task.add_done_callback(self._refreshes.discard)
+
+    async def _refresh(self, key: Hashable, load: Callable[[], Awaitable[Any]]) -> None:
+        try:
+            await self.do(key, load)
+        except Exception as e:
+            logger.warning(f"Early refresh of {self.name} {key} failed: {e}")
@@ -1,35 +1,90 @@
 import enum
+import hashlib
 from datetime import timedelta
 from typing import Optional
 
-from sqlalchemy import select
-from sqlalchemy.orm import joinedload
-
 from hiccup import SETTINGS
 from hiccup.cache import AsyncRedisSessionLocal
+from hiccup.cache.redis import REDIS_FAILURES
+from hiccup.cache.shared import SHARED_CACHE
+from hiccup.cache.singleflight import SingleFlight
 from hiccup.db import AsyncSessionLocal
 from hiccup.db.permission import PermissionGroup
+from hiccup.db.statements import USER_PERMISSION_GROUPS
 from hiccup.db.user import ClassicIdentify
 
 
 class _Prefix(str, enum.Enum):
     Nonce = "NONCE::"
     UserPermission = "USER-PERMISSION::"
+    RecentWrite = "RECENT-WRITE::"
+
+
+async def cache_nonce(nonce: str, timestamp: int, scope: str = '') -> bool:
+    """
+    Remember the nonce of a signed action, false if it was used already. A signed action is only accepted within
+    SIGNED_ACTION_MAX_SKEW seconds of its timestamp and a replay carries the same timestamp, so nonces are kept in
+    one set per window of timestamps that expires as a whole once no timestamp of the window is accepted anymore.
+    """
+    width = 2 * SETTINGS.signed_action_max_skew
+    bucket = timestamp // width
+    key = f'{_Prefix.Nonce.value}{bucket}'
+    member = hashlib.blake2b(f'{scope}:{nonce}'.encode('utf-8'), digest_size=16).digest()
+    async with AsyncRedisSessionLocal() as session:
+        async with session.pipeline(transaction=False) as pipe:
+            pipe.sadd(key, member)
+            pipe.expireat(key, (bucket + 1) * width + SETTINGS.signed_action_max_skew + 1)
+            added, _ = await pipe.execute()
+    return added == 1
 
 
-async def cache_nonce(nonce: str, expire_in: timedelta = timedelta(minutes=5)) -> bool:
+async def mark_recent_write(writer: str) -> None:
+    """
+    Route the writer's reads to the primary for DB_READ_YOUR_WRITES_WINDOW seconds.
+    """
     async with AsyncRedisSessionLocal() as session:
-        return await session.set(f'{_Prefix.Nonce.value}{nonce}', 1, ex=expire_in, nx=True)
+        await session.set(f'{_Prefix.RecentWrite.value}{writer}', 1, ex=timedelta(seconds=SETTINGS.db_read_your_writes_window))
 
 
-async def invalidate_permission_cache(uid: int) -> None:
+async def has_recent_write(writer: str) -> bool:
     async with AsyncRedisSessionLocal() as session:
-        await session.delete(f'{_Prefix.UserPermission.value}{uid}')
+        return bool(await session.exists(f'{_Prefix.RecentWrite.value}{writer}'))
+
+
+async def delete_keys_matching(pattern: str, batch_size: int = 1000) -> int:
+    """
+    Unlink every key matching a glob pattern, in batches so that redis is never blocked for long.
+    """
+    deleted = 0
+    async with AsyncRedisSessionLocal() as session:
+        batch = []
+        async for key in session.scan_iter(match=pattern, count=batch_size):
+            batch.append(key)
+            if len(batch) >= batch_size:
+                deleted += await session.unlink(*batch)
+                batch = []
+        if batch:
+            deleted += await session.unlink(*batch)
+    return deleted
+
+
+async def invalidate_permission_cache(*uids: int) -> None:
+    if not uids:
+        return
+    keys = [f'{_Prefix.UserPermission.value}{uid}' for uid in uids]
+    async with AsyncRedisSessionLocal() as session:
+        await session.delete(*keys)
+    await SHARED_CACHE.invalidate(*keys)
+
+
+async def flush_permission_cache() -> None:
+    await delete_keys_matching(f'{_Prefix.UserPermission.value}*')
+    await SHARED_CACHE.flush()
 
 
 async def get_user_permission_no_cache(uid: int) -> Optional[set[str]]:
     async with AsyncSessionLocal() as session:
-        db_user: Optional[ClassicIdentify] = await session.scalar(select(ClassicIdentify).options(joinedload(ClassicIdentify.permission_groups)).where(ClassicIdentify.id == uid).limit(1))
+        db_user: Optional[ClassicIdentify] = await session.scalar(USER_PERMISSION_GROUPS, {'uid': uid})
         if db_user is None:
             return None
         permissions: set[str] = {p for p in db_user.permissions}
@@ -42,20 +97,53 @@ async def get_user_permission_no_cache(uid: int) -> Optional[set[str]]:
         return permissions
 
 
-async def get_user_permission_cached(uid: int) -> set[str]:
-    key = f'{_Prefix.UserPermission.value}{uid}'
-    async with AsyncRedisSessionLocal() as session:
-        value: list[bytes] = await session.lrange(key, 0, -1)
-        if len(value) > 0:
-            return { p.decode('utf-8') for p in value }
+PERMISSION_LOADS = SingleFlight('user_permission')
 
-        value: set[str] = await get_user_permission_no_cache(uid)
 
-        if len(value) == 0:
-            return set()
+async def _load_user_permission(uid: int) -> set[str]:
+    value: set[str] = await get_user_permission_no_cache(uid)
 
-        await session.delete(key)
-        await session.lpush(key, *value)
-        await session.expire(key, timedelta(seconds=SETTINGS.permission_cache_ttl))
+    if not value:
+        return set()
+
+    key = f'{_Prefix.UserPermission.value}{uid}'
+    try:
+        async with AsyncRedisSessionLocal() as session:
+            async with session.pipeline(transaction=True) as pipe:
+                pipe.delete(key)
+                pipe.lpush(key, *value)
+                pipe.expire(key, timedelta(seconds=SETTINGS.permission_cache_ttl))
+                await pipe.execute()
+    except REDIS_FAILURES:
+        pass
 
     return value
+
+
+async def get_user_permission_cached(uid: int) -> set[str]:
+    key = f'{_Prefix.UserPermission.value}{uid}'
+    shared = SHARED_CACHE.get(key)
+    if shared is not None:
+        return set(shared.decode('utf-8').split('\n'))
+
+    generation = SHARED_CACHE.generation
+    try:
+        async with AsyncRedisSessionLocal() as session:
+            async with session.pipeline(transaction=False) as pipe:
+                pipe.lrange(key, 0, -1)
+                pipe.pttl(key)
+                value, ttl = await pipe.execute()
+    except REDIS_FAILURES:
+        # Redis is unavailable, permissions are read from the database until it is back
+        return await PERMISSION_LOADS.do(uid, lambda: get_user_permission_no_cache(uid)) or set()
+
+    if len(value) > 0:
+        if PERMISSION_LOADS.should_refresh(ttl / 1000):
+            PERMISSION_LOADS.refresh(uid, lambda: _load_user_permission(uid))
+        permissions = { p.decode('utf-8') for p in value }
+    else:
+        permissions = await PERMISSION_LOADS.do(uid, lambda: _load_user_permission(uid))
+
+    if permissions and SHARED_CACHE.enabled:
+        SHARED_CACHE.put(key, '\n'.join(sorted(permissions)).encode('utf-8'), generation)
+    return permissions
@@ -1,6 +1,6 @@
 from hiccup.db.user import *
 from hiccup.db.server import *
-from hiccup.db.base import Base, AsyncSessionLocal, get_db
+from hiccup.db.base import Base, AsyncSessionLocal, ReadOnlySessionLocal, get_db, UnitOfWork, CURRENT_UNIT_OF_WORK, READ_ONLY_OPERATION, db_session, after_commit
 
 
 models = [
@@ -14,4 +14,6 @@ models = [
 ]
 
 
-__all__ = ['Base', 'AsyncSessionLocal', 'get_db', 'models', 'check_ed25519_signature']
+__all__ = ['Base', 'AsyncSessionLocal', 'ReadOnlySessionLocal', 'get_db', 'UnitOfWork', 'CURRENT_UNIT_OF_WORK', 'READ_ONLY_OPERATION',
+           'db_session', 'after_commit',
+           'models', 'check_ed25519_signature']
@@ -1,13 +1,65 @@
+import asyncio
+import itertools
+import logging
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Optional, Callable, Awaitable, Any, AsyncIterator
+from uuid import uuid4
+
 from hiccup import SETTINGS
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession, AsyncEngine
 from sqlalchemy.orm import declarative_base
 
 
+logger = logging.getLogger(__name__)
+
 Base = declarative_base()
 
-engine = create_async_engine(SETTINGS.database_url, echo=False)
+
+def create_engine(url: str) -> AsyncEngine:
+    connect_args: dict[str, Any] = {
+        'statement_cache_size': SETTINGS.db_statement_cache_size,
+        'prepared_statement_cache_size': SETTINGS.db_prepared_statement_cache_size,
+    }
+    if SETTINGS.db_command_timeout is not None:
+        connect_args['command_timeout'] = SETTINGS.db_command_timeout
+    if SETTINGS.db_external_pooler:
+        # A transaction mode pooler hands each transaction to any server connection,
+        # prepared statements must neither be cached nor reuse names
+        connect_args['statement_cache_size'] = 0
+        connect_args['prepared_statement_cache_size'] = 0
+        connect_args['prepared_statement_name_func'] = lambda: f'__asyncpg_{uuid4()}__'
+
+    return create_async_engine(
+        url,
+        echo=False,
+        pool_size=SETTINGS.db_pool_size,
+        max_overflow=SETTINGS.db_max_overflow,
+        pool_timeout=SETTINGS.db_pool_timeout,
+        pool_recycle=SETTINGS.db_pool_recycle,
+        pool_pre_ping=SETTINGS.db_pool_pre_ping,
+        connect_args=connect_args,
+    )
+
+
+engine = create_engine(SETTINGS.database_url)
 AsyncSessionLocal = async_sessionmaker(bind=engine, autocommit=False, autoflush=False, expire_on_commit=False, class_=AsyncSession)
 
+replica_engines = [create_engine(url) for url in SETTINGS.db_replica_urls]
+_replica_session_makers = itertools.cycle([
+    async_sessionmaker(bind=replica, autocommit=False, autoflush=False, expire_on_commit=False, class_=AsyncSession)
+    for replica in replica_engines
+])
+
+
+def ReadOnlySessionLocal() -> AsyncSession:
+    """
+    Session on the next replica in turn, or on the primary when no replica is configured.
+    """
+    if not replica_engines:
+        return AsyncSessionLocal()
+    return next(_replica_session_makers)()
+
 
 async def get_db() -> AsyncSession:
     async with AsyncSessionLocal() as session:
@@ -15,3 +67,115 @@ async def get_db() -> AsyncSession:
             yield session
         finally:
             await session.close()
+
+
+class UnitOfWork:
+    """
+    Session shared by every resolver of one GraphQL operation. The connection is only checked out when a
+    resolver first asks for it; queries share it, a mutation runs as a single transaction committed after
+    the whole operation succeeded. Resolvers take turns on the session, a block nested in a block of the
+    same task reuses the session it holds.
+
+    A read only unit of work checks its session out from a replica.
+    """
+    def __init__(self, read_only: bool = False):
+        self.read_only = read_only
+        self.checked_out = False
+        self._session: Optional[AsyncSession] = None
+        self._lock = asyncio.Lock()
+        self._holder: Optional[asyncio.Task] = None
+        self._after_commit: list[Callable[[], Awaitable[Any]]] = []
+
+    @asynccontextmanager
+    async def session(self) -> AsyncIterator[AsyncSession]:
+        if self._holder is not None and self._holder is asyncio.current_task():
+            # Nested block, the lock is ours already
+            yield self._session
+            return
+        async with self._lock:
+            self._holder = asyncio.current_task()
+            try:
+                if self._session is None:
+                    self._session = ReadOnlySessionLocal() if self.read_only else AsyncSessionLocal()
+                    self.checked_out = True
+                yield self._session
+                # Let following resolvers see generated ids and constraint errors surface in the failing resolver
+                await self._session.flush()
+            finally:
+                self._holder = None
+
+    def after_commit(self, callback: Callable[[], Awaitable[Any]]) -> None:
+        self._after_commit.append(callback)
+
+    async def commit(self) -> None:
+        try:
+            if self._session is not None:
+                await self._session.commit()
+        finally:
+            await self.close()
+        callbacks, self._after_commit = self._after_commit, []
+        for callback in callbacks:
+            # The data is committed already, a failing side effect must neither skip the others nor fail the operation
+            try:
+                await callback()
+            except Exception as e:
+                logger.warning(f"After commit callback failed: {e!r}")
+
+    async def rollback(self) -> None:
+        self._after_commit.clear()
+        try:
+            if self._session is not None:
+                await self._session.rollback()
+        finally:
+            await self.close()
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+CURRENT_UNIT_OF_WORK: ContextVar[Optional[UnitOfWork]] = ContextVar('CURRENT_UNIT_OF_WORK', default=None)
+# Set while an operation that may read from a replica runs
+READ_ONLY_OPERATION: ContextVar[bool] = ContextVar('READ_ONLY_OPERATION', default=False)
+
+
+@asynccontextmanager
+async def db_session() -> AsyncIterator[AsyncSession]:
+    """
+    Session of the current unit of work. Outside of one the block is its own unit of work, committed when it exits,
+    on a replica during a read only operation.
+    """
+    unit_of_work = CURRENT_UNIT_OF_WORK.get()
+    if unit_of_work is not None:
+        async with unit_of_work.session() as session:
+            yield session
+        return
+
+    unit_of_work = UnitOfWork(read_only=READ_ONLY_OPERATION.get())
+    token = CURRENT_UNIT_OF_WORK.set(unit_of_work)
+    try:
+        async with unit_of_work.session() as session:
+            yield session
+    except BaseException:
+        await unit_of_work.rollback()
+        raise
+    finally:
+        CURRENT_UNIT_OF_WORK.reset(token)
+    await unit_of_work.commit()
+
+
+async def after_commit(callback: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any) -> None:
+    """
+    Run a side effect (cache invalidation, events) once the data it describes is committed. Call it inside the
+    db_session() block of the change, outside of a unit of work the data is taken as committed and it runs now.
+    A failing side effect is logged, never raised.
+    """
+    unit_of_work = CURRENT_UNIT_OF_WORK.get()
+    if unit_of_work is None:
+        try:
+            await callback(*args, **kwargs)
+        except Exception as e:
+            logger.warning(f"After commit callback failed: {e!r}")
+    else:
+        unit_of_work.after_commit(lambda: callback(*args, **kwargs))
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+from typing import Any, Optional, Type
+
+from sqlalchemy import insert, Row
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import DeclarativeBase
+
+from hiccup import SETTINGS
+from hiccup.db.base import AsyncSessionLocal
+from hiccup.db.user import AuthToken
+from hiccup.metrics import METRICS
+
+
+logger = logging.getLogger(__name__)
+
+
+class InsertBatcher:
+    """
+    Group commit of single row inserts. Rows arriving within a short window, or until the batch is full,
+    are written by one multi row INSERT in one transaction. Every caller resumes once the transaction
+    holding its row has committed.
+    """
+    def __init__(self, model: Type[DeclarativeBase], key: str, name: str, max_rows: int, max_wait: float):
+        self.model = model
+        self.key = key
+        self.max_rows = max_rows
+        self.max_wait = max_wait
+        self._pending: list[tuple[dict[str, Any], asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._writes: set[asyncio.Task] = set()
+        self.batches = 0
+        self.rows = 0
+        self.fallbacks = 0
+        METRICS.register(name, self.stats)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            'batches': self.batches,
+            'rows': self.rows,
+            'rows_per_batch': self.rows / self.batches if self.batches else 0.0,
+            'pending': len(self._pending),
+            'fallbacks': self.fallbacks,
+        }
+
+    def _values(self, item: DeclarativeBase) -> dict[str, Any]:
+        return {column.key: getattr(item, column.key) for column in self.model.__table__.columns}
+
+    async def insert(self, item: DeclarativeBase) -> Row:
+        """
+        Insert a transient instance, returns the inserted row once it is committed.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((self._values(item), future))
+
+        if len(self._pending) >= self.max_rows or self.max_wait <= 0:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._write(batch))
+            self._writes.add(task)
+            task.add_done_callback(self._writes.discard)
+
+    async def _write(self, batch: list[tuple[dict[str, Any], asyncio.Future]]) -> None:
+        # Every row of a multi row VALUES has the same columns, columns left to server defaults stay out
+        columns = [column for column in self.model.__table__.columns
+                   if any(values[column.key] is not None for values, _ in batch)]
+        rows = [{column.key: values[column.key] for column in columns} for values, _ in batch]
+        try:
+            async with AsyncSessionLocal() as session:
+                result = await session.execute(insert(self.model).values(rows).returning(*self.model.__table__.columns))
+                inserted = {getattr(row, self.key): row for row in result}
+                await session.commit()
+        except IntegrityError as e:
+            if len(batch) == 1:
+                self._resolve(batch, exception=e)
+                return
+            # One bad row must not fail the others, write them one by one
+            self.fallbacks += 1
+            for entry in batch:
+                await self._write([entry])
+            return
+        except Exception as e:
+            logger.warning(f"Batched insert into {self.model.__tablename__} failed: {e}")
+            self._resolve(batch, exception=e)
+            return
+
+        self.batches += 1
+        self.rows += len(batch)
+        self._resolve(batch, inserted=inserted)
+
+    def _resolve(self, batch, inserted: Optional[dict[Any, Row]] = None, exception: Optional[BaseException] = None) -> None:
+        for values, future in batch:
+            # The caller may be gone already, its row is committed all the same
+            if future.done():
+                continue
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(inserted[values[self.key]])
+
+
+AUTH_TOKEN_INSERTS = InsertBatcher(AuthToken, 'token', 'auth_token_inserts',
+                                   max_rows=SETTINGS.token_insert_batch_size, max_wait=SETTINGS.token_insert_batch_window)
@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import time
+from contextlib import suppress
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Optional
+
+from sqlalchemy import text
+
+from hiccup import SETTINGS
+from hiccup.db.base import AsyncSessionLocal, engine
+from hiccup.metrics import METRICS
+
+
+logger = logging.getLogger(__name__)
+
+# Each batch is its own short transaction. SKIP LOCKED lets every worker purge at the same time
+# without waiting on each other or on a token being revoked right now.
+PURGE_EXPIRED_TOKENS = text("""
+    DELETE FROM auth_token
+    WHERE revoked_at < :cutoff AND id IN (
+        SELECT id FROM auth_token
+        WHERE revoked_at < :cutoff
+        ORDER BY revoked_at
+        LIMIT :batch_size
+        FOR UPDATE SKIP LOCKED
+    )
+""")
+
+IS_PARTITIONED = text("SELECT relkind = 'p' FROM pg_class WHERE oid = 'auth_token'::regclass")
+
+TOKEN_PARTITIONS = text("""
+    SELECT child.relname, pg_inherits.inhdetachpending, pg_get_expr(child.relpartbound, child.oid) = 'DEFAULT'
+    FROM pg_inherits
+    JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+    JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+    WHERE parent.relname = 'auth_token'
+""")
+
+# Partitions are maintained by one worker at a time, the others skip the run
+MAINTENANCE_LOCK_KEY = 0x68696363_7570_0001
+TRY_MAINTENANCE_LOCK = text("SELECT pg_try_advisory_lock(:key)")
+RELEASE_MAINTENANCE_LOCK = text("SELECT pg_advisory_unlock(:key)")
+
+TABLE_SIZE = text("""
+    SELECT coalesce(sum(pg_total_relation_size(tree.relid)), 0), coalesce(sum(greatest(c.reltuples, 0)), 0)
+    FROM pg_partition_tree('auth_token'::regclass) tree
+    JOIN pg_class c ON c.oid = tree.relid
+    WHERE tree.isleaf
+""")
+
+_PARTITION_PREFIX = 'auth_token_p'
+
+
+def _month(day: date) -> date:
+    return date(day.year, day.month, 1)
+
+
+def _next_month(day: date) -> date:
+    return date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+
+class TokenPurger:
+    """
+    Deletes expired auth tokens in bounded batches. On an auth_token partitioned by the optional
+    migration, partitions that expired as a whole are detached and dropped instead and new ones are
+    created ahead, by one worker at a time.
+    """
+    task: Optional[asyncio.Task]
+
+    def __init__(self):
+        self.task = None
+        self.runs = 0
+        self.deleted = 0
+        self.dropped_partitions = 0
+        self.last_run_at: Optional[float] = None
+        self.last_run_seconds: Optional[float] = None
+        self.table_bytes: Optional[int] = None
+        self.table_rows: Optional[int] = None
+        METRICS.register('token_purge', self.stats)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            'running': self.task is not None and not self.task.done(),
+            'runs': self.runs,
+            'deleted': self.deleted,
+            'dropped_partitions': self.dropped_partitions,
+            'last_run_at': self.last_run_at,
+            'last_run_seconds': self.last_run_seconds,
+            'table_bytes': self.table_bytes,
+            'table_rows': self.table_rows,
+        }
+
+    async def setup(self):
+        if SETTINGS.token_purge_interval > 0:
+            self.task = asyncio.create_task(self._loop())
+
+    async def dispose(self):
+        if self.task is not None:
+            self.task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self.task
+        self.task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.purge()
+            except Exception as e:
+                logger.warning(f"Token purge failed: {e}")
+            await asyncio.sleep(SETTINGS.token_purge_interval)
+
+    async def purge(self, batch_size: Optional[int] = None, max_batches: Optional[int] = None) -> int:
+        """
+        Removes tokens expired longer than the grace period ago, returns how many rows were deleted.
+        """
+        batch_size = batch_size or SETTINGS.token_purge_batch_size
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=SETTINGS.token_purge_grace)
+        started = time.perf_counter()
+
+        async with AsyncSessionLocal() as session:
+            partitioned = (await session.execute(IS_PARTITIONED)).scalar()
+        if partitioned:
+            try:
+                await self._maintain_partitions(cutoff)
+            except Exception as e:
+                # Expired rows are still deleted batch by batch
+                logger.warning(f"Token partition maintenance failed: {e}")
+
+        deleted = batches = 0
+        while max_batches is None or batches < max_batches:
+            async with AsyncSessionLocal() as session:
+                result = await session.execute(PURGE_EXPIRED_TOKENS, {'cutoff': cutoff, 'batch_size': batch_size})
+                await session.commit()
+            deleted += result.rowcount
+            self.deleted += result.rowcount
+            batches += 1
+            if result.rowcount < batch_size:
+                break
+            # Let the workload in between batches
+            await asyncio.sleep(SETTINGS.token_purge_batch_pause)
+
+        await self.measure()
+        self.runs += 1
+        self.last_run_at = time.time()
+        self.last_run_seconds = time.perf_counter() - started
+        logger.info(f"Purged {deleted} expired tokens in {batches} batches, "
+                    f"auth_token holds ~{self.table_rows} rows in {self.table_bytes} bytes")
+        return deleted
+
+    async def _maintain_partitions(self, cutoff: datetime):
+        # Autocommit, DETACH PARTITION CONCURRENTLY can't run inside a transaction
+        async with engine.connect() as connection:
+            connection = await connection.execution_options(isolation_level='AUTOCOMMIT')
+            if not (await connection.execute(TRY_MAINTENANCE_LOCK, {'key': MAINTENANCE_LOCK_KEY})).scalar():
+                return
+            try:
+                await self._maintain_partitions_locked(connection, cutoff)
+            finally:
+                await connection.execute(RELEASE_MAINTENANCE_LOCK, {'key': MAINTENANCE_LOCK_KEY})
+
+    async def _maintain_partitions_locked(self, connection, cutoff: datetime):
+        partitions = (await connection.execute(TOKEN_PARTITIONS)).all()
+        has_default = any(is_default for _, _, is_default in partitions)
+        # DDL waiting for its lock would queue every login behind it, give up and retry next run instead
+        await connection.execute(text(f"SET lock_timeout = '{int(SETTINGS.token_partition_lock_timeout * 1000)}ms'"))
+        try:
+            for name, detach_pending, _ in partitions:
+                if not name.startswith(_PARTITION_PREFIX):
+                    continue
+                month = datetime.strptime(name.removeprefix(_PARTITION_PREFIX), '%Y%m').date()
+                if detach_pending:
+                    # A concurrent detach of an expired partition was interrupted
+                    await connection.execute(text(f'ALTER TABLE auth_token DETACH PARTITION {name} FINALIZE'))
+                elif _next_month(month) <= cutoff.date():
+                    # Concurrently only takes a SHARE UPDATE EXCLUSIVE lock on auth_token, but is
+                    # refused while a default partition exists
+                    concurrently = '' if has_default else ' CONCURRENTLY'
+                    await connection.execute(text(f'ALTER TABLE auth_token DETACH PARTITION {name}{concurrently}'))
+                else:
+                    continue
+                # Detached, the drop only locks the partition itself
+                await connection.execute(text(f'DROP TABLE IF EXISTS {name}'))
+                self.dropped_partitions += 1
+                logger.info(f"Dropped expired token partition {name}")
+
+            # Tokens expire at most session_valid_duration from now, make room for them before they come
+            existing = {name for name, _, _ in partitions}
+            month = _month(datetime.now(timezone.utc).date())
+            horizon = datetime.now(timezone.utc).date() + timedelta(seconds=SETTINGS.session_valid_duration)
+            while month <= horizon:
+                name = f'{_PARTITION_PREFIX}{month:%Y%m}'
+                if name not in existing:
+                    await connection.execute(text(
+                        f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF auth_token "
+                        f"FOR VALUES FROM ('{month.isoformat()} 00:00+00') TO ('{_next_month(month).isoformat()} 00:00+00')"
+                    ))
+                month = _next_month(month)
+        finally:
+            await connection.execute(text("RESET lock_timeout"))
+
+    async def measure(self):
+        async with AsyncSessionLocal() as session:
+            table_bytes, table_rows = (await session.execute(TABLE_SIZE)).one()
+        self.table_bytes, self.table_rows = int(table_bytes), int(table_rows)
+
+
+TOKEN_PURGER = TokenPurger()
@@ -22,6 +22,7 @@ class VirtualServer(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now(), server_default=func.now())
     configuration = Column(JSON(), default=dict)
+    owner_id = Column(BigInteger, ForeignKey('classic_identify.id'), nullable=True)
 
     channels = relationship('Channel', back_populates='virtual_server', cascade='all, delete, delete-orphan')
     virtual_server_aliases = relationship('VirtualServerAlias', back_populates='virtual_server')
@@ -0,0 +1,49 @@
+from functools import lru_cache
+from typing import Type
+
+from sqlalchemy import select, bindparam, Select
+from sqlalchemy.orm import joinedload, DeclarativeBase
+
+from hiccup.db.server import user_joined_server_table
+from hiccup.db.user import AuthToken, AnonymousIdentify, ClassicIdentify
+
+
+# Hot statements are built once. A statement object memoizes its cache key, so executing it again skips
+# both the Python side construction and the cache key walk, and hits the engine's compiled cache directly.
+
+AUTH_TOKEN_IDENTITY = (
+    select(AuthToken)
+    .options(
+        joinedload(AuthToken.anonymous_identify)
+        .options(joinedload(AnonymousIdentify.owner)),
+        joinedload(AuthToken.classic_identify))
+    .where(AuthToken.token == bindparam('token'))
+    .limit(1)
+)
+
+USER_PERMISSION_GROUPS = (
+    select(ClassicIdentify)
+    .options(joinedload(ClassicIdentify.permission_groups))
+    .where(ClassicIdentify.id == bindparam('uid'))
+    .limit(1)
+)
+
+JOINED_SERVER_IDS = (
+    select(user_joined_server_table.c.virtual_server_id)
+    .where(user_joined_server_table.c.classic_user_id == bindparam('uid'))
+)
+
+
+@lru_cache(maxsize=None)
+def row_by_id(model: Type[DeclarativeBase]) -> Select:
+    return select(model).where(model.id == bindparam('ident')).limit(1)
+
+
+@lru_cache(maxsize=None)
+def id_by_column(model: Type[DeclarativeBase], column: str) -> Select:
+    return select(model.id).where(getattr(model, column) == bindparam('value')).limit(1)
+
+
+@lru_cache(maxsize=None)
+def rows_by_ids(model: Type[DeclarativeBase]) -> Select:
+    return select(model).where(model.id.in_(bindparam('idents', expanding=True)))
@@ -77,7 +77,7 @@ class AuthToken(Base):
     anonymous_user_id = Column(BigInteger, ForeignKey('anonymous_identify.id'), nullable=True)
     classic_user_id = Column(BigInteger, ForeignKey('classic_identify.id'), nullable=True)
     issued_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
-    revoked_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    revoked_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False, index=True)
 
     anonymous_identify = relationship('AnonymousIdentify', back_populates='auth_tokens')
     classic_identify = relationship('ClassicIdentify', back_populates='auth_tokens')
@@ -3,7 +3,7 @@ import strawberry
 from hiccup.db.permission import PermissionGroup
 from hiccup.db.server import Channel, VirtualServer, VirtualServerAlias
 from hiccup.graphql.base import generate_multiple_mutations, generate_multiple_queries
-from hiccup.graphql.channel import ChannelMutation, ChannelQuery
+from hiccup.graphql.channel import ChannelMutation, ChannelQuery, ChannelSubscription
 from hiccup.graphql.base import Context
 from hiccup.graphql.services import ServiceMutation, ServiceQuery
 from hiccup.graphql.user import UserQuery, UserMutation
@@ -48,8 +48,15 @@ class Mutation(
     pass
 
 
+@strawberry.type
+class Subscription(
+    ChannelSubscription,
+):
+    pass
+
+
 async def get_context() -> Context:
     return Context()
 
 
-__all__ = ['Query', 'Mutation', 'get_context']
+__all__ = ['Query', 'Mutation', 'Subscription', 'get_context']
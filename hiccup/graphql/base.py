@@ -1,33 +1,49 @@
+import asyncio
+import hashlib
+import logging
 import re
 import string
 import time
 import random
-from datetime import datetime
+from datetime import datetime, timezone
 from enum import Enum
 from functools import cached_property, lru_cache
-from typing import Type, Optional, Any, NewType, Union
+from typing import Type, Optional, Any, NewType, Union, Sequence, Iterable, NamedTuple
 
+import sqlalchemy
 import strawberry
-from sqlalchemy import select, Column, ARRAY, VARCHAR, BOOLEAN, String, JSON, Table, delete, CursorResult, and_, func
+from graphql import GraphQLError
+from sqlalchemy import select, Column, ARRAY, VARCHAR, BOOLEAN, String, JSON, Table, delete, CursorResult, and_, func, \
+    insert, update
 from sqlalchemy.orm import DeclarativeBase, joinedload
 from sqlalchemy.sql.type_api import TypeEngine
 from strawberry.annotation import StrawberryAnnotation
+from strawberry.extensions import FieldExtension
 from strawberry.fastapi import BaseContext
 from strawberry.permission import PermissionExtension, BasePermission
 from strawberry.tools import create_type
+from strawberry.types.base import StrawberryList, StrawberryOptional
+from strawberry.types.enum import EnumDefinition
 from strawberry.types.field import StrawberryField
 from strawberry.tools import merge_types
 from strawberry import scalars, Info, UNSET
 
 from authlib.jose import JsonWebToken
+from authlib.jose.errors import JoseError
 
 from hiccup import SETTINGS
-from hiccup.cache import get_user_permission_cached
+from hiccup.cache import get_user_permission_cached, get_cached_response, store_cached_response, invalidate_response_tags, \
+    ENTITY_CACHES, EVENT_BROKER, REVOCATION_FILTER, RATE_LIMITER
+from hiccup.cache.ratelimit import Bucket
+from hiccup.cache.redis import REDIS_FAILURES
 from hiccup.captcha import Turnstile
-from hiccup.db import AsyncSessionLocal
+from hiccup.db import AsyncSessionLocal, db_session, after_commit, UnitOfWork, CURRENT_UNIT_OF_WORK
 from hiccup.db.user import AuthToken, AnonymousIdentify, ClassicIdentify
+from hiccup.db.statements import AUTH_TOKEN_IDENTITY, row_by_id
 
 
+logger = logging.getLogger(__name__)
+
 def map_sqlalchemy_engine_type(t: Type[TypeEngine]):
     if isinstance(t, VARCHAR):
         return str
@@ -113,16 +129,24 @@ def generate_mutations(
     table = model if isinstance(model, Table) else model.__table__
     table_name = table.name
 
+    bulk_update_type = create_type(name=f'{table_name}_bulk_update_input', fields=[
+        StrawberryField(python_name='id', type_annotation=StrawberryAnnotation(int), description=f"id of the {table_name}"),
+        StrawberryField(python_name='data', type_annotation=StrawberryAnnotation(optional_type), description=f"Fields of the {table_name} to update"),
+    ], is_input=True)
+    bulk_result_type = create_type(name=f'{table_name}_bulk_result', fields=[
+        StrawberryField(python_name='items', type_annotation=StrawberryAnnotation(list[graphql_type]), description=f"Affected {table_name} rows"),
+        StrawberryField(python_name='errors', type_annotation=StrawberryAnnotation(list[BulkRowError]), description="Rows failed to apply"),
+        StrawberryField(python_name='affected_rows', type_annotation=StrawberryAnnotation(int), description="Count of affected rows"),
+    ])
+
     def create_mutation_class():
         mutations: dict[str, any] = {}
 
         async def create_item(data: partial_optional_type) -> graphql_type:
-            async with AsyncSessionLocal() as session:
-                item = model(**data.__dict__)
-                session.add(item)
-                await session.commit()
-                await session.refresh(item)
-                return item
+            async with db_session() as session:
+                item = await session.scalar(insert(model).values(**provided_values(data)).returning(model))
+                await after_commit(on_rows_changed, table, [item], "created")
+            return item
 
         setattr(create_item, "__name__", to_camel_case(f"create_{table_name}"))
         mutations[to_camel_case(f"create_{table_name}")] = strawberry.mutation(create_item, description=f"Create {table_name}",
@@ -130,18 +154,16 @@ def generate_mutations(
                              name=to_camel_case(f"create_{table_name}"))
 
         async def update_item(item_id: int, data: optional_type) -> graphql_type:
-            async with AsyncSessionLocal() as session:
-                item = await session.scalar(select(model).where(model.id == item_id).limit(1))
-                if item:
-                    for key, value in data.__dict__.items():
-                        if value is not UNSET:
-                            setattr(item, key, value)
+            values = provided_values(data)
+            async with db_session() as session:
+                if values:
+                    item = await session.scalar(update(model).where(model.id == item_id).values(**values).returning(model))
                 else:
+                    item = await session.scalar(select(model).where(model.id == item_id).limit(1))
+                if item is None:
                     raise ValueError(f"Item with id {item_id} does not exist")
-                session.add(item)
-                await session.commit()
-                await session.refresh(item)
-                return item
+                await after_commit(on_rows_changed, table, [item], "updated")
+            return item
 
         setattr(update_item, "__name__", to_camel_case(f"update_{table_name}"))
         mutations[to_camel_case(f"update_{table_name}")] = strawberry.mutation(update_item, description=f"Update {table_name}. Create if not exist.",
@@ -149,21 +171,194 @@ def generate_mutations(
                              name=to_camel_case(f"update_{table_name}"))
 
         async def delete_item(item_id: int) -> bool:
-            async with AsyncSessionLocal() as session:
-                item: CursorResult = await session.execute(delete(model).where(model.id == item_id))
-                await session.commit()
-                return item.rowcount != 0
+            async with db_session() as session:
+                item = await session.scalar(delete(model).where(model.id == item_id).returning(model))
+                if item is None:
+                    return False
+                await after_commit(on_rows_changed, table, [item], "deleted")
+            return True
 
         setattr(delete_item, "__name__", to_camel_case(f"delete_{table_name}"))
         mutations[f"delete_{table_name}"] = strawberry.mutation(delete_item, description=f"Delete {table_name}.",
                              extensions=[PermissionExtension(permissions=[HasPermission(*required_permissions)])],
                              name=to_camel_case(f"delete_{table_name}"))
 
+        async def create_many_items(data: list[partial_optional_type], continue_on_error: bool = False) -> bulk_result_type:
+            check_bulk_batch_size(len(data))
+            # An empty executemany INSERT would run as INSERT ... DEFAULT VALUES
+            if not data:
+                return bulk_result_type(items=[], errors=[], affected_rows=0)
+            rows = [provided_values(entry) for entry in data]
+            async with db_session() as session:
+                if not continue_on_error:
+                    items = list(await session.scalars(insert(model).returning(model), rows))
+                    await after_commit(on_rows_changed, table, items, "created")
+                    return bulk_result_type(items=items, errors=[], affected_rows=len(items))
+
+                items, errors = await run_bulk_rows(
+                    session, rows,
+                    lambda row: session.scalar(insert(model).values(**row).returning(model)),
+                )
+                await after_commit(on_rows_changed, table, items, "created")
+                return bulk_result_type(items=items, errors=errors, affected_rows=len(items))
+
+        setattr(create_many_items, "__name__", to_camel_case(f"create_many_{table_name}"))
+        mutations[to_camel_case(f"create_many_{table_name}")] = strawberry.mutation(create_many_items, description=f"Create multiple {table_name} in one transaction",
+                             extensions=[PermissionExtension(permissions=[HasPermission(*required_permissions)])],
+                             name=to_camel_case(f"create_many_{table_name}"))
+
+        async def update_many_items(data: list[bulk_update_type], continue_on_error: bool = False) -> bulk_result_type:
+            check_bulk_batch_size(len(data))
+            if not data:
+                return bulk_result_type(items=[], errors=[], affected_rows=0)
+            rows = [{**provided_values(entry.data), 'id': entry.id} for entry in data]
+            async with db_session() as session:
+                if not continue_on_error:
+                    # Rows providing the same set of fields share one executemany UPDATE
+                    grouped_rows: dict[tuple[str, ...], list[dict]] = {}
+                    for row in rows:
+                        grouped_rows.setdefault(tuple(sorted(row.keys())), []).append(row)
+                    for keys, group in grouped_rows.items():
+                        if keys != ('id', ):
+                            await session.execute(update(model), group)
+
+                    ids = [row['id'] for row in rows]
+                    found = {item.id: item for item in await session.scalars(select(model).where(model.id.in_(ids)))}
+                    missing = [item_id for item_id in ids if item_id not in found]
+                    if missing:
+                        raise ValueError(f"Items with id {', '.join(map(str, missing))} do not exist")
+                    items = [found[item_id] for item_id in dict.fromkeys(ids)]
+                    await after_commit(on_rows_changed, table, items, "updated")
+                    return bulk_result_type(items=items, errors=[], affected_rows=len(items))
+
+                async def update_row(row: dict):
+                    values = {key: value for key, value in row.items() if key != 'id'}
+                    if values:
+                        stmt = update(model).where(model.id == row['id']).values(**values).returning(model)
+                    else:
+                        stmt = select(model).where(model.id == row['id']).limit(1)
+                    item = await session.scalar(stmt)
+                    if item is None:
+                        raise ValueError(f"Item with id {row['id']} does not exist")
+                    return item
+
+                items, errors = await run_bulk_rows(session, rows, update_row)
+                await after_commit(on_rows_changed, table, items, "updated")
+                return bulk_result_type(items=items, errors=errors, affected_rows=len(items))
+
+        setattr(update_many_items, "__name__", to_camel_case(f"update_many_{table_name}"))
+        mutations[to_camel_case(f"update_many_{table_name}")] = strawberry.mutation(update_many_items, description=f"Update multiple {table_name} in one transaction",
+                             extensions=[PermissionExtension(permissions=[HasPermission(*required_permissions)])],
+                             name=to_camel_case(f"update_many_{table_name}"))
+
+        async def delete_many_items(item_ids: list[int], continue_on_error: bool = False) -> bulk_result_type:
+            check_bulk_batch_size(len(item_ids))
+            if not item_ids:
+                return bulk_result_type(items=[], errors=[], affected_rows=0)
+            async with db_session() as session:
+                if not continue_on_error:
+                    items = list(await session.scalars(delete(model).where(model.id.in_(item_ids)).returning(model)))
+                    await after_commit(on_rows_changed, table, items, "deleted")
+                    return bulk_result_type(items=items, errors=[], affected_rows=len(items))
+
+                async def delete_row(item_id: int):
+                    item = await session.scalar(delete(model).where(model.id == item_id).returning(model))
+                    if item is None:
+                        raise ValueError(f"Item with id {item_id} does not exist")
+                    return item
+
+                items, errors = await run_bulk_rows(session, item_ids, delete_row)
+                await after_commit(on_rows_changed, table, items, "deleted")
+                return bulk_result_type(items=items, errors=errors, affected_rows=len(items))
+
+        setattr(delete_many_items, "__name__", to_camel_case(f"delete_many_{table_name}"))
+        mutations[to_camel_case(f"delete_many_{table_name}")] = strawberry.mutation(delete_many_items, description=f"Delete multiple {table_name} in one transaction",
+                             extensions=[PermissionExtension(permissions=[HasPermission(*required_permissions)])],
+                             name=to_camel_case(f"delete_many_{table_name}"))
+
         return create_type(name=f"{table_name}Mutation", fields=list(mutations.values()), description=f"Auto generated cud mutation for {table_name}")
 
     return create_mutation_class()
 
 
+@strawberry.type
+class BulkRowError:
+    index: int
+    message: str
+
+
+def check_bulk_batch_size(size: int) -> None:
+    if size > SETTINGS.graphql_bulk_max_batch_size:
+        raise ValueError(f"Batch size {size} exceeds the limit of {SETTINGS.graphql_bulk_max_batch_size}")
+
+
+def provided_values(data: Any) -> dict[str, Any]:
+    return {key: value for key, value in data.__dict__.items() if value is not UNSET}
+
+
+def bulk_row_error_message(e: Exception) -> str:
+    """
+    Message safe to hand to clients, database errors carry values and SQL and only name the violated constraint.
+    """
+    if isinstance(e, sqlalchemy.exc.IntegrityError):
+        constraint = getattr(getattr(e.orig, '__cause__', None), 'constraint_name', None)
+        return f"Constraint violation: {constraint}" if constraint else "Constraint violation"
+    if isinstance(e, sqlalchemy.exc.SQLAlchemyError):
+        return "Database error"
+    return str(e)
+
+
+async def run_bulk_rows(session, rows: list, action) -> (list, list[BulkRowError]):
+    """
+    Apply action to every row inside its own savepoint, collecting failed rows instead of aborting the batch.
+    """
+    items, errors = [], []
+    for index, row in enumerate(rows):
+        try:
+            async with session.begin_nested():
+                items.append(await action(row))
+        except (sqlalchemy.exc.SQLAlchemyError, ValueError) as e:
+            logger.warning(f"Bulk row {index} failed: {getattr(e, 'orig', None) or e}")
+            errors.append(BulkRowError(index=index, message=bulk_row_error_message(e)))
+    return items, errors
+
+
+def row_cache_tags(table: Table, row: Any) -> list[str]:
+    """
+    Tags touched by a row: the row itself plus every row it references through a foreign key.
+    """
+    tags = [f"{table.name}:{row.id}"]
+    for column in table.columns:
+        value = getattr(row, column.name, None)
+        if value is None:
+            continue
+        for foreign_key in column.foreign_keys:
+            tags.append(f"{foreign_key.column.table.name}:{value}")
+    return tags
+
+
+async def publish_event(topics: Iterable[str], event_type: str, entity_id: Optional[int] = None,
+                        user_id: Optional[int] = None, data: Optional[dict[str, Any]] = None) -> None:
+    """
+    Publish a ServerEvent to subscription topics, topics share their names with the cache tags.
+    """
+    await EVENT_BROKER.publish(list(topics), {
+        'type': event_type,
+        'entity_id': entity_id,
+        'user_id': user_id,
+        'data': data,
+    })
+
+
+async def on_rows_changed(table: Table, rows: Iterable[Any], change: str) -> None:
+    rows = list(rows)
+    if table.name in ENTITY_CACHES:
+        await ENTITY_CACHES[table.name].invalidate(*(row.id for row in rows))
+    await invalidate_response_tags(*(tag for row in rows for tag in row_cache_tags(table, row)))
+    for row in rows:
+        await publish_event(row_cache_tags(table, row), f"{table.name}_{change}", entity_id=row.id)
+
+
 def generate_multiple_mutations(
         name: str = "GeneratedMutations",
         *models: tuple[ Type[DeclarativeBase], Optional[list[str]], Optional[list[str]] ]
@@ -186,12 +381,12 @@ def generate_queries(
     table_name = table.name
 
     async def retrieve_items(page: int = 0, page_size: int = 10) -> list[graphql_type]:
-        async with AsyncSessionLocal() as session:
+        async with db_session() as session:
             offset = page * page_size
             result = await session.scalars(
                 select(model).offset(offset).limit(page_size)
-            ).all()
-            return result
+            )
+            return list(result)
 
     retrieve_name = to_camel_case(f"retrieve_{table_name}")
     setattr(retrieve_items, "__name__", retrieve_name)
@@ -200,6 +395,7 @@ def generate_queries(
         retrieve_items,
         description=f"Retrieve paged {table_name} instances.",
         name=retrieve_name,
+        metadata=query_cost(2),
         extensions=[PermissionExtension(permissions=[HasPermission(*required_permissions)])],
     )])
 
@@ -212,6 +408,16 @@ def generate_multiple_queries(
     return merge_types(name, created_types)
 
 
+QUERY_COST_METADATA_KEY = "hiccup::query_cost"
+
+
+def query_cost(cost: int) -> dict[str, int]:
+    """
+    Field metadata declaring the static cost of resolving a field once, see QueryCostLimiter.
+    """
+    return {QUERY_COST_METADATA_KEY: cost}
+
+
 def to_camel_case(s: str) -> str:
     words = re.split(r'[\s_-]+', s)
     return words[0].lower() + ''.join(word.capitalize() for word in words[1:])
@@ -236,9 +442,75 @@ obfuscated_id = strawberry.scalar(
 )
 
 
+class TokenIdentity(NamedTuple):
+    token_id: int
+    user: Union['ClassicUser', 'AnonymousUser']
+    revoked_at: datetime
+
+
+def identity_from_auth_token(db_token: Optional[AuthToken]) -> Optional[TokenIdentity]:
+    """
+    Identity of a token loaded with AUTH_TOKEN_IDENTITY. An anonymous identify owned by a classic user acts as its owner.
+    """
+    if db_token is None or db_token.is_expired:
+        return None
+
+    if db_token.anonymous_identify is not None:
+        anonymous: AnonymousIdentify = db_token.anonymous_identify
+        if anonymous.owner is None:
+            user = AnonymousUser(id=anonymous.id, created_at=anonymous.created_at, updated_at=anonymous.updated_at, public_key=anonymous.public_key.hex().upper())
+            return TokenIdentity(token_id=db_token.id, user=user, revoked_at=db_token.revoked_at)
+        classic: ClassicIdentify = anonymous.owner
+        user = ClassicUser(id=classic.id, created_at=classic.created_at, updated_at=classic.updated_at, username=classic.user_name)
+        return TokenIdentity(token_id=db_token.id, user=user, revoked_at=db_token.revoked_at)
+
+    if db_token.classic_identify is not None:
+        classic: ClassicIdentify = db_token.classic_identify
+        user = ClassicUser(id=classic.id, created_at=classic.created_at, updated_at=classic.updated_at, username=classic.user_name)
+        return TokenIdentity(token_id=db_token.id, user=user, revoked_at=db_token.revoked_at)
+
+    return None
+
+
 class Context(BaseContext):
+    def __init__(self):
+        super().__init__()
+        self._identity_lookup: Optional[asyncio.Future] = None
+        self.revoked = False
+        self.rate_limits: dict[str, dict[str, Any]] = {}
+
     async def user(self) -> Optional[Union['ClassicUser', 'AnonymousUser']]:
-        # TODO: cache in redis
+        identity = await self.identity()
+        return None if identity is None else identity.user
+
+    async def identity(self) -> Optional[TokenIdentity]:
+        """
+        Identity behind the request token, looked up once however many resolvers or batched operations ask.
+        A websocket context lives as long as the connection and keeps the identity until the token's revoked_at,
+        or until a revocation event marks the context revoked.
+        """
+        if self.revoked:
+            return None
+
+        lookup = self._identity_lookup
+        if lookup is not None and lookup.done():
+            if lookup.cancelled() or lookup.exception() is not None:
+                self._identity_lookup = None
+            elif lookup.result() is not None and lookup.result().revoked_at <= datetime.now(lookup.result().revoked_at.tzinfo):
+                self._identity_lookup = None
+
+        if self._identity_lookup is None:
+            self._identity_lookup = asyncio.ensure_future(self._resolve_identity())
+        return await asyncio.shield(self._identity_lookup)
+
+    @property
+    def unit_of_work(self) -> Optional[UnitOfWork]:
+        """
+        Unit of work of the operation being executed, use db_session() to get its session.
+        """
+        return CURRENT_UNIT_OF_WORK.get()
+
+    async def _resolve_identity(self) -> Optional[TokenIdentity]:
         if not self.request:
             return None
 
@@ -250,29 +522,19 @@ class Context(BaseContext):
         if token is None:
             return None
 
-        async with AsyncSessionLocal() as session:
-            db_token: Optional[AuthToken] = await session.scalar(
-                select(AuthToken)
-                .options(
-                    joinedload(AuthToken.anonymous_identify)
-                    .options(joinedload(AnonymousIdentify.owner)),
-                    joinedload(AuthToken.classic_identify))
-                .where(AuthToken.token == token).limit(1))
-            if db_token is None or db_token.is_expired:
-                return None
+        if SETTINGS.signed_session_tokens_enabled and token.count('.') == 2:
+            return await verify_session_token(token)
 
-            if db_token.anonymous_identify is not None:
-                anonymous: AnonymousIdentify = db_token.anonymous_identify
-                if anonymous.owner is None:
-                    return AnonymousUser(id=anonymous.id, created_at=anonymous.created_at, updated_at=anonymous.updated_at, public_key=anonymous.public_key)
-                classic: ClassicIdentify = anonymous.owner
-                return ClassicUser(id=classic.id, created_at=classic.created_at, updated_at=classic.updated_at, username=classic.user_name)
-
-            if db_token.classic_identify is not None:
-                classic: ClassicIdentify = db_token.classic_identify
-                return ClassicUser(id=classic.id, created_at=classic.created_at, updated_at=classic.updated_at, username=classic.user_name)
+        # Not part of the unit of work: the lookup is shared by every operation of the context
+        async with AsyncSessionLocal() as session:
+            db_token: Optional[AuthToken] = await session.scalar(AUTH_TOKEN_IDENTITY, {'token': token})
+            return identity_from_auth_token(db_token)
 
-        return None
+    @cached_property
+    def client_ip(self) -> Optional[str]:
+        if SETTINGS.rate_limit_trust_forwarded_for and 'X-Forwarded-For' in self.request.headers:
+            return self.request.headers['X-Forwarded-For'].split(',')[0].strip()
+        return self.request.client.host if self.request.client else None
 
     @cached_property
     def captcha_challenge_token(self) -> Optional[str]:
@@ -294,6 +556,109 @@ class Context(BaseContext):
 
         return None
 
+class ResponseCacheScope(str, Enum):
+    PUBLIC = "public"
+    USER = "user"
+
+
+def _response_to_json(value: Any) -> Any:
+    # Plain fields only, fields with a resolver are resolved again on every request
+    definition = getattr(value, '__strawberry_definition__', None)
+    if definition is not None:
+        return {f.python_name: _response_to_json(getattr(value, f.python_name))
+                for f in definition.fields if f.base_resolver is None}
+    if isinstance(value, (list, tuple)):
+        return [_response_to_json(item) for item in value]
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _response_from_json(type_: Any, value: Any) -> Any:
+    if value is None:
+        return None
+    if isinstance(type_, StrawberryOptional):
+        return _response_from_json(type_.of_type, value)
+    if isinstance(type_, StrawberryList):
+        return [_response_from_json(type_.of_type, item) for item in value]
+    if isinstance(type_, EnumDefinition):
+        return type_.wrapped_cls(value)
+    definition = getattr(type_, '__strawberry_definition__', None)
+    if definition is not None:
+        return type_(**{f.python_name: _response_from_json(f.type, value[f.python_name])
+                        for f in definition.fields if f.base_resolver is None})
+    if type_ is datetime:
+        return datetime.fromisoformat(value)
+    return value
+
+
+class CachedResponse(FieldExtension):
+    """
+    Opt-in response cache for a field. Tags are format strings over the field arguments, `source` and `user`,
+    item_tags are formatted against each returned `item`. Place it before permission extensions so that
+    permission checks still run before cached data is served. Results are stored as JSON of their plain fields
+    and rebuilt as the field's return type on a hit.
+    """
+    def __init__(
+            self,
+            *,
+            scope: ResponseCacheScope = ResponseCacheScope.PUBLIC,
+            tags: Sequence[str] = (),
+            item_tags: Sequence[str] = (),
+            ttl: Optional[int] = None,
+    ):
+        self.scope = scope
+        self.tags = tuple(tags)
+        self.item_tags = tuple(item_tags)
+        self.ttl = ttl
+        self.field: Optional[StrawberryField] = None
+
+    def apply(self, field: StrawberryField) -> None:
+        self.field = field
+
+    async def resolve_async(self, next_, source: Any, info: Info, **kwargs: Any) -> Any:
+        if not SETTINGS.response_cache_enabled:
+            return await next_(source, info, **kwargs)
+
+        user = None
+        if self.scope == ResponseCacheScope.USER:
+            user = await info.context.user()
+            if user is None:
+                return await next_(source, info, **kwargs)
+
+        tags = [tag.format(**kwargs, source=source, user=user) for tag in self.tags]
+        key = hashlib.sha256(repr((
+            info.path.typename,
+            info.field_name,
+            sorted(kwargs.items()),
+            tags,
+            None if user is None else user.id,
+        )).encode('utf-8')).hexdigest()
+
+        try:
+            hit, value, started_at = await get_cached_response(key)
+        except REDIS_FAILURES:
+            # Serve uncached while redis is unavailable
+            return await next_(source, info, **kwargs)
+        if hit:
+            try:
+                return _response_from_json(self.field.type, value)
+            except (KeyError, TypeError, ValueError):
+                # Stored by a release with other fields, recompute
+                pass
+
+        result = await next_(source, info, **kwargs)
+        items = result if isinstance(result, list) else [result]
+        tags += [tag.format(item=item) for item in items for tag in self.item_tags]
+        try:
+            await store_cached_response(key, _response_to_json(result), tags, started_at, self.ttl)
+        except REDIS_FAILURES:
+            pass
+        return result
+
+
 @strawberry.enum
 class UserType(str, Enum):
     CLASSIC = "classic"
@@ -329,7 +694,7 @@ class ClassicUser(UserBase):
         if current_user is None or current_user.id != self.id:
             raise ValueError(f"Access denied")
 
-        async with AsyncSessionLocal() as session:
+        async with db_session() as session:
             stmt = select(AuthToken).where(
                 and_(
                     self.id == AuthToken.classic_user_id,
@@ -348,7 +713,7 @@ class ClassicUser(UserBase):
         if current_user is None or current_user.id != self.id:
             raise ValueError(f"Access denied")
 
-        async with AsyncSessionLocal() as session:
+        async with db_session() as session:
             stmt = select(AnonymousIdentify).where(self.id == AnonymousIdentify.owner_id)
             rows = await session.scalars(stmt)
             return list(map(lambda row: AnonymousUser(id=row.id, public_key=row.public_key.hex().upper(), created_at=row.created_at, updated_at=row.updated_at), rows))
@@ -375,6 +740,52 @@ class IsPassedCaptcha(BasePermission):
         return False
 
 
+class RateLimit(BasePermission):
+    """
+    Token bucket limits of a field, `limits` maps 'ip' or an argument name to the number of calls allowed per `period`
+    seconds. Place it before permissions that are expensive to check.
+    """
+    def __init__(self, scope: str, limits: dict[str, int], period: float = 60.0):
+        super().__init__()
+        self.scope = scope
+        self.limits = limits
+        self.period = period
+
+    def _value(self, dimension: str, info: Info[Context], kwargs: dict[str, Any]) -> Optional[str]:
+        if dimension == 'ip':
+            return info.context.client_ip
+        value = kwargs.get(dimension)
+        if value is None:
+            return None
+        # Arguments are client provided, keep the keys short whatever they hold
+        return hashlib.blake2b(str(value).lower().encode('utf-8'), digest_size=12).hexdigest()
+
+    async def has_permission(
+            self, source: Any, info: Info[Context], **kwargs: Any
+    ) -> bool:
+        if not SETTINGS.rate_limit_enabled:
+            return True
+
+        buckets = []
+        for dimension, capacity in self.limits.items():
+            value = self._value(dimension, info, kwargs)
+            if value is not None:
+                buckets.append(Bucket(key=RATE_LIMITER.key(self.scope, dimension, value), capacity=capacity, period=self.period))
+        if not buckets:
+            return True
+
+        result = await RATE_LIMITER.hit(buckets)
+        info.context.rate_limits[self.scope] = {
+            'limit': result.limit,
+            'remaining': result.remaining,
+            'retry_after': round(result.retry_after, 3),
+        }
+        if not result.allowed:
+            raise GraphQLError(f"Rate limit exceeded, retry in {result.retry_after:.1f}s",
+                               extensions={'code': 'RATE_LIMITED', 'retry_after': round(result.retry_after, 3)})
+        return True
+
+
 class HasPermission(BasePermission):
     message = "Access denied"
 
@@ -409,6 +820,61 @@ class IsAuthenticated(BasePermission):
 jwt = JsonWebToken(algorithms=['EdDSA'])
 
 
+SESSION_TOKEN_AUDIENCE = 'hiccup-session'
+
+
+def create_session_token(identity: TokenIdentity) -> tuple[str, datetime]:
+    """
+    Short lived token carrying the whole identity, verified without any lookup. It never outlives the auth token
+    it was issued from, which is used to refresh it.
+    """
+    now = int(time.time())
+    expires_at = min(now + SETTINGS.signed_session_token_ttl, int(identity.revoked_at.timestamp()))
+    user = identity.user
+    payload = {
+        'iss': 'Hiccup',
+        'aud': SESSION_TOKEN_AUDIENCE,
+        'sub': str(user.id),
+        'typ': user.type.value,
+        'tid': identity.token_id,
+        'iat': now,
+        'exp': expires_at,
+        'name': user.username if isinstance(user, ClassicUser) else user.public_key,
+        'cat': user.created_at.timestamp(),
+        'uat': user.updated_at.timestamp(),
+    }
+    token = jwt.encode(header={'alg': 'EdDSA'}, payload=payload, key=SETTINGS.service_private_key_cryptography).decode('utf-8')
+    return token, datetime.fromtimestamp(expires_at, timezone.utc)
+
+
+async def verify_session_token(token: str) -> Optional[TokenIdentity]:
+    try:
+        claims = jwt.decode(token, key=SETTINGS.service_public_key_cryptography, claims_options={
+            'iss': {'essential': True, 'value': 'Hiccup'},
+            'aud': {'essential': True, 'value': SESSION_TOKEN_AUDIENCE},
+            'exp': {'essential': True},
+        })
+        claims.validate()
+    except JoseError:
+        return None
+
+    token_id = claims['tid']
+    if REVOCATION_FILTER.might_be_revoked(token_id):
+        # Either revoked or a false positive of the filter, the auth token row tells which
+        async with AsyncSessionLocal() as session:
+            db_token: Optional[AuthToken] = await session.scalar(row_by_id(AuthToken), {'ident': token_id})
+            if db_token is None or db_token.is_expired:
+                return None
+
+    created_at = datetime.fromtimestamp(claims['cat'], timezone.utc)
+    updated_at = datetime.fromtimestamp(claims['uat'], timezone.utc)
+    if claims['typ'] == UserType.CLASSIC.value:
+        user = ClassicUser(id=int(claims['sub']), created_at=created_at, updated_at=updated_at, username=claims['name'])
+    else:
+        user = AnonymousUser(id=int(claims['sub']), created_at=created_at, updated_at=updated_at, public_key=claims['name'])
+    return TokenIdentity(token_id=token_id, user=user, revoked_at=datetime.fromtimestamp(claims['exp'], timezone.utc))
+
+
 def create_jwt(payload: dict) -> str:
     header = {'alg': 'EdDSA'}
     payload.setdefault('iss', 'Hiccup')
@@ -1,23 +1,49 @@
 import random
 import string
-from typing import Optional
+from datetime import datetime, timezone
+from typing import Optional, AsyncGenerator, Iterable, Any
 
 import sqlalchemy
 import strawberry
-from sqlalchemy import select, and_, Alias
+from sqlalchemy import select, and_, delete, Alias
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import joinedload
 from strawberry import Info
+from strawberry.permission import BasePermission
 from strawberry.scalars import JSON
 
-from hiccup.db import AsyncSessionLocal, user_joined_server_table, VirtualServer
+from hiccup import SETTINGS
+from hiccup.db import user_joined_server_table, VirtualServer, db_session, after_commit
 from hiccup.db.server import Channel, VirtualServerAlias
-from hiccup.db.user import ClassicIdentify
-from hiccup.graphql.base import IsAuthenticated, create_jwt, Context, ObfuscatedID, ClassicUser
+from hiccup.cache import get_user_permission_cached, invalidate_response_tags, VIRTUAL_SERVER_CACHE, CHANNEL_CACHE, \
+    EVENT_BROKER, PRESENCE, ALIAS_RESOLUTION_CACHE, MEMBERSHIP_INDEX
+from hiccup.cache.redis import REDIS_FAILURES
+from hiccup.graphql.base import IsAuthenticated, create_jwt, Context, ObfuscatedID, ClassicUser, CachedResponse, \
+    ResponseCacheScope, query_cost, publish_event, UserType
 from hiccup.graphql.base import obfuscated_id
 from hiccup.graphql.services import IsValidService
 from hiccup.services import get_media_controller
 
 
+class IsServerMember(BasePermission):
+    """
+    The user joined the server named by the `server_id` argument, or the server of the `channel_id` argument.
+    """
+    message = "Not a member of the server"
+
+    async def has_permission(self, source: Any, info: Info[Context], **kwargs: Any) -> bool:
+        user = await info.context.user()
+        if not isinstance(user, ClassicUser):
+            return False
+        server_id = kwargs.get('server_id')
+        if server_id is None:
+            channel = await CHANNEL_CACHE.get(kwargs['channel_id'])
+            if channel is None:
+                return False
+            server_id = channel.server_id
+        return await MEMBERSHIP_INDEX.is_member(user.id, server_id)
+
+
 @strawberry.type
 class MediaTokenType:
     service_id: str
@@ -42,6 +68,71 @@ class ChannelInfo:
     configuration: JSON
 
 
+@strawberry.type
+class PresenceMemberInfo:
+    user_id: obfuscated_id
+    user_type: UserType
+    last_seen: datetime
+
+
+@strawberry.input
+class PresenceMemberInput:
+    user_id: obfuscated_id
+    user_type: UserType
+
+
+@strawberry.type
+class ChannelPresence:
+    channel_id: obfuscated_id
+    members: list[PresenceMemberInfo]
+
+
+async def update_presence(channel_id: int, present: Iterable[tuple[str, int]], left: Iterable[tuple[str, int]] = ()) -> None:
+    """
+    Heartbeat present members and drop left ones, members showing up or leaving are announced on the channel and its server.
+    """
+    channel = await CHANNEL_CACHE.get(channel_id)
+    if channel is None:
+        raise ValueError("Channel not found")
+
+    present, left = list(present), list(left)
+    topics = [f"channel:{channel_id}", f"virtual_server:{channel.server_id}"]
+    if await PRESENCE.heartbeat(channel_id, present):
+        await publish_event(topics, "presence_joined", entity_id=channel_id, data={
+            "members": [{"user_type": user_type, "user_id": ObfuscatedID.serialize(user_id)} for user_type, user_id in present],
+        })
+    if await PRESENCE.leave(channel_id, left):
+        await publish_event(topics, "presence_left", entity_id=channel_id, data={
+            "members": [{"user_type": user_type, "user_id": ObfuscatedID.serialize(user_id)} for user_type, user_id in left],
+        })
+
+
+async def remove_member(server_id: int, member_id: int, event_type: str, user_id: Optional[int]) -> bool:
+    """
+    Delete a membership in the current unit of work, the membership index and listeners follow after commit.
+    """
+    stmt = delete(user_joined_server_table).where(and_(
+        user_joined_server_table.c.classic_user_id == member_id,
+        user_joined_server_table.c.virtual_server_id == server_id,
+    ))
+    async with db_session() as session:
+        result = await session.execute(stmt)
+        if not result.rowcount:
+            return False
+        await after_commit(MEMBERSHIP_INDEX.remove, member_id, server_id)
+        await after_commit(invalidate_response_tags, f"user_joined_server:{member_id}")
+        await after_commit(publish_event, [f"virtual_server:{server_id}"], event_type, entity_id=member_id, user_id=user_id)
+    return True
+
+
+@strawberry.type
+class ServerEvent:
+    type: str = strawberry.field(description="Event type, e.g. member_joined or channel_updated")
+    entity_id: Optional[obfuscated_id] = strawberry.field(description="Id of the row the event is about")
+    user_id: Optional[obfuscated_id] = strawberry.field(description="User that caused the event")
+    data: Optional[JSON]
+
+
 @strawberry.type
 class VirtualServerInfo:
     id: obfuscated_id
@@ -51,11 +142,13 @@ class VirtualServerInfo:
     @strawberry.field(
         description="Get list of channel in server",
         permission_classes=[IsAuthenticated],
+        extensions=[CachedResponse(tags=["virtual_server:{source.id}"], item_tags=["channel:{item.id}"])],
+        metadata=query_cost(2),
     )
     async def channels(self) -> list[ChannelInfo]:
         server_id = self.id
-        stmt = select(VirtualServer).options(joinedload(VirtualServer.channels)).where(VirtualServerAlias.id == server_id)
-        async with AsyncSessionLocal() as session:
+        stmt = select(VirtualServer).options(joinedload(VirtualServer.channels)).where(VirtualServer.id == server_id)
+        async with db_session() as session:
             virtual_server: Optional[VirtualServer] = await session.scalar(stmt)
 
             if virtual_server is None:
@@ -72,118 +165,257 @@ class ChannelMutation:
     )
     async def allocate_media_server(self, channel_id: obfuscated_id, _info: strawberry.Info[Context]) -> MediaSignalServerConnectionInfo:
         # TODO: check permission, waiting for channel controller impl
-        async with AsyncSessionLocal() as session:
-            channel = await session.scalar(select(Channel).where(Channel.id == channel_id).limit(1))
-
-            if channel is None:
-                raise ValueError("Channel not found")
-
-            allocated_service = await get_media_controller().get_or_allocate_channel_room(channel_id)
-            if allocated_service is None:
-                raise ValueError("Allocating room failed")
-
-            payload = {
-                "service_id": allocated_service.id,
-                "room_id": ObfuscatedID.serialize(channel_id),
-                "server_id": ObfuscatedID.serialize(channel.server_id),
-                "display_name": f'AnonymousUser',
-                "max_incoming_bitrate": 32000,
-            }
-
-            return MediaSignalServerConnectionInfo(
-                hostname=allocated_service.hostname,
-                port=allocated_service.port,
-                token=create_jwt(payload),
-            )
+        channel = await CHANNEL_CACHE.get(channel_id)
+
+        if channel is None:
+            raise ValueError("Channel not found")
+
+        allocated_service = await get_media_controller().get_or_allocate_channel_room(channel_id)
+        if allocated_service is None:
+            raise ValueError("Allocating room failed")
+        await publish_event([f"channel:{channel_id}"], "room_allocated", entity_id=channel_id, data={"service_id": allocated_service.id})
+
+        payload = {
+            "service_id": allocated_service.id,
+            "room_id": ObfuscatedID.serialize(channel_id),
+            "server_id": ObfuscatedID.serialize(channel.server_id),
+            "display_name": f'AnonymousUser',
+            "max_incoming_bitrate": 32000,
+        }
+
+        return MediaSignalServerConnectionInfo(
+            hostname=allocated_service.hostname,
+            port=allocated_service.port,
+            token=create_jwt(payload),
+        )
 
     @strawberry.field(
         description="Deallocate a media server. Might occur when room is empty for a period.",
         permission_classes=[IsValidService],
     )
     async def deallocate_media_server(self, channel_id: obfuscated_id) -> bool:
-        return await get_media_controller().deallocate_channel_room(channel_id)
+        deallocated = await get_media_controller().deallocate_channel_room(channel_id)
+        if deallocated:
+            await publish_event([f"channel:{channel_id}"], "room_deallocated", entity_id=channel_id)
+        return deallocated
+
+    @strawberry.field(
+        description="Join a channel, the presence lasts PRESENCE_TTL seconds unless refreshed by channelHeartbeat",
+        permission_classes=[IsAuthenticated],
+    )
+    async def join_channel(self, channel_id: obfuscated_id, info: Info[Context]) -> bool:
+        user = await info.context.user()
+        await update_presence(channel_id, [(user.type.value, user.id)])
+        return True
+
+    @strawberry.field(
+        description="Refresh presence in a channel",
+        permission_classes=[IsAuthenticated],
+    )
+    async def channel_heartbeat(self, channel_id: obfuscated_id, info: Info[Context]) -> bool:
+        user = await info.context.user()
+        await update_presence(channel_id, [(user.type.value, user.id)])
+        return True
+
+    @strawberry.field(
+        description="Leave a channel",
+        permission_classes=[IsAuthenticated],
+    )
+    async def leave_channel(self, channel_id: obfuscated_id, info: Info[Context]) -> bool:
+        user = await info.context.user()
+        await update_presence(channel_id, [], [(user.type.value, user.id)])
+        return True
+
+    @strawberry.field(
+        description="Report participants of a media room. Present members are refreshed in one batch.",
+        permission_classes=[IsValidService],
+    )
+    async def report_channel_presence(self, channel_id: obfuscated_id, present: list[PresenceMemberInput],
+                                      left: Optional[list[PresenceMemberInput]] = None) -> bool:
+        await update_presence(
+            channel_id,
+            [(member.user_type.value, member.user_id) for member in present],
+            [(member.user_type.value, member.user_id) for member in left or []],
+        )
+        return True
 
     @strawberry.field(
         description="Create alias for server",
         permission_classes=[IsAuthenticated],
     )
-    async def create_alias_for_server(self, server_id: obfuscated_id) -> str:
-        async with AsyncSessionLocal() as session:
-            virtual_server: Optional[VirtualServer] = await session.scalar(select(VirtualServer).where(VirtualServer.id == server_id))
-            if virtual_server is None:
-                raise ValueError(f"Virtual server #{ObfuscatedID.serialize(server_id)} not found")
+    async def create_alias_for_server(self, server_id: obfuscated_id, info: Info[Context]) -> str:
+        virtual_server = await VIRTUAL_SERVER_CACHE.get(server_id)
+        if virtual_server is None:
+            raise ValueError(f"Virtual server #{ObfuscatedID.serialize(server_id)} not found")
+        async with db_session() as session:
             new_alias_name = ''.join(random.SystemRandom().choice(string.ascii_uppercase + string.digits) for _ in range(10))
             new_alias = VirtualServerAlias(name=new_alias_name, virtual_server_id=virtual_server.id)
             session.add(new_alias)
-            await session.commit()
-            return new_alias_name
+        user = await info.context.user()
+        await after_commit(
+            publish_event, [f"virtual_server:{virtual_server.id}"], "alias_created",
+            entity_id=new_alias.id, user_id=user.id if isinstance(user, ClassicUser) else None,
+        )
+        return new_alias_name
 
     @strawberry.field(
         description="Join server via server alias",
         permission_classes=[IsAuthenticated],
     )
     async def join_server_by_alias(self, alias: str, info: Info[Context]) -> VirtualServerInfo:
-        async with AsyncSessionLocal() as session:
-            stmt = select(VirtualServerAlias).options(joinedload(VirtualServerAlias.virtual_server)).where(
-                and_(
-                    VirtualServerAlias.name == alias,
-                    VirtualServerAlias.valid == True,
-                )
-            )
-            result: Optional[VirtualServerAlias] = await session.scalar(stmt)
-
-            if result is None:
-                raise ValueError("Alias not found")
+        resolution = await ALIAS_RESOLUTION_CACHE.get(alias)
 
-            virtual_server: VirtualServer = result.virtual_server
+        if resolution is None or not resolution.valid:
+            raise ValueError("Alias not found")
 
-            if not virtual_server.config.allow_join_by_alias:
-                raise ValueError("Server doesn't allow join using alias")
+        if not resolution.allow_join_by_alias:
+            raise ValueError("Server doesn't allow join using alias")
 
-            user = await info.context.user()
+        user = await info.context.user()
 
-            if isinstance(user, ClassicUser):
-                new_row = user_joined_server_table.insert().values(classic_user_id=user.id, virtual_server_id=virtual_server.id)
+        if isinstance(user, ClassicUser):
+            # Joining again is a no-op, no savepoint or error round trip needed
+            new_row = pg_insert(user_joined_server_table) \
+                .values(classic_user_id=user.id, virtual_server_id=resolution.server_id) \
+                .on_conflict_do_nothing()
+            async with db_session() as session:
                 try:
-                    await session.execute(new_row)
-                    await session.commit()
-                except sqlalchemy.exc.IntegrityError:
-                    pass
+                    result = await session.execute(new_row)
                 except sqlalchemy.exc.SQLAlchemyError:
                     raise ValueError("Internal Server Error")
+                if result.rowcount:
+                    await after_commit(MEMBERSHIP_INDEX.add, user.id, resolution.server_id)
+                    await after_commit(invalidate_response_tags, f"user_joined_server:{user.id}")
+                    await after_commit(publish_event, [f"virtual_server:{resolution.server_id}"], "member_joined", entity_id=user.id, user_id=user.id)
 
-            return VirtualServerInfo(id=virtual_server.id, name=virtual_server.name, configuration=virtual_server.configuration)
+        return VirtualServerInfo(id=resolution.server_id, name=resolution.server_name, configuration=resolution.server_configuration)
+
+    @strawberry.field(
+        description="Leave a joined server",
+        permission_classes=[IsAuthenticated],
+    )
+    async def leave_server(self, server_id: obfuscated_id, info: Info[Context]) -> bool:
+        user = await info.context.user()
+        if not isinstance(user, ClassicUser):
+            return False
+        return await remove_member(server_id, user.id, "member_left", user.id)
+
+    @strawberry.field(
+        description="Remove a member from a server, allowed to the owner of the server",
+        permission_classes=[IsAuthenticated],
+    )
+    async def kick_member(self, server_id: obfuscated_id, user_id: obfuscated_id, info: Info[Context]) -> bool:
+        user = await info.context.user()
+        if not isinstance(user, ClassicUser):
+            raise ValueError("Access denied")
+        virtual_server = await VIRTUAL_SERVER_CACHE.get(server_id)
+        if virtual_server is None:
+            raise ValueError("Server not found")
+        if virtual_server.owner_id != user.id and 'admin::super_admin' not in await get_user_permission_cached(user.id):
+            raise ValueError("Access denied")
+        if user_id == virtual_server.owner_id:
+            raise ValueError("The owner of a server can't be kicked")
+        return await remove_member(server_id, user_id, "member_kicked", user.id)
 
 
 @strawberry.type
 class ChannelQuery:
     @strawberry.field(
-        description="Get list of server user joined",
+        description="Get list of server user joined, ordered by server id. "
+                    "Pass the id of the last server of a page as `after` to get the next one",
         permission_classes=[IsAuthenticated],
+        extensions=[CachedResponse(
+            scope=ResponseCacheScope.USER,
+            tags=["user_joined_server:{user.id}"],
+            item_tags=["virtual_server:{item.id}"],
+        )],
+        metadata=query_cost(5),
     )
-    async def user_server_list(self, info: Info[Context]) -> list[VirtualServerInfo]:
+    async def user_server_list(self, info: Info[Context], after: Optional[obfuscated_id] = None,
+                               first: Optional[int] = None) -> list[VirtualServerInfo]:
+        if first is not None and not 1 <= first <= SETTINGS.server_list_max_page_size:
+            raise ValueError(f"first must be between 1 and {SETTINGS.server_list_max_page_size}")
+
         user = await info.context.user()
 
         if isinstance(user, ClassicUser):
-            stmt = select(ClassicIdentify).join(ClassicIdentify.joined_servers).options(joinedload(ClassicIdentify.joined_servers)).where(ClassicIdentify.id == user.id)
-            async with AsyncSessionLocal() as session:
-                user = await session.scalar(stmt)
-
-            if user is None:
-                raise ValueError("Internal Server Error")
-
-            return list(map(lambda x: VirtualServerInfo(id=x.id, name=x.name, configuration=x.configuration), user.joined_servers))
+            result = []
+            while True:
+                server_ids = await MEMBERSHIP_INDEX.server_ids(user.id, after=after,
+                                                               limit=None if first is None else first - len(result))
+                servers = await VIRTUAL_SERVER_CACHE.get_many(server_ids)
+                result += [
+                    VirtualServerInfo(id=server.id, name=server.name, configuration=server.configuration)
+                    for server in (servers[server_id] for server_id in server_ids if server_id in servers)
+                ]
+
+                # Servers deleted since they were indexed
+                deleted = [server_id for server_id in server_ids if server_id not in servers]
+                if deleted:
+                    try:
+                        await MEMBERSHIP_INDEX.remove(user.id, *deleted)
+                    except REDIS_FAILURES:
+                        pass
+
+                # Read on past the deleted servers until the page is full or the index is exhausted
+                if not deleted or first is None or len(result) >= first:
+                    return result
+                after = server_ids[-1]
 
         return []
 
     @strawberry.field(
         description="Get server info",
         permission_classes=[IsAuthenticated],
+        extensions=[CachedResponse(tags=["virtual_server:{server_id}"])],
     )
     async def server_info(self, server_id: obfuscated_id) -> VirtualServerInfo:
-        async with AsyncSessionLocal() as session:
-            stmt = select(VirtualServer).where(VirtualServer.id == server_id)
-            result: Optional[VirtualServer] = await session.scalar(stmt)
-            if result is None:
-                raise ValueError("Server not found")
-            return VirtualServerInfo(id=result.id, name=result.name, configuration=result.configuration)
+        result = await VIRTUAL_SERVER_CACHE.get(server_id)
+        if result is None:
+            raise ValueError("Server not found")
+        return VirtualServerInfo(id=result.id, name=result.name, configuration=result.configuration)
+
+
+    @strawberry.field(
+        description="Members present in each channel of a server",
+        permission_classes=[IsAuthenticated, IsServerMember],
+        metadata=query_cost(3),
+    )
+    async def server_presence(self, server_id: obfuscated_id) -> list[ChannelPresence]:
+        async with db_session() as session:
+            channel_ids = list(await session.scalars(select(Channel.id).where(Channel.server_id == server_id)))
+        occupancy = await PRESENCE.occupancy(channel_ids)
+        return [
+            ChannelPresence(channel_id=channel_id, members=[
+                PresenceMemberInfo(
+                    user_id=member.user_id,
+                    user_type=UserType(member.user_type),
+                    last_seen=datetime.fromtimestamp(member.last_seen, tz=timezone.utc),
+                ) for member in members
+            ]) for channel_id, members in occupancy.items()
+        ]
+
+
+@strawberry.type
+class ChannelSubscription:
+    @strawberry.subscription(
+        description="Events of a server: membership, aliases and edits of the server or its channels",
+        permission_classes=[IsAuthenticated, IsServerMember],
+    )
+    async def server_events(self, server_id: obfuscated_id, info: Info[Context]) -> AsyncGenerator[ServerEvent, None]:
+        user = await info.context.user()
+        async with EVENT_BROKER.subscribe(f"virtual_server:{server_id}") as subscriber:
+            async for event in subscriber:
+                yield ServerEvent(**event)
+                # No longer a member, the stream ends with the event telling so
+                if event['type'] in ('member_left', 'member_kicked') and event.get('entity_id') == user.id:
+                    return
+
+    @strawberry.subscription(
+        description="Events of a channel: edits and media room allocation",
+        permission_classes=[IsAuthenticated, IsServerMember],
+    )
+    async def channel_events(self, channel_id: obfuscated_id) -> AsyncGenerator[ServerEvent, None]:
+        async with EVENT_BROKER.subscribe(f"channel:{channel_id}") as subscriber:
+            async for event in subscriber:
+                yield ServerEvent(**event)
@@ -0,0 +1,339 @@
+import json
+import logging
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Hashable, Iterator, Optional
+
+from graphql import DocumentNode, FieldNode, OperationDefinitionNode, get_introspection_query, graphql_sync, parse, \
+    GraphQLError, GraphQLField, GraphQLNamedType, SelectionSetNode, FragmentDefinitionNode, InlineFragmentNode, \
+    FragmentSpreadNode, get_named_type, get_nullable_type, is_list_type, value_from_ast_untyped
+from strawberry.extensions import SchemaExtension
+from strawberry.schema.execute import validate_document
+from strawberry.schema.schema_converter import GraphQLCoreConverter
+from strawberry.types import ExecutionResult
+from strawberry.types.graphql import OperationType
+
+from hiccup import SETTINGS
+from hiccup.cache import get_user_permission_cached, mark_recent_write, has_recent_write
+from hiccup.cache.persisted_query import query_hash
+from hiccup.cache.redis import REDIS_FAILURES
+from hiccup.db import UnitOfWork, CURRENT_UNIT_OF_WORK, READ_ONLY_OPERATION
+from hiccup.graphql.base import ClassicUser, QUERY_COST_METADATA_KEY
+from hiccup.metrics import METRICS, HitRate
+
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    def __init__(self, maxsize: int, hit_rate: HitRate):
+        self.maxsize = maxsize
+        self.hit_rate = hit_rate
+        self._items: OrderedDict[Hashable, Any] = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        if key not in self._items:
+            self.hit_rate.miss()
+            return None
+        self.hit_rate.hit()
+        self._items.move_to_end(key)
+        return self._items[key]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def clear(self) -> None:
+        self._items.clear()
+
+
+def get_operation(document: DocumentNode, operation_name: Optional[str]) -> Optional[OperationDefinitionNode]:
+    operations = [d for d in document.definitions if isinstance(d, OperationDefinitionNode)]
+    if operation_name is None:
+        return operations[0] if len(operations) == 1 else None
+    return next((o for o in operations if o.name is not None and o.name.value == operation_name), None)
+
+
+# Extensions below are registered as classes, strawberry instantiates them per operation so that
+# execution_context can't be swapped by a concurrent request across an await.
+
+_VALIDATION_CACHE = LRUCache(SETTINGS.graphql_validation_cache_size, METRICS.hit_rate('graphql.validation_cache'))
+
+
+class CachedValidation(SchemaExtension):
+    """
+    Caches validation errors by document hash.
+    """
+    def on_validate(self) -> Iterator[None]:
+        execution_context = self.execution_context
+        if execution_context.query is not None:
+            key = (query_hash(execution_context.query), tuple(execution_context.validation_rules))
+            errors = _VALIDATION_CACHE.get(key)
+            if errors is None:
+                errors = validate_document(
+                    execution_context.schema._schema,
+                    execution_context.graphql_document,
+                    execution_context.validation_rules,
+                )
+                _VALIDATION_CACHE.set(key, errors)
+            execution_context.errors = errors
+        yield
+
+
+_INTROSPECTION_CACHE = LRUCache(SETTINGS.graphql_introspection_cache_size, METRICS.hit_rate('graphql.introspection_cache'))
+
+
+class CachedIntrospection(SchemaExtension):
+    """
+    Serves introspection-only operations from memory. The standard introspection result is built
+    once per schema build by warm(), other introspection documents are memoized on first execution.
+    """
+    @staticmethod
+    def _key(query: str, operation: OperationDefinitionNode, variables: Optional[dict]) -> tuple:
+        return (
+            query_hash(query),
+            None if operation.name is None else operation.name.value,
+            json.dumps(variables or {}, sort_keys=True),
+        )
+
+    @staticmethod
+    def _is_introspection(operation: OperationDefinitionNode) -> bool:
+        return all(
+            isinstance(selection, FieldNode) and selection.name.value.startswith('__')
+            for selection in operation.selection_set.selections
+        )
+
+    @classmethod
+    def warm(cls, schema) -> None:
+        _INTROSPECTION_CACHE.clear()
+        query = get_introspection_query()
+        result = graphql_sync(schema._schema, query)
+        if result.errors:
+            return
+        operation = get_operation(parse(query), None)
+        _INTROSPECTION_CACHE.set(cls._key(query, operation, None), ExecutionResult(data=result.data, errors=None))
+
+    def on_execute(self) -> Iterator[None]:
+        execution_context = self.execution_context
+        operation = None
+        if execution_context.query is not None and execution_context.graphql_document is not None:
+            operation = get_operation(execution_context.graphql_document, execution_context.operation_name)
+
+        if operation is None or not self._is_introspection(operation):
+            yield
+            return
+
+        key = self._key(execution_context.query, operation, execution_context.variables)
+        cached = _INTROSPECTION_CACHE.get(key)
+        if cached is not None:
+            execution_context.result = cached
+            yield
+            return
+
+        yield
+        result = execution_context.result
+        if result is not None and not result.errors:
+            _INTROSPECTION_CACHE.set(key, result)
+
+
+class QueryCostLimiter(SchemaExtension):
+    """
+    Static cost analysis run before execution. Each field costs what its query_cost metadata declares
+    (resolver fields default to GRAPHQL_COST_DEFAULT_RESOLVER_COST, plain attributes are free), and the
+    selections below a list field are multiplied by its pagination argument.
+    """
+    def __init__(self, *, execution_context):
+        super().__init__(execution_context=execution_context)
+        self.cost: Optional[int] = None
+        self.budget: Optional[int] = None
+
+    @staticmethod
+    def _definition(graphql_object) -> Optional[Any]:
+        return (graphql_object.extensions or {}).get(GraphQLCoreConverter.DEFINITION_BACKREF)
+
+    def _field_cost(self, field: GraphQLField) -> int:
+        definition = self._definition(field)
+        if definition is None:
+            return 0
+        if definition.metadata and QUERY_COST_METADATA_KEY in definition.metadata:
+            return definition.metadata[QUERY_COST_METADATA_KEY]
+        if definition.base_resolver is not None:
+            return SETTINGS.graphql_cost_default_resolver_cost
+        return 0
+
+    def _list_size(self, field: GraphQLField, node: FieldNode) -> int:
+        for argument in node.arguments:
+            graphql_argument = field.args.get(argument.name.value)
+            definition = graphql_argument and self._definition(graphql_argument)
+            if definition is None or definition.python_name not in SETTINGS.graphql_cost_pagination_arguments:
+                continue
+            value = value_from_ast_untyped(argument.value, self.execution_context.variables)
+            if isinstance(value, int):
+                return max(value, 0)
+        return SETTINGS.graphql_cost_default_list_size
+
+    def _selection_cost(self, selection_set: SelectionSetNode, parent_type: GraphQLNamedType, fragments: dict[str, FragmentDefinitionNode]) -> int:
+        schema = self.execution_context.schema._schema
+        total = 0
+        for selection in selection_set.selections:
+            if isinstance(selection, FieldNode):
+                if selection.name.value.startswith('__'):
+                    continue
+                field = getattr(parent_type, 'fields', {}).get(selection.name.value)
+                if field is None:
+                    continue
+                children = 0
+                if selection.selection_set is not None:
+                    children = self._selection_cost(selection.selection_set, get_named_type(field.type), fragments)
+                if is_list_type(get_nullable_type(field.type)):
+                    children *= self._list_size(field, selection)
+                total += self._field_cost(field) + children
+            elif isinstance(selection, InlineFragmentNode):
+                fragment_type = parent_type
+                if selection.type_condition is not None:
+                    fragment_type = schema.get_type(selection.type_condition.name.value)
+                total += self._selection_cost(selection.selection_set, fragment_type, fragments)
+            elif isinstance(selection, FragmentSpreadNode):
+                fragment = fragments.get(selection.name.value)
+                if fragment is not None:
+                    fragment_type = schema.get_type(fragment.type_condition.name.value)
+                    total += self._selection_cost(fragment.selection_set, fragment_type, fragments)
+        return total
+
+    async def _resolve_budget(self, cost: int) -> Optional[int]:
+        """
+        Budget of the requesting user, None means unlimited. The user is only resolved when the cost
+        exceeds what anonymous requests are allowed anyway.
+        """
+        if cost <= SETTINGS.graphql_cost_budget_anonymous:
+            return SETTINGS.graphql_cost_budget_anonymous
+
+        user = await self.execution_context.context.user()
+        if user is None:
+            return SETTINGS.graphql_cost_budget_anonymous
+
+        if isinstance(user, ClassicUser):
+            permissions = await get_user_permission_cached(user.id)
+            if permissions & {'system::unlimited_query_cost', 'admin::super_admin'}:
+                return None
+
+        return SETTINGS.graphql_cost_budget_authenticated
+
+    async def on_execute(self) -> AsyncIterator[None]:
+        execution_context = self.execution_context
+        document = execution_context.graphql_document
+        operation = None
+        if SETTINGS.graphql_cost_enabled and document is not None:
+            operation = get_operation(document, execution_context.operation_name)
+
+        if operation is not None:
+            fragments = {d.name.value: d for d in document.definitions if isinstance(d, FragmentDefinitionNode)}
+            root_type = execution_context.schema._schema.get_root_type(operation.operation)
+            self.cost = self._selection_cost(operation.selection_set, root_type, fragments)
+            self.budget = await self._resolve_budget(self.cost)
+
+            if self.budget is not None and self.cost > self.budget:
+                execution_context.result = ExecutionResult(data=None, errors=[GraphQLError(
+                    f"Query cost {self.cost} exceeds the budget of {self.budget}",
+                    extensions={'code': 'QUERY_TOO_EXPENSIVE'},
+                )])
+        yield
+
+    def get_results(self) -> dict[str, Any]:
+        if self.cost is None:
+            return {}
+        return {'cost': {'requested': self.cost, 'budget': self.budget}}
+
+
+class UnitOfWorkExtension(SchemaExtension):
+    """
+    Runs each operation inside a UnitOfWork, committed when the operation finished without errors, when
+    DB_UNIT_OF_WORK_ENABLED is set.
+
+    With replicas configured, queries read from a replica unless the requesting user wrote within
+    DB_READ_YOUR_WRITES_WINDOW seconds, and mutations always run on the primary. This does not depend
+    on the unit of work, without one every db_session() block of a query picks a replica.
+    """
+    def __init__(self, *, execution_context):
+        super().__init__(execution_context=execution_context)
+        self.unit_of_work: Optional[UnitOfWork] = None
+
+    async def _writer(self) -> Optional[str]:
+        identity = await self.execution_context.context.identity()
+        if identity is None:
+            return None
+        return f'{identity.user.type.value}:{identity.user.id}'
+
+    async def _mark_write(self) -> None:
+        if not SETTINGS.db_replica_urls or not SETTINGS.db_read_your_writes_window \
+                or self.execution_context.operation_type != OperationType.MUTATION:
+            return
+        result = self.execution_context.result
+        if result is None or result.errors:
+            return
+        writer = await self._writer()
+        if writer is not None:
+            try:
+                await mark_recent_write(writer)
+            except REDIS_FAILURES as e:
+                # Committed already, the writer may read a lagging replica for a moment
+                logger.warning(f"Could not mark recent write of {writer}: {e}")
+
+    async def on_operation(self) -> AsyncIterator[None]:
+        if not SETTINGS.db_unit_of_work_enabled:
+            yield
+            await self._mark_write()
+            return
+
+        unit_of_work = self.unit_of_work = UnitOfWork()
+        token = CURRENT_UNIT_OF_WORK.set(unit_of_work)
+        try:
+            yield
+        except BaseException:
+            await unit_of_work.rollback()
+            raise
+        finally:
+            CURRENT_UNIT_OF_WORK.reset(token)
+
+        result = self.execution_context.result
+        if result is None or result.errors:
+            await unit_of_work.rollback()
+            return
+
+        await unit_of_work.commit()
+        if unit_of_work.checked_out:
+            await self._mark_write()
+
+    async def _read_only(self) -> bool:
+        if not SETTINGS.db_replica_urls or self.execution_context.operation_type != OperationType.QUERY:
+            return False
+        writer = await self._writer()
+        if writer is None:
+            return True
+        try:
+            return not await has_recent_write(writer)
+        except REDIS_FAILURES:
+            # Unknown whether the writer wrote recently, the primary is always up to date
+            return False
+
+    async def on_execute(self) -> AsyncIterator[None]:
+        read_only = await self._read_only()
+        if self.unit_of_work is not None:
+            self.unit_of_work.read_only = read_only
+        token = READ_ONLY_OPERATION.set(read_only)
+        try:
+            yield
+        finally:
+            READ_ONLY_OPERATION.reset(token)
+
+
+class RateLimitReport(SchemaExtension):
+    """
+    Reports the quota left of every rate limit the operation went through.
+    """
+    def get_results(self) -> dict[str, Any]:
+        rate_limits = getattr(self.execution_context.context, 'rate_limits', None)
+        if not rate_limits:
+            return {}
+        return {'rate_limit': dict(rate_limits)}
@@ -0,0 +1,201 @@
+import asyncio
+import logging
+from contextlib import suppress
+from typing import Any, Optional
+
+from graphql import GraphQLError
+from starlette.requests import Request
+from starlette.responses import Response
+from strawberry import UNSET
+from strawberry.exceptions import MissingQueryError
+from strawberry.fastapi import GraphQLRouter
+from strawberry.fastapi.handlers import GraphQLTransportWSHandler, GraphQLWSHandler
+from strawberry.http import GraphQLRequestData
+from strawberry.http.async_base_view import AsyncHTTPRequestAdapter
+from strawberry.http.base import BaseRequestProtocol
+from strawberry.http.exceptions import HTTPException
+from strawberry.schema.exceptions import InvalidOperationTypeError
+from strawberry.types import ExecutionResult
+from strawberry.types.graphql import OperationType
+
+from hiccup import SETTINGS
+from hiccup.cache import EVENT_BROKER
+from hiccup.cache.persisted_query import PERSISTED_QUERIES, query_hash
+from hiccup.graphql.base import Context
+
+
+logger = logging.getLogger(__name__)
+
+
+class PersistedQueryError(Exception):
+    def __init__(self, message: str, code: str):
+        super().__init__(message)
+        self.code = code
+
+    def as_graphql_error(self) -> GraphQLError:
+        return GraphQLError(str(self), extensions={'code': self.code})
+
+
+async def resolve_persisted_query(query: Optional[str], extensions: Optional[dict[str, Any]]) -> Optional[str]:
+    """
+    Resolve the document of a request following the automatic persisted queries protocol.
+    """
+    persisted_query = (extensions or {}).get('persistedQuery')
+
+    if persisted_query is None:
+        if query is not None and PERSISTED_QUERIES.allowlist_only:
+            if await PERSISTED_QUERIES.get(query_hash(query)) is None:
+                raise PersistedQueryError("Query is not in the allowlist", "PERSISTED_QUERY_NOT_ALLOWED")
+        return query
+
+    if not SETTINGS.graphql_persisted_queries_enabled:
+        raise PersistedQueryError("PersistedQueryNotSupported", "PERSISTED_QUERY_NOT_SUPPORTED")
+
+    sha256_hash = persisted_query.get('sha256Hash')
+    if not isinstance(sha256_hash, str) or persisted_query.get('version', 1) != 1:
+        raise PersistedQueryError("Unsupported persisted query", "PERSISTED_QUERY_NOT_SUPPORTED")
+
+    if query is None:
+        query = await PERSISTED_QUERIES.get(sha256_hash)
+        if query is None:
+            raise PersistedQueryError("PersistedQueryNotFound", "PERSISTED_QUERY_NOT_FOUND")
+        return query
+
+    if query_hash(query) != sha256_hash:
+        raise PersistedQueryError("Provided sha does not match query", "PERSISTED_QUERY_HASH_MISMATCH")
+
+    if PERSISTED_QUERIES.allowlist_only:
+        if await PERSISTED_QUERIES.get(sha256_hash) is None:
+            raise PersistedQueryError("Query is not in the allowlist", "PERSISTED_QUERY_NOT_ALLOWED")
+        return query
+
+    return await PERSISTED_QUERIES.register(sha256_hash, query)
+
+
+class ConnectionIdentityMixin:
+    """
+    Resolves the identity of a websocket once at connection init. The context keeps it for the lifetime
+    of the connection, and the socket is closed as soon as its token gets revoked.
+    """
+    revocation_task: Optional[asyncio.Task] = None
+
+    async def watch_revocation(self) -> None:
+        context = await self.get_context()
+        if not isinstance(context, Context):
+            return
+        try:
+            identity = await context.identity()
+        except Exception as e:
+            # Operations will retry the lookup, revocations are then only noticed at revoked_at
+            logger.warning(f"Resolving websocket identity failed: {e}")
+            return
+        if identity is None:
+            return
+
+        async with EVENT_BROKER.subscribe(f"auth_token:{identity.token_id}") as subscriber:
+            async for event in subscriber:
+                if event['type'] == 'auth_token_revoked':
+                    context.revoked = True
+                    await self.close(4403, "Token revoked")
+                    return
+
+    async def handle_connection_init(self, message) -> None:
+        await super().handle_connection_init(message)
+        if self.connection_params is not None and self.revocation_task is None:
+            self.revocation_task = asyncio.create_task(self.watch_revocation())
+
+    async def handle(self) -> Any:
+        try:
+            return await super().handle()
+        finally:
+            if self.revocation_task is not None:
+                self.revocation_task.cancel()
+                with suppress(asyncio.CancelledError):
+                    await self.revocation_task
+
+
+class HiccupGraphQLTransportWSHandler(ConnectionIdentityMixin, GraphQLTransportWSHandler):
+    pass
+
+
+class HiccupGraphQLWSHandler(ConnectionIdentityMixin, GraphQLWSHandler):
+    pass
+
+
+class HiccupGraphQLRouter(GraphQLRouter):
+    graphql_transport_ws_handler_class = HiccupGraphQLTransportWSHandler
+    graphql_ws_handler_class = HiccupGraphQLWSHandler
+
+    async def run(self, request: Request, context=UNSET, root_value=UNSET) -> Response:
+        if request.method == "POST" and "application/json" in (request.headers.get("content-type") or ""):
+            body = await request.body()
+            if body.lstrip().startswith(b'['):
+                return await self.run_batch(request, body, context, root_value)
+        return await super().run(request, context=context, root_value=root_value)
+
+    async def run_batch(self, request: Request, body: bytes, context, root_value) -> Response:
+        """
+        Execute a json array of operations concurrently with one shared context. Results keep the order
+        of the operations, operations that depend on each other's writes must be sent separately.
+        """
+        operations = self.parse_json(body)
+        if not operations or not all(isinstance(operation, dict) for operation in operations):
+            raise HTTPException(400, "Invalid batch")
+        if len(operations) > SETTINGS.graphql_max_batch_size:
+            raise HTTPException(400, f"Batch size exceeds the limit of {SETTINGS.graphql_max_batch_size}")
+
+        sub_response = await self.get_sub_response(request)
+
+        async def execute(operation: dict[str, Any]):
+            try:
+                result = await self.schema.execute(
+                    await resolve_persisted_query(operation.get('query'), operation.get('extensions')),
+                    root_value=root_value,
+                    variable_values=operation.get('variables'),
+                    context_value=context,
+                    operation_name=operation.get('operationName'),
+                    allowed_operation_types=OperationType.from_http("POST"),
+                )
+            except PersistedQueryError as e:
+                result = ExecutionResult(data=None, errors=[e.as_graphql_error()])
+            except MissingQueryError:
+                result = ExecutionResult(data=None, errors=[GraphQLError("No GraphQL query found in the request")])
+            except InvalidOperationTypeError as e:
+                result = ExecutionResult(data=None, errors=[GraphQLError(e.as_http_error_reason("POST"))])
+            return await self.process_result(request=request, result=result)
+
+        results = await asyncio.gather(*(execute(operation) for operation in operations))
+        return self.create_response(response_data=results, sub_response=sub_response)
+
+    def should_render_graphql_ide(self, request: BaseRequestProtocol) -> bool:
+        return super().should_render_graphql_ide(request) and request.query_params.get('extensions') is None
+
+    async def execute_operation(self, request, context, root_value) -> ExecutionResult:
+        try:
+            return await super().execute_operation(request, context, root_value)
+        except PersistedQueryError as e:
+            return ExecutionResult(data=None, errors=[e.as_graphql_error()])
+
+    async def parse_http_body(self, request: AsyncHTTPRequestAdapter) -> GraphQLRequestData:
+        content_type = request.content_type or ""
+
+        if request.method == "GET":
+            data = self.parse_query_params(request.query_params)
+            if data.get('extensions'):
+                data['extensions'] = self.parse_json(data['extensions'])
+        elif "application/json" in content_type:
+            data = self.parse_json(await request.get_body())
+        elif content_type.startswith("multipart/form-data"):
+            data = await self.parse_multipart(request)
+        else:
+            raise HTTPException(400, "Unsupported content type")
+
+        extensions = data.get('extensions')
+        if extensions is not None and not isinstance(extensions, dict):
+            raise HTTPException(400, "Invalid extensions")
+
+        return GraphQLRequestData(
+            query=await resolve_persisted_query(data.get('query'), extensions),
+            variables=data.get('variables'),
+            operation_name=data.get('operationName'),
+        )
@@ -2,9 +2,11 @@ from datetime import datetime
 
 import strawberry
 from strawberry.permission import PermissionExtension
+from strawberry.scalars import JSON
 
 from hiccup import SETTINGS
 from hiccup.graphql.base import HasPermission
+from hiccup.metrics import METRICS
 
 
 @strawberry.type
@@ -38,3 +40,14 @@ class SystemQuery:
     )
     def decrypt_number(self, encrypted_number: str) -> int:
         return SETTINGS.decrypt_id(encrypted_number)
+
+    @strawberry.field(
+        description="Get metrics of current worker",
+        extensions=[
+            PermissionExtension(permissions=[
+                HasPermission("system::metrics")
+            ])
+        ]
+    )
+    def metrics(self) -> JSON:
+        return METRICS.snapshot()
@@ -3,21 +3,49 @@ from typing import Optional, Union, Annotated
 
 import sqlalchemy
 import strawberry
-from sqlalchemy import select, func
+from sqlalchemy import select, func, update, and_
 from strawberry.permission import PermissionExtension
 
 from hiccup import SETTINGS
-from hiccup.cache import cache_nonce
-from hiccup.db import AsyncSessionLocal, check_ed25519_signature
+from hiccup.cache import cache_nonce, REVOCATION_FILTER
+from hiccup.db import check_ed25519_signature, db_session, after_commit
 from hiccup.db.user import ClassicIdentify, AnonymousIdentify, AuthToken
+from hiccup.db.statements import AUTH_TOKEN_IDENTITY
+from hiccup.db.batch import AUTH_TOKEN_INSERTS
 from hiccup.graphql.base import obfuscated_id
 from hiccup.graphql.base import Context
-from hiccup.graphql.base import IsPassedCaptcha, IsAuthenticated, ClassicUser, AnonymousUser
+from hiccup.graphql.base import IsPassedCaptcha, IsAuthenticated, ClassicUser, AnonymousUser, publish_event, \
+    identity_from_auth_token, create_session_token, RateLimit
+
+
+# Checked ahead of the captcha, and of the password derivation in the resolver
+REGISTER_RATE_LIMIT = RateLimit('register', {'ip': SETTINGS.rate_limit_register_per_ip}, period=SETTINGS.rate_limit_auth_period)
+LOGIN_CLASSIC_RATE_LIMIT = RateLimit('login', {'ip': SETTINGS.rate_limit_auth_per_ip, 'username': SETTINGS.rate_limit_auth_per_identity},
+                                     period=SETTINGS.rate_limit_auth_period)
+LOGIN_ANONYMOUS_RATE_LIMIT = RateLimit('login', {'ip': SETTINGS.rate_limit_auth_per_ip, 'public_key': SETTINGS.rate_limit_auth_per_identity},
+                                       period=SETTINGS.rate_limit_auth_period)
 
 
 @strawberry.type
 class SessionToken:
     token: str
+    access_token: Optional[str] = strawberry.field(default=None, description="Short lived signed token, sent as X-Hiccup-Token "
+                                                                            "instead of token while signed session tokens are enabled")
+    access_token_expires_at: Optional[datetime] = None
+
+
+async def issue_session_token(token: str) -> SessionToken:
+    """
+    Session token for an auth token, with a signed access token when they are enabled.
+    """
+    if not SETTINGS.signed_session_tokens_enabled:
+        return SessionToken(token=token)
+    async with db_session() as session:
+        identity = identity_from_auth_token(await session.scalar(AUTH_TOKEN_IDENTITY, {'token': token}))
+    if identity is None:
+        raise ValueError("Invalid or expired token")
+    access_token, expires_at = create_session_token(identity)
+    return SessionToken(token=token, access_token=access_token, access_token_expires_at=expires_at)
 
 
 @strawberry.type
@@ -29,7 +57,7 @@ class UserQuery:
     async def user_info(self, uid: Annotated[obfuscated_id, strawberry.argument(
         description="User id"
     )]) -> Union[ClassicUser, AnonymousUser]:
-        async with AsyncSessionLocal() as session:
+        async with db_session() as session:
             user: Optional[AnonymousIdentify] = await session.get(AnonymousIdentify, uid)
             if user is not None:
                 return AnonymousUser(id=uid, public_key=user.public_key.hex(), created_at=datetime.now(), updated_at=datetime.now())
@@ -47,22 +75,22 @@ class UserQuery:
 
 @strawberry.type
 class UserMutation:
-    @strawberry.mutation(description="Register classic user", permission_classes=[IsPassedCaptcha])
+    @strawberry.mutation(description="Register classic user", extensions=[PermissionExtension(permissions=[REGISTER_RATE_LIMIT, IsPassedCaptcha()])])
     async def register_classic(self, username: str, password: str) -> ClassicUser:
         if not SETTINGS.register_enabled:
             raise RuntimeError("Registration is not enabled")
-        async with AsyncSessionLocal() as session:
+        async with db_session() as session:
             derived_key, salt = ClassicIdentify.encrypt_password(password.encode("utf-8"))
             new_user = ClassicIdentify(user_name=username, password=derived_key, salt=salt)
             session.add(new_user)
             try:
-                await session.commit()
+                await session.flush()
             except sqlalchemy.exc.IntegrityError:
                 raise ValueError(f"User {username} already registered")
             await session.refresh(new_user)
             return ClassicUser(id=new_user.id, username=new_user.user_name, updated_at=new_user.updated_at, created_at=new_user.created_at)
 
-    @strawberry.mutation(description="Register anonymous user.", permission_classes=[IsPassedCaptcha])
+    @strawberry.mutation(description="Register anonymous user.", extensions=[PermissionExtension(permissions=[REGISTER_RATE_LIMIT, IsPassedCaptcha()])])
     async def register_anonymous(self, public_key: Annotated[str, strawberry.argument(
         description="Ed25519 public key in hex"
     )]) -> AnonymousUser:
@@ -72,30 +100,29 @@ class UserMutation:
         if not AnonymousIdentify.is_valid_ed25519_public_key(public_key_bytes):
             raise ValueError("Invalid public key")
 
-        async with AsyncSessionLocal() as session:
+        async with db_session() as session:
             new_user = AnonymousIdentify(public_key=public_key_bytes)
             session.add(new_user)
             try:
-                await session.commit()
+                await session.flush()
             except sqlalchemy.exc.IntegrityError:
                 raise ValueError(f"User with public key '{public_key}' already registered")
             await session.refresh(new_user)
             return AnonymousUser(id=new_user.id, public_key=new_user.public_key.hex(), created_at=datetime.now(), updated_at=datetime.now())
 
-    @strawberry.mutation(description="Login classic user", permission_classes=[IsPassedCaptcha])
+    @strawberry.mutation(description="Login classic user", extensions=[PermissionExtension(permissions=[LOGIN_CLASSIC_RATE_LIMIT, IsPassedCaptcha()])])
     async def login_classic(self, username: str, password: str) -> SessionToken:
-        async with AsyncSessionLocal() as session:
+        async with db_session() as session:
             db_user: ClassicIdentify = (await session.scalars(select(ClassicIdentify).where(
                 username == ClassicIdentify.user_name).limit(1))).one_or_none()
             if db_user is None or not db_user.is_password_valid(password.encode("utf-8")):
                 raise ValueError(f"User {username} not found or invalid password")
 
-            token = AuthToken.new_classic_token(db_user.id)
-            session.add(token)
-            await session.commit()
-            return SessionToken(token=token.token)
+        # Group committed with concurrent logins, resumes once the token is durable
+        token = await AUTH_TOKEN_INSERTS.insert(AuthToken.new_classic_token(db_user.id))
+        return await issue_session_token(token.token)
 
-    @strawberry.mutation(description="Login anonymous user.", permission_classes=[IsPassedCaptcha])
+    @strawberry.mutation(description="Login anonymous user.", extensions=[PermissionExtension(permissions=[LOGIN_ANONYMOUS_RATE_LIMIT, IsPassedCaptcha()])])
     async def login_anonymous(self, public_key: Annotated[str, strawberry.argument(description="Ed25519 public key in hex")],
                               timestamp: Annotated[int, strawberry.argument(description="Posix timestamp. The timestamp must within +-30s of server time")],
                               nonce: Annotated[str, strawberry.argument(description="A random string")],
@@ -103,20 +130,24 @@ class UserMutation:
 
         public_key_bytes = bytes.fromhex(public_key)
         verify_action_signature('login', public_key_bytes=public_key_bytes, timestamp=timestamp, nonce=nonce, signature=signature)
+        # Replays are turned away before they reach the database
+        if not await cache_nonce(nonce, timestamp, scope=f'login-{public_key_bytes.hex()}'):
+            raise ValueError(f"Nonce '{nonce}' is already used, try another one.")
 
-        async with AsyncSessionLocal() as session:
+        async with db_session() as session:
             db_user: AnonymousIdentify = await session.scalar(select(AnonymousIdentify).where(
                 public_key_bytes == AnonymousIdentify.public_key).limit(1))
             if db_user is None:
                 raise ValueError(f"User with public key '{public_key}' not found")
 
-            if not await cache_nonce(nonce):
-                raise ValueError(f"Nonce '{nonce}' is already used, try another one.")
+        token = await AUTH_TOKEN_INSERTS.insert(AuthToken.new_anonymous_token(db_user.id))
+        return await issue_session_token(token.token)
 
-            token = AuthToken.new_anonymous_token(db_user.id)
-            session.add(token)
-            await session.commit()
-            return SessionToken(token=token.token)
+    @strawberry.mutation(description="Issue a new signed access token from the token returned at login")
+    async def refresh_session_token(self, token: str) -> SessionToken:
+        if not SETTINGS.signed_session_tokens_enabled:
+            raise ValueError("Signed session tokens are not enabled")
+        return await issue_session_token(token)
 
     @strawberry.mutation(description="Binding anonymous identify to a classic identify. Auto register public key if anonymous doesn't exist.", permission_classes=[IsAuthenticated])
     async def bind_anonymous_identify(
@@ -133,29 +164,51 @@ class UserMutation:
         if user:
             public_key_bytes = bytes.fromhex(public_key)
             verify_action_signature(f'bind-to-{user.id}', public_key_bytes=public_key_bytes, timestamp=timestamp, nonce=nonce, signature=signature)
+            if not await cache_nonce(nonce, timestamp, scope=f'bind-to-{user.id}-{public_key_bytes.hex()}'):
+                raise ValueError(f"Nonce '{nonce}' is already used, try another one.")
 
-            async with AsyncSessionLocal() as session:
+            async with db_session() as session:
                 db_user: AnonymousIdentify = await session.scalar(select(AnonymousIdentify).where(
                     public_key_bytes == AnonymousIdentify.public_key).limit(1))
                 if db_user is None:
                     db_user = AnonymousIdentify(public_key=public_key_bytes)
                     session.add(db_user)
-                    await session.commit()
-                    await session.refresh(db_user)
-
-                if not await cache_nonce(nonce):
-                    raise ValueError(f"Nonce '{nonce}' is already used, try another one.")
+                    await session.flush()
 
                 db_user.owner_id = user.id
                 session.add(db_user)
-                await session.commit()
                 return True
 
         return False
 
-    @strawberry.mutation(description="Create default administrator", permission_classes=[IsPassedCaptcha])
+    @strawberry.mutation(description="Revoke an auth token. Revoke the token of current request if token_id is null. "
+                                     "Websocket connections using the token are closed.", permission_classes=[IsAuthenticated])
+    async def revoke_auth_token(self, info: strawberry.Info[Context], token_id: Optional[obfuscated_id] = None) -> bool:
+        identity = await info.context.identity()
+
+        if token_id is None:
+            condition = AuthToken.id == identity.token_id
+        elif isinstance(identity.user, ClassicUser):
+            condition = and_(AuthToken.id == token_id, AuthToken.classic_user_id == identity.user.id)
+        else:
+            condition = and_(AuthToken.id == token_id, AuthToken.anonymous_user_id == identity.user.id)
+
+        async with db_session() as session:
+            revoked_id = await session.scalar(
+                update(AuthToken).where(condition, AuthToken.revoked_at > func.now())
+                .values(revoked_at=func.now()).returning(AuthToken.id)
+            )
+            if revoked_id is None:
+                return False
+
+            await after_commit(publish_event, [f"auth_token:{revoked_id}"], "auth_token_revoked", entity_id=revoked_id)
+            if SETTINGS.signed_session_tokens_enabled:
+                await after_commit(REVOCATION_FILTER.revoke, revoked_id)
+        return True
+
+    @strawberry.mutation(description="Create default administrator", extensions=[PermissionExtension(permissions=[REGISTER_RATE_LIMIT, IsPassedCaptcha()])])
     async def create_default_admin(self, username: str, password: str) -> ClassicUser:
-        async with AsyncSessionLocal() as session:
+        async with db_session() as session:
             stmt = select(func.count()).select_from(ClassicIdentify)
             count = await session.scalar(stmt)
             if count != 0:
@@ -174,7 +227,7 @@ def verify_action_signature(
     signature: Annotated[str, strawberry.argument(
         description="Signature of utf-8(no-bom) encoded text '{action}-{timestamp}-{nonce}' using private key")],
 ) -> bool:
-    if abs(datetime.fromtimestamp(timestamp) - datetime.now()) > timedelta(seconds=30):
+    if abs(datetime.fromtimestamp(timestamp) - datetime.now()) > timedelta(seconds=SETTINGS.signed_action_max_skew):
         raise ValueError("Invalid timestamp")
     if len(nonce) > 64 or len(nonce) < 5:
         raise ValueError("Nonce too long / too short")
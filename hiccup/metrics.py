@@ -0,0 +1,43 @@
+from typing import Any, Callable
+
+
+class HitRate:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def hit(self) -> None:
+        self.hits += 1
+
+    def miss(self) -> None:
+        self.misses += 1
+
+    @property
+    def rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def snapshot(self) -> dict[str, Any]:
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.rate}
+
+
+class MetricsRegistry:
+    """
+    Per worker metrics. Sources are callables so that values are read only when exported.
+    """
+    def __init__(self):
+        self._sources: dict[str, Callable[[], dict[str, Any]]] = {}
+
+    def register(self, name: str, source: Callable[[], dict[str, Any]]) -> None:
+        self._sources[name] = source
+
+    def hit_rate(self, name: str) -> HitRate:
+        counter = HitRate()
+        self.register(name, counter.snapshot)
+        return counter
+
+    def snapshot(self) -> dict[str, dict[str, Any]]:
+        return {name: source() for name, source in self._sources.items()}
+
+
+METRICS = MetricsRegistry()
@@ -0,0 +1,118 @@
+import asyncio
+import enum
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Optional
+
+from hiccup import SETTINGS
+from hiccup.metrics import METRICS
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitState(str, enum.Enum):
+    Closed = "closed"
+    Open = "open"
+    HalfOpen = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Stops calling a dependency after `failure_threshold` consecutive failures. Calls are rejected right away
+    for `reset_timeout` seconds, then a single trial call is let through, its result decides whether the circuit
+    closes or opens for another period. Calls are rejected while the trial is in flight, a trial that reports
+    no result within `reset_timeout` is replaced by the next call.
+    """
+    def __init__(self, name: str, *, timeout: Optional[float] = None, failure_threshold: Optional[int] = None,
+                 reset_timeout: Optional[float] = None):
+        self.name = name
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold or SETTINGS.breaker_failure_threshold
+        self.reset_timeout = reset_timeout or SETTINGS.breaker_reset_timeout
+        self.state = CircuitState.Closed
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trial_started_at = 0.0
+        self.calls = 0
+        self.failures = 0
+        self.rejected = 0
+        self.latency_avg = 0.0
+        self.latency_max = 0.0
+        METRICS.register(f'breaker.{name}', self.stats)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            'state': self.state.value,
+            'calls': self.calls,
+            'failures': self.failures,
+            'rejected': self.rejected,
+            'latency_avg_ms': round(self.latency_avg * 1000, 3),
+            'latency_max_ms': round(self.latency_max * 1000, 3),
+        }
+
+    def allow(self) -> None:
+        """
+        Raises CircuitOpenError while the dependency is given time to recover.
+        """
+        now = time.monotonic()
+        if self.state == CircuitState.Open:
+            if now - self.opened_at < self.reset_timeout:
+                self.rejected += 1
+                raise CircuitOpenError(f"Circuit {self.name} is open")
+            self.state = CircuitState.HalfOpen
+            self.trial_started_at = now
+        elif self.state == CircuitState.HalfOpen:
+            if now - self.trial_started_at < self.reset_timeout:
+                self.rejected += 1
+                raise CircuitOpenError(f"Circuit {self.name} is half open, a trial call is in flight")
+            self.trial_started_at = now
+
+    def record_success(self, latency: float) -> None:
+        self.calls += 1
+        # Exponentially weighted, recent calls dominate
+        self.latency_avg = latency if self.calls == 1 else self.latency_avg * 0.9 + latency * 0.1
+        self.latency_max = max(self.latency_max, latency)
+        self.consecutive_failures = 0
+        self.state = CircuitState.Closed
+
+    def record_failure(self) -> None:
+        self.calls += 1
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.state == CircuitState.HalfOpen or self.consecutive_failures >= self.failure_threshold:
+            self.state = CircuitState.Open
+            self.opened_at = time.monotonic()
+
+    @asynccontextmanager
+    async def guard(self) -> AsyncIterator[None]:
+        """
+        Run a call under the breaker and its timeout. Any exception counts as a failure of the dependency.
+        """
+        self.allow()
+        started = time.perf_counter()
+        try:
+            async with asyncio.timeout(self.timeout):
+                yield
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success(time.perf_counter() - started)
+
+
+_BREAKERS: dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(name: str, **kwargs: Any) -> CircuitBreaker:
+    """
+    Breaker of a dependency, created with `kwargs` on first use.
+    """
+    if name not in _BREAKERS:
+        _BREAKERS[name] = CircuitBreaker(name, **kwargs)
+    return _BREAKERS[name]
+
+
+REDIS_BREAKER = get_breaker('redis')
+SERVICE_REGISTRY_BREAKER = get_breaker('service_registry')
+TURNSTILE_BREAKER = get_breaker('turnstile', timeout=SETTINGS.captcha_timeout)
@@ -1,8 +1,12 @@
+import asyncio
 from typing import Optional, Literal
 
 import aiohttp
 from unicodedata import category
 
+from hiccup import SETTINGS
+from hiccup.cache.singleflight import SingleFlight
+from hiccup.resilience import CircuitOpenError, get_breaker
 from hiccup.services.registry import ServiceController, ServiceHealthType, SERVICE_REGISTRY, ServiceRegistry, ServiceInfo
 
 
@@ -11,14 +15,24 @@ class MediaServiceController(ServiceController):
         super().__init__(service)
 
     async def check_health(self) -> ServiceHealthType:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{self.info.domain_or_ip}/") as resp:
-                if resp.status == 418:
-                    return ServiceHealthType.Healthy
+        # One breaker per service, a dead server doesn't get probed on every check
+        breaker = get_breaker(f'health_probe.{self.info.id}', timeout=SETTINGS.health_probe_timeout)
+        try:
+            async with breaker.guard():
+                async with aiohttp.ClientSession() as session:
+                    async with session.get(f"{self.info.domain_or_ip}/") as resp:
+                        status = resp.status
+        except (CircuitOpenError, asyncio.TimeoutError, aiohttp.ClientError, OSError):
+            return ServiceHealthType.Unavailable
 
+        if status == 418:
+            return ServiceHealthType.Healthy
         return ServiceHealthType.Unavailable
 
 
+ROOM_ALLOCATIONS = SingleFlight('room_allocation')
+
+
 # noinspection PyProtectedMember
 class MediaController:
     registry: ServiceRegistry
@@ -28,6 +42,11 @@ class MediaController:
         self.registry = registry
 
     async def get_or_allocate_channel_room(self, channel_id: int, tags: Optional[list[str]] = None) -> Optional[ServiceInfo]:
+        # Joins of a channel within this worker share one lookup, the redis lock serializes the workers
+        flight_key = (channel_id, tuple(sorted(tags)) if tags is not None else None)
+        return await ROOM_ALLOCATIONS.do(flight_key, lambda: self._get_or_allocate_channel_room(channel_id, tags))
+
+    async def _get_or_allocate_channel_room(self, channel_id: int, tags: Optional[list[str]] = None) -> Optional[ServiceInfo]:
         key = f"room_of_{channel_id}"
         async with self.registry._redis_session() as session:
             async with self.registry._redis_lock(session, lock_key=f"lock::{key}", timeout=3.0):
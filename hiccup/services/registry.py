@@ -12,6 +12,8 @@ from pydantic import BaseModel
 from redis.asyncio.client import PubSub
 
 from hiccup import SETTINGS
+from hiccup.cache.redis import measured_connection_pool
+from hiccup.resilience import CircuitOpenError, SERVICE_REGISTRY_BREAKER
 
 
 class ServiceInfo(BaseModel):
@@ -53,7 +55,7 @@ class ServiceRegistry:
     pub_sub_task: asyncio.Task
 
     def __init__(self):
-        self.pool = redis.ConnectionPool().from_url(SETTINGS.service_registry_redis_url)
+        self.pool = measured_connection_pool(SETTINGS.service_registry_redis_url, SERVICE_REGISTRY_BREAKER)
         self._namespace = SETTINGS.service_registry_namespace
 
     async def setup(self):
@@ -86,6 +88,10 @@ class ServiceRegistry:
                 self.client = None
 
             async def __aenter__(self):
+                try:
+                    SERVICE_REGISTRY_BREAKER.allow()
+                except CircuitOpenError as e:
+                    raise redis.ConnectionError(str(e)) from e
                 self.client = redis.Redis(connection_pool=self.pool)
                 return self.client
 